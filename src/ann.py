@@ -0,0 +1,184 @@
+import numpy as np
+from typing import Dict, List
+from sparse_matrix import expand_ranges
+import dataclasses
+import json
+import os
+import tempfile
+import time
+
+# compare_with_exactで全件走査を計測する間だけ空にする、推薦器の類似度のキャッシュ
+_SIMILARITY_CACHE_ATTRIBUTES = ['_similarity_cache', '_similarity_row_cache', '_dirty_similarity',
+                                '_similarity_operands']
+
+
+@dataclasses.dataclass
+class RandomProjectionLSH:
+    """ランダム射影によるLSHのインデックス。
+    ベクトルをn_bits本の超平面で符号化したものをバケットとし、n_tables個のテーブルを持つ。
+    n_tablesを増やすと再現率が上がり、n_bitsを増やすと候補が減って検索が速くなる
+    """
+    n_tables: int = 8
+    n_bits: int = 12
+    seed: int = 0
+
+    def fit(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray,
+            n_dims: int) -> 'RandomProjectionLSH':
+        """圧縮形式で与えたベクトル群からインデックスを作成する
+
+        Args:
+            indptr (np.ndarray): ベクトルiの要素は indptr[i]:indptr[i+1]
+            indices (np.ndarray): 各要素の次元
+            data (np.ndarray): 各要素の値
+            n_dims (int): 次元数
+
+        Returns:
+            RandomProjectionLSH: 自身
+        """
+        rng = np.random.default_rng(self.seed)
+        # テーブル単位で乱数を生成し、同じシードならテーブルを増やしても既存のテーブルは変わらないようにする
+        self._planes = rng.standard_normal(
+            (self.n_tables * self.n_bits, n_dims)).T
+        n_objects = len(indptr) - 1
+        projections = np.zeros((n_objects, self._planes.shape[1]))
+        nonempty = np.diff(indptr) > 0
+        if len(data) > 0:
+            contributions = data[:, np.newaxis] * self._planes[indices]
+            projections[nonempty] = np.add.reduceat(
+                contributions, indptr[:-1][nonempty], axis=0)
+        self._codes = self._hash(projections)
+        # テーブルごとに符号でソートしておき、検索は二分探索で行う
+        self._order = np.argsort(self._codes, axis=0, kind='stable')
+        self._sorted_codes = np.take_along_axis(
+            self._codes, self._order, axis=0)
+        return self
+
+    def _hash(self, projections: np.ndarray) -> np.ndarray:
+        """射影した値をテーブルごとの符号に変換する
+
+        Args:
+            projections (np.ndarray): 射影した値 (ベクトル数, n_tables * n_bits)
+
+        Returns:
+            np.ndarray: 符号 (ベクトル数, n_tables)
+        """
+        bits = (projections > 0).reshape(
+            len(projections), self.n_tables, self.n_bits)
+        weights = np.left_shift(1, np.arange(self.n_bits, dtype=np.int64))
+        return bits.astype(np.int64) @ weights
+
+    def query_candidates(self, indices: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """クエリベクトルといずれかのテーブルで同じバケットに入るベクトルのindexを返却する。
+        インデックスの作成後に追加された次元の要素は無視する
+
+        Args:
+            indices (np.ndarray): クエリベクトルの要素の次元
+            values (np.ndarray): クエリベクトルの要素の値
+
+        Returns:
+            np.ndarray: 候補のindex(昇順)
+        """
+        # インデックスの作成後に追加された次元は、作成時と同じく値が0だったものとみなす
+        indices = np.asarray(indices)
+        known = indices < self._planes.shape[0]
+        projection = np.asarray(values)[known] @ self._planes[indices[known]]
+        codes = self._hash(projection[np.newaxis, :])[0]
+        starts = np.empty(self.n_tables, dtype=np.int64)
+        ends = np.empty(self.n_tables, dtype=np.int64)
+        for table, code in enumerate(codes):
+            starts[table] = np.searchsorted(
+                self._sorted_codes[:, table], code, side='left')
+            ends[table] = np.searchsorted(
+                self._sorted_codes[:, table], code, side='right')
+        # テーブルごとのソート順をつなげた1次元配列上の位置に変換する
+        offsets = np.arange(self.n_tables) * len(self._order)
+        pos = expand_ranges(starts + offsets, ends - starts)
+        return np.unique(self._order.T.ravel()[pos])
+
+
+def compare_with_exact(recommendation, object_type: str = 'user', top_n: int = 10,
+                       n_queries: int = 100, seed: int = 0) -> Dict[str, float]:
+    """近似最近傍探索と全件走査を比較し、再現率と1クエリあたりの平均時間を返却する。
+    全件走査は類似度のキャッシュを空にして計測し、終了後に推薦器のキャッシュを元に戻す
+
+    Args:
+        recommendation (Recommendation): build_ann_indexでインデックスを作成済みの推薦器
+        object_type (str, optional): 'user' or 'item'
+        top_n (int, optional): 取得する類似ユーザ(アイテム)数
+        n_queries (int, optional): クエリ数
+        seed (int, optional): クエリを選ぶ乱数のシード
+
+    Returns:
+        Dict[str, float]: recall, candidate_ratio(全体に対する候補の割合), exact_seconds, approximate_seconds
+    """
+    if object_type == 'user':
+        object_list, table = recommendation._get_user_list(), recommendation._users
+    else:
+        object_list, table = recommendation._get_item_list(), recommendation._items
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(object_list, size=min(
+        n_queries, len(object_list)), replace=False)
+    # 全件走査は類似度のキャッシュを使わずに計測する。計測中に作られたキャッシュは捨て、元のキャッシュに戻す
+    saved = {name: getattr(recommendation, name) for name in _SIMILARITY_CACHE_ATTRIBUTES + ['_buffers']}
+    for name in _SIMILARITY_CACHE_ATTRIBUTES:
+        setattr(recommendation, name, {})
+    recommendation._buffers = dict(saved['_buffers'])
+    try:
+        exact: List[List[str]] = []
+        start = time.perf_counter()
+        for name in queries:
+            exact.append([k for k, _ in recommendation._get_similar_objects(
+                object_type, name, top_n=top_n)])
+        exact_seconds = time.perf_counter() - start
+    finally:
+        for name, value in saved.items():
+            setattr(recommendation, name, value)
+    approximate: List[List[str]] = []
+    n_candidates = 0
+    start = time.perf_counter()
+    for name in queries:
+        approximate.append([k for k, _ in recommendation._get_similar_objects(
+            object_type, name, top_n=top_n, approximate=True)])
+    approximate_seconds = time.perf_counter() - start
+    index = recommendation._ann_index[object_type]
+    for name in queries:
+        n_candidates += len(index.query_candidates(
+            *recommendation._get_centered_ratings(object_type, table[name])))
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approximate))
+    total = sum(len(e) for e in exact)
+    return {
+        'recall': hits / total if total > 0 else 1.0,
+        'candidate_ratio': n_candidates / len(queries) / len(object_list),
+        'exact_seconds': exact_seconds / len(queries),
+        'approximate_seconds': approximate_seconds / len(queries),
+    }
+
+
+def main() -> None:
+    # 潜在因子から生成した合成データで、近似最近傍探索と全件走査を比較する
+    from recommendation import Recommendation
+    rng = np.random.default_rng(0)
+    n_users, n_items, n_factors = 5000, 1000, 4
+    scores = rng.standard_normal(
+        (n_users, n_factors)) @ rng.standard_normal((n_factors, n_items))
+    ratings = np.clip(np.round(3 + scores / np.sqrt(n_factors)), 1, 5)
+    observed = rng.random((n_users, n_items)) < 0.1
+    data = {'user{}'.format(u): {'item{}'.format(i): float(ratings[u, i])
+                                 for i in np.where(observed[u])[0]}
+            for u in range(n_users)}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'ratings.json')
+        with open(file_name, 'w') as f:
+            json.dump(data, f)
+        recommendation = Recommendation(
+            file_name=file_name, metric='pearson', storage='sparse')
+    for n_bits in [4, 8]:
+        for n_tables in [1, 4, 16]:
+            recommendation.build_ann_index(
+                'user', n_tables=n_tables, n_bits=n_bits)
+            print('n_bits={} n_tables={}'.format(n_bits, n_tables),
+                  compare_with_exact(recommendation, 'user', n_queries=50))
+
+
+if __name__ == "__main__":
+    main()
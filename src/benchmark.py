@@ -0,0 +1,253 @@
+import numpy as np
+from typing import Callable, Dict, List, Sequence, Tuple
+from recommendation import Recommendation
+from similarity import calc_similarity_with_missing_value
+import argparse
+import dataclasses
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+
+@dataclasses.dataclass
+class SyntheticRatings:
+    """ベンチマーク用の合成評価データの生成器。
+    アイテムの人気はべき乗則(順位の-popularity_exponent乗に比例)に従い、
+    評価値はrating_probabilitiesで与えた1〜len(rating_probabilities)の分布に従う
+    """
+    n_users: int = 1000
+    n_items: int = 500
+    density: float = 0.02
+    popularity_exponent: float = 1.0
+    rating_probabilities: Tuple[float, ...] = (0.05, 0.1, 0.25, 0.35, 0.25)
+    seed: int = 0
+
+    def generate(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(ユーザ, アイテム, 評価値)の三つ組をログのように順不同で生成する。同じユーザとアイテムの組は1度しか現れない
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: ユーザindex、アイテムindex、評価値
+        """
+        rng = np.random.default_rng(self.seed)
+        n_cells = self.n_users * self.n_items
+        n_ratings = min(int(round(self.density * n_cells)), n_cells)
+        popularity = (np.arange(self.n_items) + 1.0) ** -self.popularity_exponent
+        popularity /= popularity.sum()
+        # 評価数はユーザ間でほぼ均等に割り当てる
+        counts = np.full(self.n_users, n_ratings // self.n_users)
+        counts[rng.permutation(self.n_users)[:n_ratings % self.n_users]] += 1
+        log_popularity = np.log(popularity)
+        key_blocks = []
+        # Gumbel-top-k法で、ユーザごとに人気に比例した重みでアイテムを非復元抽出する
+        block_size = max(1, 2 ** 22 // max(self.n_items, 1))
+        for start in range(0, self.n_users, block_size):
+            block = np.arange(start, min(start + block_size, self.n_users))
+            scores = log_popularity + rng.gumbel(size=(len(block), self.n_items))
+            order = np.argsort(-scores, axis=1)
+            selected = np.arange(self.n_items) < counts[block, np.newaxis]
+            key_blocks.append((block[:, np.newaxis] * self.n_items + order)[selected])
+        keys = np.concatenate(key_blocks) if key_blocks else np.zeros(0, dtype=np.int64)
+        keys = rng.permutation(keys)
+        probabilities = np.asarray(self.rating_probabilities, dtype=np.float64)
+        ratings = rng.choice(len(probabilities), size=len(keys),
+                             p=probabilities / probabilities.sum()) + 1.0
+        return keys // self.n_items, keys % self.n_items, ratings
+
+    def write(self, file_name: str, file_format: str = 'csv'):
+        """生成した評価ログをファイルに書き出す
+
+        Args:
+            file_name (str): ファイル名
+            file_format (str, optional): 'csv' or 'jsonl'
+        """
+        user_idx, item_idx, ratings = self.generate()
+        with open(file_name, 'w') as f:
+            if file_format == 'csv':
+                f.write('user,item,rating\n')
+                for u, i, r in zip(user_idx, item_idx, ratings):
+                    f.write('user{},item{},{}\n'.format(u, i, r))
+            elif file_format == 'jsonl':
+                for u, i, r in zip(user_idx, item_idx, ratings):
+                    f.write(json.dumps({'user': 'user{}'.format(u),
+                                        'item': 'item{}'.format(i),
+                                        'rating': float(r)}) + '\n')
+            else:
+                raise Exception("Unknown file_format: {}".format(file_format))
+
+
+def _summarize(latencies: Sequence[float], n_operations: int, peak_memory: int) -> Dict[str, float]:
+    """計測結果をレイテンシのパーセンタイル、スループット、ピークメモリにまとめる
+
+    Args:
+        latencies (Sequence[float]): 1回ごとの所要時間(秒)
+        n_operations (int): 処理した件数
+        peak_memory (int): tracemallocで計測したピークメモリ(バイト)
+
+    Returns:
+        Dict[str, float]: 計測結果
+    """
+    latencies_ms = np.asarray(latencies) * 1000
+    total = float(np.sum(latencies))
+    return {
+        'n': len(latencies),
+        'mean_ms': float(np.mean(latencies_ms)),
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p90_ms': float(np.percentile(latencies_ms, 90)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'max_ms': float(np.max(latencies_ms)),
+        'throughput_per_second': n_operations / total if total > 0 else 0.0,
+        'peak_memory_mb': peak_memory / 2 ** 20,
+    }
+
+
+def _measure(setup: Callable[[], object], run: Callable[[object, object], int],
+             queries: List) -> Dict[str, float]:
+    """シナリオを計測する。setupで作った新しい状態に対してクエリを1つずつ実行して時間を測り、
+    改めて作った状態で最初のクエリをtracemalloc下で実行してピークメモリを測る
+
+    Args:
+        setup (Callable[[], object]): 状態を作る関数
+        run (Callable[[object, object], int]): 状態とクエリを受け取り、処理した件数を返す関数
+        queries (List): クエリのリスト
+
+    Returns:
+        Dict[str, float]: 計測結果
+    """
+    state = setup()
+    latencies = []
+    n_operations = 0
+    for query in queries:
+        start = time.perf_counter()
+        n_operations += run(state, query)
+        latencies.append(time.perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    run(state, queries[0])
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return _summarize(latencies, n_operations, peak_memory)
+
+
+def run_benchmarks(generator: SyntheticRatings, storage: str = 'dense', metric: str = 'euclidean',
+                   n_queries: int = 50, top_n: int = 10, repeats: int = 3) -> Dict:
+    """合成データに対して各シナリオを計測する。
+    類似度のキャッシュは各シナリオの開始時に空にするため、最初のクエリの計算時間も含まれる
+
+    Args:
+        generator (SyntheticRatings): 合成データの生成器
+        storage (str, optional): 'dense' or 'sparse'
+        metric (str, optional): 類似度
+        n_queries (int, optional): 1シナリオあたりのクエリ数
+        top_n (int, optional): 推薦・類似検索の件数
+        repeats (int, optional): 読み込みと全ユーザ一括推薦の繰り返し回数
+
+    Returns:
+        Dict: config(条件)、scenarios(シナリオごとの計測結果)、max_rss_mb
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'ratings.csv')
+        generator.write(file_name, 'csv')
+        snapshot_path = os.path.join(tmp_dir, 'snapshot')
+
+        def load() -> Recommendation:
+            return Recommendation(file_name=file_name, file_format='csv', storage=storage, metric=metric)
+
+        def setup() -> Recommendation:
+            return Recommendation(file_name=snapshot_path, file_format='snapshot', storage=storage, metric=metric)
+
+        def run_load(state, _) -> int:
+            load()
+            return 1
+
+        results['load'] = _measure(lambda: None, run_load, [None] * repeats)
+        recommendation = load()
+        recommendation.save_snapshot(snapshot_path)
+        rng = np.random.default_rng(generator.seed)
+        users = [str(u) for u in rng.choice(recommendation._get_user_list(), size=min(
+            n_queries, len(recommendation._get_user_list())), replace=False)]
+        items = [str(i) for i in rng.choice(recommendation._get_item_list(), size=min(
+            n_queries, len(recommendation._get_item_list())), replace=False)]
+
+        for based in ['user', 'item']:
+            results['recommend_{}'.format(based)] = _measure(
+                setup, lambda state, user, based=based: state.get_recommendations(
+                    user, based=based, top_n=top_n) is not None, users)
+        results['similar_users'] = _measure(
+            setup, lambda state, user: state._get_similar_objects('user', user, top_n=top_n) is not None, users)
+        results['similar_items'] = _measure(
+            setup, lambda state, item: state._get_similar_objects('item', item, top_n=top_n) is not None, items)
+        pairs = list(zip(users, users[1:] + users[:1]))
+        results['similarity_pair'] = _measure(
+            lambda: recommendation, lambda state, pair: calc_similarity_with_missing_value(
+                state._get_ratings_for_one_user(pair[0]), state._get_ratings_for_one_user(pair[1]),
+                metric, state.missing_value) is not None, pairs)
+        for based in ['user', 'item']:
+            results['batch_{}'.format(based)] = _measure(
+                setup, lambda state, _, based=based: len(state.get_recommendations_batch(
+                    state._get_user_list(), based=based, top_n=top_n)), [None] * repeats)
+    return {
+        'config': dict(dataclasses.asdict(generator), storage=storage, metric=metric,
+                       n_queries=n_queries, top_n=top_n, repeats=repeats),
+        'scenarios': results,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def compare_results(baseline: Dict, current: Dict, key: str = 'p50_ms',
+                    threshold: float = 1.2) -> Dict[str, float]:
+    """2つの計測結果を比較し、threshold倍以上遅くなったシナリオとその比率を返却する
+
+    Args:
+        baseline (Dict): 基準の計測結果
+        current (Dict): 比較する計測結果
+        key (str, optional): 比較する指標
+        threshold (float, optional): 劣化とみなす比率
+
+    Returns:
+        Dict[str, float]: シナリオと比率
+    """
+    regressions = {}
+    for name, scenario in current['scenarios'].items():
+        if name not in baseline['scenarios']:
+            continue
+        base = baseline['scenarios'][name][key]
+        if base > 0 and scenario[key] / base >= threshold:
+            regressions[name] = scenario[key] / base
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='合成データで推薦処理を計測する')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=0.02)
+    parser.add_argument('--popularity-exponent', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--storage', default='dense')
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None, help='計測結果を書き出すJSONファイル')
+    parser.add_argument('--baseline', default=None, help='比較する過去の計測結果のJSONファイル')
+    args = parser.parse_args()
+    generator = SyntheticRatings(n_users=args.users, n_items=args.items, density=args.density,
+                                 popularity_exponent=args.popularity_exponent, seed=args.seed)
+    results = run_benchmarks(generator, storage=args.storage, metric=args.metric,
+                             n_queries=args.queries, top_n=args.top_n, repeats=args.repeats)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            results['regressions'] = compare_results(json.load(f), results)
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Tuple
+import dataclasses
+import sys
+import threading
+import time
+
+
+def _estimate_size(key: Hashable, value: object) -> int:
+    """エントリのおおよそのメモリ使用量(バイト)。
+    推薦リストの要素の文字列はアイテムのリストと共有しているため、リスト自体とkeyの大きさだけを数える
+
+    Args:
+        key (Hashable): key
+        value (object): 値
+
+    Returns:
+        int: バイト数
+    """
+    return sys.getsizeof(key) + sys.getsizeof(value)
+
+
+@dataclasses.dataclass
+class ResultCache:
+    """スレッドセーフなLRUキャッシュ。
+    エントリ数の上限(max_entries)、有効期限(ttl秒)、メモリ使用量の上限(max_bytes)を指定でき、
+    0の場合はその制限を設けない。ヒット、ミス、追い出し、期限切れ、無効化の回数を数える
+    """
+    max_entries: int = 1024
+    ttl: float = 0.0
+    max_bytes: int = 0
+
+    def __post_init__(self):
+        # keyから(値, 有効期限, バイト数)への辞書。末尾ほど最近使われたエントリ
+        self._entries: 'OrderedDict[Hashable, Tuple[object, float, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._n_bytes = 0
+        # 無効化のたびに増やす世代。計算中に無効化された結果を格納しないために使う
+        self._generation = 0
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0,
+                          'expirations': 0, 'invalidations': 0}
+
+    @property
+    def generation(self) -> int:
+        """現在の世代。putに渡すと、取得してから無効化があった場合に格納しない
+
+        Returns:
+            int: 世代
+        """
+        return self._generation
+
+    def get(self, key: Hashable) -> object:
+        """keyに対応する値を返却する。存在しないか期限切れの場合はNone
+
+        Args:
+            key (Hashable): key
+
+        Returns:
+            object: 値
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+            value, expires, _ = entry
+            if expires and expires <= time.monotonic():
+                self._remove(key)
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return value
+
+    def put(self, key: Hashable, value: object, generation: int = None):
+        """値を格納し、上限を超えた分を古い順に追い出す
+
+        Args:
+            key (Hashable): key
+            value (object): 値
+            generation (int, optional): 値の計算を始めたときの世代。その後に無効化があった場合は格納しない
+        """
+        size = _estimate_size(key, value)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if self.max_bytes and size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._remove(key)
+            expires = time.monotonic() + self.ttl if self.ttl > 0 else 0.0
+            self._entries[key] = (value, expires, size)
+            self._n_bytes += size
+            while self._entries and ((self.max_entries and len(self._entries) > self.max_entries) or
+                                     (self.max_bytes and self._n_bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self._counters['evictions'] += 1
+
+    def invalidate(self, predicate: Callable[[Hashable], bool] = None):
+        """predicateを満たすkeyのエントリを削除する。省略時は全て削除する
+
+        Args:
+            predicate (Callable[[Hashable], bool], optional): 削除するkeyの条件
+        """
+        with self._lock:
+            self._generation += 1
+            keys = [key for key in self._entries if predicate is None or predicate(key)]
+            for key in keys:
+                self._remove(key)
+            self._counters['invalidations'] += len(keys)
+
+    def _remove(self, key: Hashable):
+        """エントリを削除する。ロックを取得した状態で呼ぶ
+
+        Args:
+            key (Hashable): key
+        """
+        _, _, size = self._entries.pop(key)
+        self._n_bytes -= size
+
+    def info(self) -> Dict[str, int]:
+        """カウンタと現在のエントリ数、バイト数を返却する
+
+        Returns:
+            Dict[str, int]: hits, misses, evictions, expirations, invalidations, entries, bytes
+        """
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), bytes=self._n_bytes)
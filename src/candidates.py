@@ -0,0 +1,99 @@
+import numpy as np
+from recommendation import Recommendation, _select_top_n
+from sparse_matrix import expand_ranges
+import dataclasses
+
+
+@dataclasses.dataclass
+class PopularItems:
+    """評価数が上位n件のアイテムを、全ユーザ共通の推薦の候補とする
+    """
+    n: int = 100
+
+    def __call__(self, recommendation: Recommendation, user_idx: np.ndarray) -> np.ndarray:
+        """候補アイテムのマスクを返却する
+
+        Args:
+            recommendation (Recommendation): 推薦器
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+
+        Returns:
+            np.ndarray: 候補アイテムのマスク (len(user_idx), アイテム数)
+        """
+        counts = recommendation._item_rating_count
+        mask = np.zeros(len(counts), dtype=bool)
+        mask[_select_top_n(counts.astype(np.float64), self.n)] = True
+        return np.repeat(mask[np.newaxis, :], len(user_idx), axis=0)
+
+
+def _count_cooccurring_items(recommendation: Recommendation, user_idx: np.ndarray) -> np.ndarray:
+    """対象ユーザと共通のアイテムを評価した他のユーザが評価したアイテムを、共通評価数で重み付けして数える。
+    疎行列では対象ユーザの評価済みアイテムの列(CSC)から他のユーザを、そのユーザの行(CSR)からアイテムをたどるため、
+    計算量はたどった評価数に比例し、カタログ全体との積は計算しない
+
+    Args:
+        recommendation (Recommendation): 推薦器
+        user_idx (np.ndarray): 対象ユーザのindexの配列
+
+    Returns:
+        np.ndarray: 重み付きの共起数 (len(user_idx), アイテム数)
+    """
+    n_users, n_items = len(recommendation._users), len(recommendation._items)
+    if recommendation.storage == 'sparse':
+        m = recommendation.matrix
+        # (対象ユーザの行, 評価済みアイテム)
+        lengths = m.indptr[user_idx + 1] - m.indptr[user_idx]
+        rows = np.repeat(np.arange(len(user_idx)), lengths)
+        items = m.indices[expand_ranges(m.indptr[user_idx], lengths)]
+        # (対象ユーザの行, 同じアイテムを評価した他のユーザ)。同じ組の数が共通評価数となる
+        lengths = m.col_indptr[items + 1] - m.col_indptr[items]
+        others = m.col_indices[expand_ranges(m.col_indptr[items], lengths)].astype(np.int64)
+        keys, overlap = np.unique(np.repeat(rows, lengths) * n_users + others, return_counts=True)
+        rows, others = keys // n_users, keys % n_users
+        not_self = others != user_idx[rows]
+        rows, others, overlap = rows[not_self], others[not_self], overlap[not_self]
+        # (対象ユーザの行, 他のユーザが評価したアイテム)を共通評価数で重み付けして数える
+        lengths = m.indptr[others + 1] - m.indptr[others]
+        items = m.indices[expand_ranges(m.indptr[others], lengths)]
+        counts = np.bincount(np.repeat(rows, lengths) * n_items + items,
+                             weights=np.repeat(overlap, lengths).astype(np.float64),
+                             minlength=len(user_idx) * n_items)
+        return counts.astype(np.float64).reshape(len(user_idx), n_items)
+    m, missing_value = recommendation.matrix, recommendation.missing_value
+    counts = np.zeros((len(user_idx), n_items))
+    for row, idx in enumerate(user_idx):
+        # 評価済みアイテムの列と、共通評価のある他のユーザの行だけを使う
+        items, _ = recommendation._get_observed_ratings_for_one_user(idx)
+        overlap = (m[:, items] != missing_value).sum(axis=1)
+        overlap[idx] = 0
+        others = np.nonzero(overlap)[0]
+        counts[row] = overlap[others].astype(np.float64) @ (m[others] != missing_value)
+    return counts
+
+
+@dataclasses.dataclass
+class CooccurrenceCandidates:
+    """対象ユーザと共通のアイテムを評価した他のユーザが評価したアイテムを、共通評価数で重み付けして数え、
+    上位n件を推薦の候補とする。対象ユーザの評価済みアイテムと、一度も共起しないアイテムは候補としない
+    """
+    n: int = 100
+
+    def __call__(self, recommendation: Recommendation, user_idx: np.ndarray) -> np.ndarray:
+        """候補アイテムのマスクを返却する
+
+        Args:
+            recommendation (Recommendation): 推薦器
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+
+        Returns:
+            np.ndarray: 候補アイテムのマスク (len(user_idx), アイテム数)
+        """
+        user_idx = np.asarray(user_idx, dtype=np.int64)
+        counts = _count_cooccurring_items(recommendation, user_idx)
+        _, rated = recommendation._get_observed_block(user_idx)
+        counts[rated] = 0.0
+        mask = np.zeros(counts.shape, dtype=bool)
+        for row, count in enumerate(counts):
+            top = _select_top_n(count, self.n)
+            mask[row, top[count[top] > 0]] = True
+        return mask
@@ -0,0 +1,128 @@
+import numpy as np
+from typing import Tuple
+from sparse_matrix import SparseRatingMatrix, expand_ranges
+import dataclasses
+
+# 共起回数の正規化の方法
+_NORMALIZATIONS = {'count', 'cosine', 'jaccard', 'lift'}
+
+
+def calc_cooccurrence_counts(interactions: SparseRatingMatrix,
+                             max_pairs: int = 2 ** 24) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ユーザ×アイテムの行列Bから、アイテム同士の共起回数の行列 B^T B を疎な三つ組として計算する。
+    ユーザごとに評価済みアイテムの全ての組を並べて数えるため、計算量はユーザごとの評価数の2乗の和に比例する。
+    一度に並べる組の数がmax_pairsを超えないようにユーザを分けて数え、最後に合算する
+
+    Args:
+        interactions (SparseRatingMatrix): ユーザ×アイテムの行列。格納された要素を1回の共起として数える
+        max_pairs (int, optional): 一度に並べるアイテムの組の数の上限
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: アイテムindex、アイテムindex、共起回数。対角成分(評価数)を含む
+    """
+    n_items = interactions.shape[1]
+    counts = interactions.row_counts().astype(np.int64)
+    pairs = np.cumsum(counts ** 2)
+    keys, values = [], []
+    start = 0
+    while start < len(counts):
+        # 組の数がmax_pairsに収まる範囲のユーザをまとめる。1人で超える場合はそのユーザだけとする
+        end = max(int(np.searchsorted(pairs, pairs[start] - counts[start] ** 2 + max_pairs, side='right')),
+                  start + 1)
+        entries = np.arange(interactions.indptr[start], interactions.indptr[end])
+        rows = np.repeat(np.arange(start, end), counts[start:end])
+        lengths = counts[rows]
+        partners = expand_ranges(interactions.indptr[rows], lengths)
+        chunk_keys = np.repeat(interactions.indices[entries].astype(np.int64), lengths) * n_items + \
+            interactions.indices[partners]
+        chunk_keys, chunk_values = np.unique(chunk_keys, return_counts=True)
+        keys.append(chunk_keys)
+        values.append(chunk_values)
+        start = end
+    if not keys:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    values = np.bincount(inverse, weights=np.concatenate(values))
+    return keys // n_items, keys % n_items, values
+
+
+@dataclasses.dataclass
+class CooccurrenceModel:
+    """暗黙的フィードバック(クリックや購入の有無)のためのアイテム同士の共起による推薦モデル。
+    共起回数 c_ij を正規化したアイテム×アイテムの疎行列Sを持ち、ユーザの評価済みアイテムの集合bに対して
+    スコア b S を評価済みアイテムの行の和として計算する。
+    正規化は count(c_ij)、cosine(c_ij / √(n_i n_j))、jaccard(c_ij / (n_i + n_j - c_ij))、
+    lift(c_ij N / (n_i n_j))。n_iはアイテムiの評価数、Nはユーザ数
+    """
+    normalization: str = 'cosine'
+    max_pairs: int = 2 ** 24
+
+    def fit(self, user_idx: np.ndarray, item_idx: np.ndarray, shape: Tuple[int, int]) -> 'CooccurrenceModel':
+        """(ユーザ, アイテム)の組から共起行列を作成する。同じ組が複数ある場合は1回と数える
+
+        Args:
+            user_idx (np.ndarray): ユーザindex
+            item_idx (np.ndarray): アイテムindex
+            shape (Tuple[int, int]): (ユーザ数, アイテム数)
+
+        Returns:
+            CooccurrenceModel: 自身
+        """
+        if self.normalization not in _NORMALIZATIONS:
+            raise Exception("Unknown normalization: {}".format(self.normalization))
+        n_users, n_items = shape
+        interactions = SparseRatingMatrix.from_triplets(
+            user_idx, item_idx, np.ones(len(user_idx)), shape)
+        row, col, counts = calc_cooccurrence_counts(interactions, self.max_pairs)
+        item_count = interactions.col_counts().astype(np.float64)
+        # 自分自身との共起は推薦に使わない
+        off_diagonal = row != col
+        row, col, counts = row[off_diagonal], col[off_diagonal], counts[off_diagonal]
+        if self.normalization == 'cosine':
+            scores = counts / np.sqrt(item_count[row] * item_count[col])
+        elif self.normalization == 'jaccard':
+            scores = counts / (item_count[row] + item_count[col] - counts)
+        elif self.normalization == 'lift':
+            scores = counts * n_users / (item_count[row] * item_count[col])
+        else:
+            scores = counts
+        self.matrix = SparseRatingMatrix.from_triplets(row, col, scores, (n_items, n_items), np.float32)
+        return self
+
+    def predict(self, rows: np.ndarray, items: np.ndarray, n_rows: int, n_items: int,
+                item_idx: np.ndarray = None) -> np.ndarray:
+        """ユーザ群の評価済みアイテムから、各アイテムのスコアを計算する。
+        計算量は評価済みアイテムの共起行列の行の要素数の和に比例する。学習後に追加されたアイテムのスコアは0とする
+
+        Args:
+            rows (np.ndarray): 評価ごとの、結果の行(ユーザ)
+            items (np.ndarray): 評価ごとのアイテムindex
+            n_rows (int): ユーザ数
+            n_items (int): アイテム数
+            item_idx (np.ndarray, optional): スコアを計算するアイテムのindex。省略時は全アイテム
+
+        Returns:
+            np.ndarray: スコア (n_rows, n_items) または (n_rows, len(item_idx))
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        fitted = items < self.matrix.shape[0]
+        rows, items = rows[fitted], items[fitted]
+        starts = self.matrix.indptr[items]
+        lengths = self.matrix.indptr[items + 1] - starts
+        pos = expand_ranges(starts, lengths)
+        targets = self.matrix.indices[pos].astype(np.int64)
+        weights = self.matrix.data[pos].astype(np.float64)
+        target_rows = np.repeat(rows, lengths)
+        n_columns = n_items
+        if item_idx is not None:
+            # 候補のアイテムの列だけを残す
+            columns = np.full(max(n_items, self.matrix.shape[1]), -1, dtype=np.int64)
+            columns[item_idx] = np.arange(len(item_idx))
+            targets = columns[targets]
+            keep = targets >= 0
+            targets, weights, target_rows = targets[keep], weights[keep], target_rows[keep]
+            n_columns = len(item_idx)
+        # 要素がない場合もbincountがfloatを返すように型を指定する
+        scores = np.bincount(target_rows * n_columns + targets, weights=weights, minlength=n_rows * n_columns)
+        return scores.astype(np.float64).reshape(n_rows, n_columns)
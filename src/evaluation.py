@@ -0,0 +1,336 @@
+import numpy as np
+from typing import Dict, List
+from recommendation import Recommendation
+from loader import load_triplets_with_timestamps
+from parallel import _prepare_models
+import argparse
+import csv
+import dataclasses
+import itertools
+import json
+import os
+import tempfile
+import time
+
+
+@dataclasses.dataclass
+class RatingLog:
+    """オフライン評価に使う評価ログ。ユーザとアイテムはそれぞれのリストでのindexで保持する
+    """
+    user_list: List[str]
+    item_list: List[str]
+    user_idx: np.ndarray
+    item_idx: np.ndarray
+    ratings: np.ndarray
+    # 評価ごとのタイムスタンプ。ない評価はnan
+    timestamps: np.ndarray = None
+
+    @classmethod
+    def load(cls, file_name: str, file_format: str = 'csv', chunk_size: int = 100000) -> 'RatingLog':
+        """CSVまたはJSON Linesの評価ログを読み込む
+
+        Args:
+            file_name (str): ファイル名
+            file_format (str, optional): 'csv' or 'jsonl'
+            chunk_size (int, optional): 一度に変換する行数
+
+        Returns:
+            RatingLog: 評価ログ
+        """
+        return cls(*load_triplets_with_timestamps(file_name, file_format, chunk_size))
+
+    def has_timestamps(self) -> bool:
+        """全ての評価にタイムスタンプがあるか
+
+        Returns:
+            bool: タイムスタンプがある場合はTrue
+        """
+        return self.timestamps is not None and not np.any(np.isnan(self.timestamps))
+
+    def write(self, file_name: str, mask: np.ndarray = None):
+        """評価ログの一部をuser,item,ratingのCSVとして書き出す
+
+        Args:
+            file_name (str): ファイル名
+            mask (np.ndarray, optional): 書き出す評価。省略時は全て
+        """
+        user_idx, item_idx, ratings = self.user_idx, self.item_idx, self.ratings
+        if mask is not None:
+            user_idx, item_idx, ratings = user_idx[mask], item_idx[mask], ratings[mask]
+        user_names = np.array(self.user_list, dtype=object)
+        item_names = np.array(self.item_list, dtype=object)
+        with open(file_name, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['user', 'item', 'rating'])
+            writer.writerows(zip(user_names[user_idx], item_names[item_idx], ratings.tolist()))
+
+
+def random_split(n_ratings: int, test_ratio: float = 0.2, seed: int = 0) -> np.ndarray:
+    """評価をランダムに学習用とテスト用に分ける
+
+    Args:
+        n_ratings (int): 評価数
+        test_ratio (float, optional): テスト用の評価の割合
+        seed (int, optional): 乱数のシード
+
+    Returns:
+        np.ndarray: テスト用の評価を表すbool配列
+    """
+    test = np.zeros(n_ratings, dtype=bool)
+    test[np.random.default_rng(seed).permutation(n_ratings)[:int(round(test_ratio * n_ratings))]] = True
+    return test
+
+
+def leave_k_out_split(user_idx: np.ndarray, k: int = 1, timestamps: np.ndarray = None,
+                      seed: int = 0) -> np.ndarray:
+    """ユーザごとにk件の評価をテスト用とする。timestampsを指定した場合は最新のk件、省略時はランダムなk件とする。
+    評価がk件以下のユーザの評価は全て学習用とする
+
+    Args:
+        user_idx (np.ndarray): 評価ごとのユーザのindex
+        k (int, optional): ユーザごとのテスト用の評価数
+        timestamps (np.ndarray, optional): 評価ごとのタイムスタンプ
+        seed (int, optional): 乱数のシード
+
+    Returns:
+        np.ndarray: テスト用の評価を表すbool配列
+    """
+    n_ratings = len(user_idx)
+    keys = timestamps if timestamps is not None else np.random.default_rng(seed).random(n_ratings)
+    # ユーザ順、ユーザ内ではkeyの昇順に並べ、各ユーザの末尾からの順位を求める
+    order = np.lexsort((keys, user_idx))
+    counts = np.bincount(user_idx)
+    sorted_users = user_idx[order]
+    rank_from_end = np.cumsum(counts)[sorted_users] - np.arange(n_ratings) - 1
+    test = np.zeros(n_ratings, dtype=bool)
+    test[order] = (rank_from_end < k) & (counts[sorted_users] > k)
+    return test
+
+
+def temporal_split(timestamps: np.ndarray, test_ratio: float = 0.2) -> np.ndarray:
+    """タイムスタンプの新しい方からtest_ratioの割合の評価をテスト用とする
+
+    Args:
+        timestamps (np.ndarray): 評価ごとのタイムスタンプ
+        test_ratio (float, optional): テスト用の評価の割合
+
+    Returns:
+        np.ndarray: テスト用の評価を表すbool配列
+    """
+    if timestamps is None or np.any(np.isnan(timestamps)):
+        raise Exception("A temporal split requires a timestamp for every rating.")
+    n_ratings = len(timestamps)
+    n_test = int(round(test_ratio * n_ratings))
+    test = np.zeros(n_ratings, dtype=bool)
+    test[np.argsort(timestamps, kind='stable')[n_ratings - n_test:]] = True
+    return test
+
+
+def split_log(log: RatingLog, method: str = 'random', test_ratio: float = 0.2, k: int = 1,
+              seed: int = 0) -> np.ndarray:
+    """評価ログを学習用とテスト用に分ける
+
+    Args:
+        log (RatingLog): 評価ログ
+        method (str, optional): 'random', 'leave_k_out' or 'temporal'。
+            'leave_k_out'はタイムスタンプがある場合は各ユーザの最新のk件をテスト用とする
+        test_ratio (float, optional): 'random'と'temporal'でのテスト用の評価の割合
+        k (int, optional): 'leave_k_out'でのユーザごとのテスト用の評価数
+        seed (int, optional): 乱数のシード
+
+    Returns:
+        np.ndarray: テスト用の評価を表すbool配列
+    """
+    if method == 'random':
+        return random_split(len(log.ratings), test_ratio, seed)
+    elif method == 'leave_k_out':
+        return leave_k_out_split(log.user_idx, k, log.timestamps if log.has_timestamps() else None, seed)
+    elif method == 'temporal':
+        return temporal_split(log.timestamps, test_ratio)
+    raise Exception("Unknown split method: {}".format(method))
+
+
+def rating_errors(predictions: np.ndarray, actual: np.ndarray) -> Dict[str, float]:
+    """予測評価値の誤差を計算する。予測できなかった(nanの)評価は除く
+
+    Args:
+        predictions (np.ndarray): 予測評価値
+        actual (np.ndarray): 実際の評価値
+
+    Returns:
+        Dict[str, float]: rmse, mae, n(誤差を計算した評価数)
+    """
+    errors = predictions - actual
+    errors = errors[~np.isnan(errors)]
+    if len(errors) == 0:
+        return {'rmse': float('nan'), 'mae': float('nan'), 'n': 0}
+    return {'rmse': float(np.sqrt(np.mean(errors ** 2))), 'mae': float(np.mean(np.abs(errors))),
+            'n': len(errors)}
+
+
+def ranking_metrics(recommended: np.ndarray, relevant_rows: np.ndarray, relevant_items: np.ndarray,
+                    n_items: int) -> Dict[str, float]:
+    """推薦リストの上位k件の精度を計算する。適合アイテムのあるユーザの平均とする
+
+    Args:
+        recommended (np.ndarray): ユーザごとの推薦リスト (ユーザ数, k)。k件に満たない部分は-1
+        relevant_rows (np.ndarray): 適合アイテムごとの、recommendedでのユーザの行
+        relevant_items (np.ndarray): 適合アイテムのindex
+        n_items (int): アイテム数
+
+    Returns:
+        Dict[str, float]: precision, recall, ndcg, coverage(推薦されたアイテムの割合), n_users
+    """
+    n_users, k = recommended.shape
+    # (行, アイテム)の組を1つの整数にして、推薦されたアイテムが適合するかをまとめて判定する
+    relevant_keys = np.unique(relevant_rows.astype(np.int64) * n_items + relevant_items)
+    keys = np.arange(n_users, dtype=np.int64)[:, np.newaxis] * n_items + recommended
+    hits = np.isin(keys, relevant_keys) & (recommended >= 0)
+    n_relevant = np.bincount(relevant_keys // n_items, minlength=n_users)
+    evaluated = n_relevant > 0
+    hits, n_relevant = hits[evaluated], n_relevant[evaluated]
+    discounts = 1.0 / np.log2(np.arange(k) + 2.0)
+    ideal = np.cumsum(discounts)[np.minimum(n_relevant, k) - 1] if k > 0 else np.zeros(len(n_relevant))
+    recommended_items = np.unique(recommended[recommended >= 0])
+    if len(n_relevant) == 0 or k == 0:
+        precision = recall = ndcg = float('nan')
+    else:
+        n_hits = hits.sum(axis=1)
+        precision = float(np.mean(n_hits / k))
+        recall = float(np.mean(n_hits / n_relevant))
+        ndcg = float(np.mean(hits @ discounts / ideal))
+    return {'precision': precision, 'recall': recall, 'ndcg': ndcg,
+            'coverage': len(recommended_items) / n_items if n_items > 0 else 0.0,
+            'n_users': len(n_relevant)}
+
+
+def evaluate(log: RatingLog, test: np.ndarray, based: str = 'user', k: int = 10,
+             debiasing: bool = True, relevance_threshold: float = None, block_size: int = 256,
+             **settings) -> Dict:
+    """学習用の評価で推薦器を作成し、テスト用の評価に対する予測誤差と推薦リストの精度を、それぞれの所要時間とともに計算する。
+    学習用の評価にないユーザとアイテムのテスト用の評価は除く
+
+    Args:
+        log (RatingLog): 評価ログ
+        test (np.ndarray): テスト用の評価を表すbool配列
+        based (str, optional): user, item, mf, baseline or cooccurrence
+        k (int, optional): 推薦リストの件数
+        debiasing (bool, optional): バイアス除去フラグ
+        relevance_threshold (float, optional): 適合とみなす評価値の下限。省略時はテスト用の評価を全て適合とする
+        block_size (int, optional): 一度に予測するユーザ数
+        **settings: Recommendationに渡す設定
+
+    Returns:
+        Dict: 条件(based, k, debiasing, settings)、評価数、rating(rmse, mae)、ranking(precision, recall, ndcg, coverage)、
+            seconds(fit: 読み込みと類似度行列・モデルの計算、rating: 予測誤差、ranking: 推薦リスト)
+    """
+    seconds = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'train.csv')
+        log.write(file_name, ~test)
+        start = time.perf_counter()
+        recommendation = Recommendation(file_name=file_name, file_format='csv', **settings)
+        _prepare_models(recommendation, based, debiasing)
+        seconds['fit'] = time.perf_counter() - start
+    # 評価ログのindexを推薦器のindexに変換する。学習用の評価にない場合は-1
+    user_codes = np.array([recommendation._users.get(name, -1) for name in log.user_list], dtype=np.int64)
+    item_codes = np.array([recommendation._items.get(name, -1) for name in log.item_list], dtype=np.int64)
+    user_idx = user_codes[log.user_idx[test]]
+    item_idx = item_codes[log.item_idx[test]]
+    actual = log.ratings[test]
+    known = (user_idx >= 0) & (item_idx >= 0)
+    user_idx, item_idx, actual = user_idx[known], item_idx[known], actual[known]
+
+    start = time.perf_counter()
+    users, rows = np.unique(user_idx, return_inverse=True)
+    predictions = np.full(len(actual), np.nan)
+    for block_start in range(0, len(users), block_size):
+        block = recommendation._predict_ratings_matrix(
+            users[block_start:block_start + block_size], based, debiasing)
+        selected = (rows >= block_start) & (rows < block_start + block_size)
+        predictions[selected] = block[rows[selected] - block_start, item_idx[selected]]
+    errors = rating_errors(predictions, actual)
+    seconds['rating'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    relevant = actual >= relevance_threshold if relevance_threshold is not None else np.ones(len(actual), dtype=bool)
+    users = np.unique(user_idx[relevant])
+    user_names = recommendation._users.decode(users)
+    recommendations = recommendation.get_recommendations_batch(
+        user_names, based=based, top_n=k, debiasing=debiasing, block_size=block_size)
+    recommended = np.full((len(users), k), -1, dtype=np.int64)
+    for row, user_name in enumerate(user_names):
+        items = recommendation._items.encode(recommendations[user_name])
+        recommended[row, :len(items)] = items
+    ranking = ranking_metrics(recommended, np.searchsorted(users, user_idx[relevant]),
+                              item_idx[relevant], len(recommendation._items))
+    seconds['ranking'] = time.perf_counter() - start
+    seconds['total'] = seconds['fit'] + seconds['rating'] + seconds['ranking']
+    return {
+        'based': based,
+        'k': k,
+        'debiasing': debiasing,
+        'settings': settings,
+        'n_train': int(np.sum(~test)),
+        'n_test': int(np.sum(test)),
+        'n_evaluated': int(np.sum(known)),
+        'rating': {'rmse': errors['rmse'], 'mae': errors['mae'], 'n': errors['n']},
+        'ranking': ranking,
+        'seconds': seconds,
+    }
+
+
+def select_cheapest(results: List[Dict], metric: str = 'ndcg', minimum: float = 0.0) -> Dict:
+    """推薦リストの精度がminimum以上の評価結果のうち、所要時間が最も短いものを返却する。
+    rmse、maeを指定した場合はminimum以下のものから選ぶ
+
+    Args:
+        results (List[Dict]): evaluateの結果のリスト
+        metric (str, optional): precision, recall, ndcg, coverage, rmse or mae
+        minimum (float, optional): 満たすべき値
+
+    Returns:
+        Dict: 評価結果。条件を満たすものがない場合はNone
+    """
+    if metric in ('rmse', 'mae'):
+        candidates = [r for r in results if r['rating'][metric] <= minimum]
+    else:
+        candidates = [r for r in results if r['ranking'][metric] >= minimum]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda r: r['seconds']['total'])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='評価ログを分割して推薦の精度と所要時間を計測する')
+    parser.add_argument('--file-name', default='ratings.csv')
+    parser.add_argument('--file-format', default='csv')
+    parser.add_argument('--split', default='random', help='random, leave_k_out or temporal')
+    parser.add_argument('--test-ratio', type=float, default=0.2)
+    parser.add_argument('--leave-k', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--relevance-threshold', type=float, default=None)
+    parser.add_argument('--based', default='user,item', help='カンマ区切りで複数指定する')
+    parser.add_argument('--metric', default='euclidean', help='カンマ区切りで複数指定する')
+    parser.add_argument('--storage', default='dense')
+    parser.add_argument('--output', default=None, help='評価結果を書き出すJSONファイル')
+    args = parser.parse_args()
+    log = RatingLog.load(args.file_name, args.file_format)
+    test = split_log(log, args.split, args.test_ratio, args.leave_k, args.seed)
+    results = []
+    for based, metric in itertools.product(args.based.split(','), args.metric.split(',')):
+        # 行列分解、ベースライン推定、共起は類似度を使わないため、最初の類似度でだけ評価する
+        if based in ('mf', 'baseline', 'cooccurrence') and metric != args.metric.split(',')[0]:
+            continue
+        results.append(evaluate(log, test, based=based, k=args.k, relevance_threshold=args.relevance_threshold,
+                                storage=args.storage, metric=metric))
+    output = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import numpy as np
+from typing import Tuple
+import dataclasses
+
+
+# 正規方程式の係数行列を作るときに、要素ごとの外積 (要素数, d, d) と行ごとの係数行列に使う作業領域のバイト数
+_GRAM_BUDGET = 2 ** 26
+
+
+def _solve_regularized_least_squares(indptr: np.ndarray, indices: np.ndarray, targets: np.ndarray,
+                                     features: np.ndarray, regularization: float,
+                                     block_size: int = None) -> np.ndarray:
+    """圧縮形式で与えた行ごとに、min Σ(target - feature・w)^2 + regularization * |w|^2 をまとめて解く。
+    正規方程式の係数行列は、要素ごとの外積を要素のblock_size件ずつ作って行ごとに足し込んで作り、
+    np.linalg.solveで一括して解く。行は要素数の合計と行数がblock_size以下になるようにまとめ、
+    要素がblock_sizeを超える行は1行ずつ、要素をblock_size件ずつに分けて足し込む
+
+    Args:
+        indptr (np.ndarray): 行rの要素は indptr[r]:indptr[r+1]
+        indices (np.ndarray): 各要素に対応するfeaturesの行
+        targets (np.ndarray): 各要素の目的変数
+        features (np.ndarray): 説明変数 (n, d)
+        regularization (float): 正則化の強さ
+        block_size (int, optional): 一度に処理する要素数。省略時は作業領域が_GRAM_BUDGETバイトに収まる件数
+
+    Returns:
+        np.ndarray: 行ごとの解 (len(indptr) - 1, d)
+    """
+    n_rows = len(indptr) - 1
+    n_dims = features.shape[1]
+    if block_size is None:
+        block_size = max(1, _GRAM_BUDGET // (8 * n_dims * n_dims))
+    solutions = np.zeros((n_rows, n_dims))
+    identity = regularization * np.eye(n_dims)
+    start = 0
+    while start < n_rows:
+        # 要素数の合計と行数がblock_size以下になる範囲。少なくとも1行は含める
+        end = np.searchsorted(indptr, indptr[start] + block_size, side='right') - 1
+        end = int(min(max(end, start + 1), start + block_size, n_rows))
+        gram = np.zeros((end - start, n_dims, n_dims))
+        rhs = np.zeros((end - start, n_dims))
+        for chunk_start in range(indptr[start], indptr[end], block_size):
+            chunk_end = min(chunk_start + block_size, indptr[end])
+            x = features[indices[chunk_start:chunk_end]]
+            t = targets[chunk_start:chunk_end]
+            # 各行の要素のうち、この区間に含まれる部分の和を取る
+            bounds = np.clip(indptr[start:end + 1], chunk_start, chunk_end) - chunk_start
+            nonempty = np.diff(bounds) > 0
+            gram[nonempty] += np.add.reduceat(
+                np.einsum('ni,nj->nij', x, x), bounds[:-1][nonempty], axis=0)
+            rhs[nonempty] += np.add.reduceat(
+                x * t[:, np.newaxis], bounds[:-1][nonempty], axis=0)
+        solutions[start:end] = np.linalg.solve(
+            gram + identity, rhs[:, :, np.newaxis])[:, :, 0]
+        start = end
+    return solutions
+
+
+@dataclasses.dataclass
+class MatrixFactorization:
+    """バイアス付きの行列分解。r_ui ≈ μ + b_u + b_i + p_u・q_i をALS(交互最小二乗法)で学習する。
+    学習後の因子とバイアスはfloat32で保持し、1ユーザの予測はアイテム数×因子数の積で計算する
+    """
+    n_factors: int = 20
+    n_epochs: int = 15
+    regularization: float = 0.1
+    seed: int = 0
+
+    def fit(self, user_idx: np.ndarray, item_idx: np.ndarray, ratings: np.ndarray,
+            shape: Tuple[int, int]) -> 'MatrixFactorization':
+        """(ユーザ, アイテム, 評価値)の三つ組から因子とバイアスを学習する
+
+        Args:
+            user_idx (np.ndarray): ユーザindex
+            item_idx (np.ndarray): アイテムindex
+            ratings (np.ndarray): 評価値
+            shape (Tuple[int, int]): (ユーザ数, アイテム数)
+
+        Returns:
+            MatrixFactorization: 自身
+        """
+        n_users, n_items = shape
+        user_idx = np.asarray(user_idx, dtype=np.int64)
+        item_idx = np.asarray(item_idx, dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        self.global_mean = float(ratings.mean()) if len(ratings) > 0 else 0.0
+        # ユーザ順、アイテム順に並べた2通りの圧縮形式を作っておく
+        by_user = np.lexsort((item_idx, user_idx))
+        by_item = np.lexsort((user_idx, item_idx))
+        user_indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(user_idx, minlength=n_users))])
+        item_indptr = np.concatenate(
+            [[0], np.cumsum(np.bincount(item_idx, minlength=n_items))])
+        rng = np.random.default_rng(self.seed)
+        user_factors = rng.normal(0, 0.1, (n_users, self.n_factors))
+        item_factors = rng.normal(0, 0.1, (n_items, self.n_factors))
+        user_bias = np.zeros(n_users)
+        item_bias = np.zeros(n_items)
+        residuals = ratings - self.global_mean
+        for _ in range(self.n_epochs):
+            # アイテム側を固定し、ユーザごとに[p_u, b_u]を解く
+            features = np.hstack([item_factors, np.ones((n_items, 1))])
+            solutions = _solve_regularized_least_squares(
+                user_indptr, item_idx[by_user], (residuals - item_bias[item_idx])[by_user],
+                features, self.regularization)
+            user_factors, user_bias = solutions[:, :-1], solutions[:, -1]
+            # ユーザ側を固定し、アイテムごとに[q_i, b_i]を解く
+            features = np.hstack([user_factors, np.ones((n_users, 1))])
+            solutions = _solve_regularized_least_squares(
+                item_indptr, user_idx[by_item], (residuals - user_bias[user_idx])[by_item],
+                features, self.regularization)
+            item_factors, item_bias = solutions[:, :-1], solutions[:, -1]
+        self.user_factors = user_factors.astype(np.float32)
+        self.item_factors = item_factors.astype(np.float32)
+        self.user_bias = user_bias.astype(np.float32)
+        self.item_bias = item_bias.astype(np.float32)
+        return self
+
+    def predict(self, user_idx: np.ndarray, n_items: int = None, item_idx: np.ndarray = None) -> np.ndarray:
+        """ユーザ群の全アイテムの評価値を予測する。学習後に追加されたユーザ・アイテムは因子とバイアスを0とみなす
+
+        Args:
+            user_idx (np.ndarray): ユーザindexの配列
+            n_items (int, optional): アイテム数。省略時は学習時のアイテム数
+            item_idx (np.ndarray, optional): 予測するアイテムのindex。指定した場合はn_itemsより優先する
+
+        Returns:
+            np.ndarray: 予測評価値 (len(user_idx), n_items) または (len(user_idx), len(item_idx))
+        """
+        n_fitted = len(self.item_factors)
+        if item_idx is None:
+            item_idx = np.arange(n_fitted if n_items is None else n_items)
+        item_idx = np.asarray(item_idx, dtype=np.int64)
+        user_idx = np.asarray(user_idx, dtype=np.int64)
+        known = user_idx < len(self.user_factors)
+        factors = np.zeros((len(user_idx), self.n_factors), dtype=np.float32)
+        factors[known] = self.user_factors[user_idx[known]]
+        bias = np.zeros(len(user_idx), dtype=np.float32)
+        bias[known] = self.user_bias[user_idx[known]]
+        predictions = np.full((len(user_idx), len(item_idx)), self.global_mean)
+        predictions += bias[:, np.newaxis]
+        fitted = item_idx < n_fitted
+        predictions[:, fitted] += self.item_bias[item_idx[fitted]] + \
+            factors @ self.item_factors[item_idx[fitted]].T
+        return predictions
+
+    def rmse(self, user_idx: np.ndarray, item_idx: np.ndarray, ratings: np.ndarray) -> float:
+        """(ユーザ, アイテム, 評価値)の三つ組に対する予測の二乗平均平方根誤差
+
+        Args:
+            user_idx (np.ndarray): ユーザindex
+            item_idx (np.ndarray): アイテムindex
+            ratings (np.ndarray): 評価値
+
+        Returns:
+            float: RMSE
+        """
+        predictions = self.global_mean + self.user_bias[user_idx] + self.item_bias[item_idx] + \
+            np.einsum('ij,ij->i', self.user_factors[user_idx], self.item_factors[item_idx])
+        return float(np.sqrt(np.mean(np.square(predictions - ratings))))
+
+
+@dataclasses.dataclass
+class BaselineEstimator:
+    """ベースライン推定 b_ui = μ + b_u + b_i。正則化したユーザ・アイテムのバイアスを、
+    一方を固定して他方を閉じた式で求める交互の更新をn_epochs回行って学習する
+    """
+    n_epochs: int = 3
+    user_regularization: float = 10.0
+    item_regularization: float = 25.0
+
+    def fit(self, user_idx: np.ndarray, item_idx: np.ndarray, ratings: np.ndarray,
+            shape: Tuple[int, int]) -> 'BaselineEstimator':
+        """(ユーザ, アイテム, 評価値)の三つ組からバイアスを学習する
+
+        Args:
+            user_idx (np.ndarray): ユーザindex
+            item_idx (np.ndarray): アイテムindex
+            ratings (np.ndarray): 評価値
+            shape (Tuple[int, int]): (ユーザ数, アイテム数)
+
+        Returns:
+            BaselineEstimator: 自身
+        """
+        n_users, n_items = shape
+        user_idx = np.asarray(user_idx, dtype=np.int64)
+        item_idx = np.asarray(item_idx, dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        self.global_mean = float(ratings.mean()) if len(ratings) > 0 else 0.0
+        user_count = np.bincount(user_idx, minlength=n_users)
+        item_count = np.bincount(item_idx, minlength=n_items)
+        self.user_bias = np.zeros(n_users)
+        self.item_bias = np.zeros(n_items)
+        residuals = ratings - self.global_mean
+        for _ in range(self.n_epochs):
+            self.item_bias = np.bincount(item_idx, weights=residuals - self.user_bias[user_idx],
+                                         minlength=n_items) / (self.item_regularization + item_count)
+            self.user_bias = np.bincount(user_idx, weights=residuals - self.item_bias[item_idx],
+                                         minlength=n_users) / (self.user_regularization + user_count)
+        return self
+
+    def predict(self, user_idx: np.ndarray, n_items: int = None, item_idx: np.ndarray = None) -> np.ndarray:
+        """ユーザ群の全アイテムのベースライン推定値を計算する。学習後に追加されたユーザ・アイテムはバイアスを0とみなす
+
+        Args:
+            user_idx (np.ndarray): ユーザindexの配列
+            n_items (int, optional): アイテム数。省略時は学習時のアイテム数
+            item_idx (np.ndarray, optional): 計算するアイテムのindex。指定した場合はn_itemsより優先する
+
+        Returns:
+            np.ndarray: ベースライン推定値 (len(user_idx), n_items) または (len(user_idx), len(item_idx))
+        """
+        user_bias, item_bias = self.get_biases(len(self.user_bias), n_items)
+        if item_idx is not None:
+            item_idx = np.asarray(item_idx, dtype=np.int64)
+            fitted = item_idx < len(self.item_bias)
+            item_bias = np.zeros(len(item_idx))
+            item_bias[fitted] = self.item_bias[item_idx[fitted]]
+        user_idx = np.asarray(user_idx, dtype=np.int64)
+        known = user_idx < len(self.user_bias)
+        bias = np.zeros(len(user_idx))
+        bias[known] = user_bias[user_idx[known]]
+        return self.global_mean + bias[:, np.newaxis] + item_bias[np.newaxis, :]
+
+    def get_biases(self, n_users: int = None, n_items: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """ユーザとアイテムのバイアスを、学習後に追加された分を0で埋めて返却する
+
+        Args:
+            n_users (int, optional): ユーザ数。省略時は学習時のユーザ数
+            n_items (int, optional): アイテム数。省略時は学習時のアイテム数
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: ユーザのバイアスとアイテムのバイアス
+        """
+        if n_users is None:
+            n_users = len(self.user_bias)
+        if n_items is None:
+            n_items = len(self.item_bias)
+        user_bias = np.zeros(n_users)
+        user_bias[:min(n_users, len(self.user_bias))] = self.user_bias[:n_users]
+        item_bias = np.zeros(n_items)
+        item_bias[:min(n_items, len(self.item_bias))] = self.item_bias[:n_items]
+        return user_bias, item_bias
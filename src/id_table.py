@@ -0,0 +1,86 @@
+import numpy as np
+from typing import Dict, Iterable, List, Sequence
+
+
+class IdTable:
+    """名前を一度だけ登録し、登録順に0から始まるint32のコードを割り当てる表。
+    名前はコード順にNumPyのobject配列で保持するため、コードの配列から名前への変換は配列の参照だけで済む。
+    追加に備えて配列の容量は倍々に確保する
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        names = list(names)
+        self._names = np.empty(len(names), dtype=object)
+        self._names[:] = names
+        self._size = len(names)
+        self._codes: Dict[str, int] = dict(zip(names, range(self._size)))
+        if len(self._codes) != self._size:
+            raise Exception("Names in an IdTable must be unique.")
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._codes
+
+    def __getitem__(self, name: str) -> int:
+        return self._codes[name]
+
+    def __iter__(self):
+        return iter(self._codes)
+
+    def get(self, name: str, default: int = None) -> int:
+        return self._codes.get(name, default)
+
+    @property
+    def names(self) -> np.ndarray:
+        """コード順の名前の配列(object型)。追加すると別の配列になるため、保持せずに都度参照する
+
+        Returns:
+            np.ndarray: 名前の配列
+        """
+        return self._names[:self._size]
+
+    def add(self, name: str) -> int:
+        """名前を登録してコードを返却する。登録済みの場合は既存のコードを返す
+
+        Args:
+            name (str): 名前
+
+        Returns:
+            int: コード
+        """
+        code = self._codes.get(name)
+        if code is not None:
+            return code
+        if self._size == len(self._names):
+            names = np.empty(max(2 * self._size, 16), dtype=object)
+            names[:self._size] = self._names[:self._size]
+            self._names = names
+        code = self._size
+        self._names[code] = name
+        self._codes[name] = code
+        self._size += 1
+        return code
+
+    def encode(self, names: Sequence[str]) -> np.ndarray:
+        """名前のリストをコードの配列に変換する。未登録の名前はKeyError
+
+        Args:
+            names (Sequence[str]): 名前のリスト
+
+        Returns:
+            np.ndarray: コード(int32)
+        """
+        return np.fromiter((self._codes[name] for name in names), dtype=np.int32, count=len(names))
+
+    def decode(self, codes: np.ndarray) -> List[str]:
+        """コードの配列を名前のリストに変換する
+
+        Args:
+            codes (np.ndarray): コード
+
+        Returns:
+            List[str]: 名前のリスト
+        """
+        return self.names[codes].tolist()
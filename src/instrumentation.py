@@ -0,0 +1,203 @@
+from typing import Callable, Dict, Iterator
+import contextlib
+import cProfile
+import functools
+import io
+import json
+import pstats
+import threading
+import time
+
+
+class _Timer:
+    """計測区間の所要時間を記録するコンテキストマネージャ
+    """
+    __slots__ = ('_registry', '_stage', '_start')
+
+    def __init__(self, registry: 'Registry', stage: str):
+        self._registry = registry
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._registry.record(self._stage, time.perf_counter() - self._start)
+
+
+class _NullTimer:
+    """計測が無効な場合に使う、何もしないコンテキストマネージャ
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Registry:
+    """処理の区間ごとの所要時間とカウンタを集計するレジストリ。
+    既定では無効で、無効な間はtimerが共有の何もしないコンテキストマネージャを返し、
+    timedで修飾した関数は有効かどうかの判定だけを行い、incrementは何もしない
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """集計した値を消去する
+        """
+        with self._lock:
+            # keyは区間名、valueは[回数, 合計秒数, 最大秒数]
+            self._stages: Dict[str, list] = {}
+            self._counters: Dict[str, int] = {}
+
+    def timer(self, stage: str):
+        """with文で囲んだ区間の所要時間を記録する
+
+        Args:
+            stage (str): 区間名
+
+        Returns:
+            コンテキストマネージャ
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, stage)
+
+    def timed(self, stage: str) -> Callable:
+        """関数の呼び出しごとの所要時間を記録するデコレータ。無効な間は有効かどうかの判定だけを行う
+
+        Args:
+            stage (str): 区間名
+
+        Returns:
+            Callable: デコレータ
+        """
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def record(self, stage: str, seconds: float):
+        """区間の所要時間を1回分記録する
+
+        Args:
+            stage (str): 区間名
+            seconds (float): 所要時間(秒)
+        """
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                self._stages[stage] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def increment(self, name: str, value: int = 1):
+        """カウンタを増やす
+
+        Args:
+            name (str): カウンタ名
+            value (int, optional): 増分
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def snapshot(self) -> Dict:
+        """集計した値を返却する
+
+        Returns:
+            Dict: stages(区間ごとのcount, total_seconds, max_seconds)とcounters
+        """
+        with self._lock:
+            return {
+                'stages': {stage: {'count': count, 'total_seconds': total, 'max_seconds': maximum}
+                           for stage, (count, total, maximum) in self._stages.items()},
+                'counters': dict(self._counters),
+            }
+
+    def to_json(self) -> str:
+        """集計した値をJSONで出力する
+
+        Returns:
+            str: JSON
+        """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'recommendation') -> str:
+        """集計した値をPrometheusのテキスト形式で出力する
+
+        Args:
+            prefix (str, optional): メトリクス名の接頭辞
+
+        Returns:
+            str: テキスト
+        """
+        values = self.snapshot()
+        lines = []
+        for name, kind, field in [('stage_calls_total', 'counter', 'count'),
+                                  ('stage_seconds_total', 'counter', 'total_seconds'),
+                                  ('stage_seconds_max', 'gauge', 'max_seconds')]:
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for stage, stage_values in sorted(values['stages'].items()):
+                lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, name, stage, stage_values[field]))
+        for name, value in sorted(values['counters'].items()):
+            lines.append('# TYPE {}_{}_total counter'.format(prefix, name))
+            lines.append('{}_{}_total {}'.format(prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+
+# 推薦器と類似度の計算が共有するレジストリ
+registry = Registry()
+
+
+@contextlib.contextmanager
+def profile(sort: str = 'cumulative', limit: int = 30) -> Iterator[Dict]:
+    """with文で囲んだ処理をcProfileで計測する。終了後に、返却した辞書のstatsにpstats.Stats、
+    reportに上位limit件の関数の表を格納する
+
+    Args:
+        sort (str, optional): 表の並び順
+        limit (int, optional): 表に出力する関数の数
+
+    Yields:
+        Dict: 計測結果を格納する辞書
+    """
+    result = {}
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield result
+    finally:
+        profiler.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats(sort).print_stats(limit)
+        result['stats'] = stats
+        result['report'] = stream.getvalue()
@@ -0,0 +1,132 @@
+import numpy as np
+from typing import Dict, Iterator, List, Tuple
+import csv
+import itertools
+import json
+
+
+def _parse_timestamp(value, line_number: int) -> float:
+    """タイムスタンプを数値に変換する。省略または空の場合はnanとする
+
+    Args:
+        value: タイムスタンプ
+        line_number (int): エラーメッセージに使う行番号
+
+    Returns:
+        float: タイムスタンプ
+    """
+    if value is None or value == '':
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise Exception("Invalid timestamp at line {}: {!r}".format(line_number, value))
+
+
+def _read_csv_rows(f) -> Iterator[Tuple[str, str, str, float]]:
+    """user,item[,rating[,timestamp]]の形式のCSVを1行ずつ読む。空行を除いた最初の行の評価値が数値でない場合はヘッダとして読み飛ばす。
+    評価値の列がない場合は接触の有無だけを表すログとみなし、評価値を1とする(ヘッダはuser,item。前後の空白と大文字小文字は区別しない)
+
+    Args:
+        f: ファイルオブジェクト
+
+    Yields:
+        Tuple[str, str, str, float]: ユーザ、アイテム、評価値、タイムスタンプ(列がない場合はnan)
+    """
+    reader = csv.reader(f)
+    first = True
+    for row in reader:
+        if len(row) == 0:
+            continue
+        if first:
+            first = False
+            if len(row) < 3:
+                if [column.strip().lower() for column in row] == ['user', 'item']:
+                    continue
+            else:
+                try:
+                    float(row[2])
+                except ValueError:
+                    continue
+        yield row[0], row[1], row[2] if len(row) > 2 else '1', \
+            _parse_timestamp(row[3] if len(row) > 3 else None, reader.line_num)
+
+
+def _read_jsonl_rows(f) -> Iterator[Tuple[str, str, float, float]]:
+    """{"user": ..., "item": ..., "rating": ..., "timestamp": ...}の形式のJSON Linesを1行ずつ読む。
+    ratingを省略した場合は1とし、timestampは省略できる
+
+    Args:
+        f: ファイルオブジェクト
+
+    Yields:
+        Tuple[str, str, float, float]: ユーザ、アイテム、評価値、タイムスタンプ(省略時はnan)
+    """
+    for line_number, line in enumerate(f, 1):
+        if line.strip() == '':
+            continue
+        record = json.loads(line)
+        yield record['user'], record['item'], record.get('rating', 1), \
+            _parse_timestamp(record.get('timestamp'), line_number)
+
+
+def load_triplets(file_name: str, file_format: str = 'csv', chunk_size: int = 100000) \
+        -> Tuple[List[str], List[str], np.ndarray, np.ndarray, np.ndarray]:
+    """評価ログをchunk_size行ずつ読み込み、ユーザ・アイテムのid表と(ユーザ, アイテム, 評価値)の三つ組を作成する。
+    入れ子の辞書は作らず、チャンクごとに配列に変換するため、メモリ使用量は評価数に比例する
+
+    Args:
+        file_name (str): ファイル名
+        file_format (str, optional): 'csv' or 'jsonl'
+        chunk_size (int, optional): 一度に変換する行数
+
+    Returns:
+        Tuple[List[str], List[str], np.ndarray, np.ndarray, np.ndarray]:
+            ユーザのリスト、アイテムのリスト、ユーザindex、アイテムindex、評価値。
+            indexは各リストでの位置で、リストは最初に現れた順とする
+    """
+    return load_triplets_with_timestamps(file_name, file_format, chunk_size)[:5]
+
+
+def load_triplets_with_timestamps(file_name: str, file_format: str = 'csv', chunk_size: int = 100000) \
+        -> Tuple[List[str], List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """load_tripletsに加えて、評価ごとのタイムスタンプ(CSVの4列目、JSON Linesのtimestamp)を読み込む
+
+    Args:
+        file_name (str): ファイル名
+        file_format (str, optional): 'csv' or 'jsonl'
+        chunk_size (int, optional): 一度に変換する行数
+
+    Returns:
+        Tuple[List[str], List[str], np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+            load_triplets の戻り値とタイムスタンプ。タイムスタンプがない評価はnan
+    """
+    user_dic: Dict[str, int] = {}
+    item_dic: Dict[str, int] = {}
+    user_chunks = []
+    item_chunks = []
+    rating_chunks = []
+    timestamp_chunks = []
+    # 先頭にBOMがあるファイルでも、BOMが最初のユーザ名に含まれないようにutf-8-sigで読む
+    with open(file_name, newline='', encoding='utf-8-sig') as f:
+        if file_format == 'csv':
+            rows = _read_csv_rows(f)
+        elif file_format == 'jsonl':
+            rows = _read_jsonl_rows(f)
+        else:
+            raise Exception("Unknown file_format: {}".format(file_format))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if len(chunk) == 0:
+                break
+            users, items, ratings, timestamps = zip(*chunk)
+            user_chunks.append(np.array(
+                [user_dic.setdefault(user, len(user_dic)) for user in users], dtype=np.int64))
+            item_chunks.append(np.array(
+                [item_dic.setdefault(item, len(item_dic)) for item in items], dtype=np.int64))
+            rating_chunks.append(np.array(ratings, dtype=np.float64))
+            timestamp_chunks.append(np.array(timestamps, dtype=np.float64))
+    if len(rating_chunks) == 0:
+        return [], [], np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    return (list(user_dic), list(item_dic), np.concatenate(user_chunks),
+            np.concatenate(item_chunks), np.concatenate(rating_chunks), np.concatenate(timestamp_chunks))
@@ -4,13 +4,16 @@ from recommendation import Recommendation
 def main() -> None:
     recommendation = Recommendation(missing_value=0)
     user_list = recommendation._get_user_list()
+    user_based = recommendation.get_recommendations_batch(
+        user_list, based='user')
+    item_based = recommendation.get_recommendations_batch(
+        user_list, based='item')
+    item_based_top_2 = recommendation.get_recommendations_batch(
+        user_list, based='item', top_n=2)
     for user_name in user_list:
-        print(user_name, recommendation.get_recommendations(
-            user_name, based='user'))
-        print(user_name, recommendation.get_recommendations(
-            user_name, based='item'))
-        print(user_name, recommendation.get_recommendations(
-            user_name, based='item', top_n=2))
+        print(user_name, user_based[user_name])
+        print(user_name, item_based[user_name])
+        print(user_name, item_based_top_2[user_name])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,156 @@
+from recommendation import Recommendation
+from typing import Dict, List, Tuple, Union
+import argparse
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+
+# ワーカープロセスごとに1つだけ保持する推薦器
+_worker_recommendation: Recommendation = None
+
+
+def _init_worker(snapshot_path: str, settings: Dict):
+    """ワーカープロセスの初期化。スナップショットは最初のタスクでメモリマップで読み込み、ページを親プロセスや他のワーカーと共有する
+
+    Args:
+        snapshot_path (str): スナップショットのディレクトリ
+        settings (Dict): Recommendationに渡す設定
+    """
+    global _worker_recommendation
+    _worker_recommendation = Recommendation(
+        file_name=snapshot_path, file_format='snapshot', lazy=True, **settings)
+
+
+def _recommend_chunk(args: Tuple[List[str], str, int, Union[bool, str]]) -> List[Tuple[str, List[str]]]:
+    """ワーカープロセスで、ユーザのチャンクに対する推薦リストを計算する
+
+    Args:
+        args (Tuple[List[str], str, int, bool]): ユーザのリスト、based、top_n、debiasing
+
+    Returns:
+        List[Tuple[str, List[str]]]: ユーザと推薦リストの組
+    """
+    user_names, based, top_n, debiasing = args
+    recommendations = _worker_recommendation.get_recommendations_batch(
+        user_names, based=based, top_n=top_n, debiasing=debiasing, block_size=len(user_names))
+    return list(recommendations.items())
+
+
+def _get_worker_settings(recommendation: Recommendation) -> Dict:
+    """ワーカープロセスでスナップショットを読み込むときに、Recommendationに渡す設定
+
+    Args:
+        recommendation (Recommendation): 推薦器
+
+    Returns:
+        Dict: 設定
+    """
+    return {
+        'missing_value': recommendation.missing_value,
+        'metric': recommendation.metric,
+        'storage': recommendation.storage,
+        'n_neighbors': recommendation.n_neighbors,
+        'shrinkage': recommendation.shrinkage,
+        'min_overlap': recommendation.min_overlap,
+        'cold_start': recommendation.cold_start,
+        'rating_dtype': recommendation.rating_dtype,
+        'implicit': recommendation.implicit,
+        'similarity_dtype': recommendation.similarity_dtype,
+        'memory_budget': recommendation.memory_budget,
+    }
+
+
+def _prepare_models(recommendation: Recommendation, based: str, debiasing: Union[bool, str] = True):
+    """推薦に使う類似度行列とモデルを前もって計算する
+
+    Args:
+        recommendation (Recommendation): 推薦器
+        based (str): user, item, mf, baseline or cooccurrence
+        debiasing (Union[bool, str], optional): バイアス除去フラグ
+    """
+    # fit_neighborsで作成した近傍リストや行列分解のモデルを使う場合は、類似度行列は不要
+    if based in recommendation._neighbors:
+        pass
+    elif based in ('mf', 'baseline', 'cooccurrence'):
+        pass
+    elif based == 'item':
+        recommendation._get_similarity_matrix('item')
+    elif recommendation.storage == 'dense':
+        recommendation._get_similarity_matrix('user')
+    # 行列分解とベースライン推定のモデルは、推薦やバイアス除去、評価のないユーザへのフォールバックで使う場合に学習しておく
+    if 'mf' in (based, recommendation.cold_start):
+        recommendation._get_factor_model()
+    if 'baseline' in (based, recommendation.cold_start, debiasing):
+        recommendation._get_baseline_model()
+    if based == 'cooccurrence':
+        recommendation._get_cooccurrence_model()
+
+
+def precompute_recommendations(recommendation: Recommendation, output_file: str, based: str = 'user',
+                               top_n: int = 10, n_workers: int = None, chunk_size: int = 256,
+                               debiasing: Union[bool, str] = True) -> Dict[str, float]:
+    """全ユーザの推薦リストを複数プロセスで計算し、1行1ユーザのJSON Linesとして書き出す。
+    評価値行列と類似度行列はスナップショットとして一度だけ保存し、各ワーカーはそれをメモリマップで共有する
+
+    Args:
+        recommendation (Recommendation): 推薦器
+        output_file (str): 出力ファイル
+        based (str, optional): ユーザまたはアイテム
+        top_n (int, optional): 上位n件のみを取得
+        n_workers (int, optional): ワーカープロセス数。省略時はCPU数
+        chunk_size (int, optional): 1タスクで計算するユーザ数
+        debiasing (Union[bool, str], optional): バイアス除去フラグ。'baseline'でベースライン推定を使う
+
+    Returns:
+        Dict[str, float]: n_users, seconds, users_per_second
+    """
+    start = time.perf_counter()
+    # 類似度行列やモデルは親プロセスで一度だけ計算し、スナップショットに含める
+    _prepare_models(recommendation, based, debiasing)
+    settings = _get_worker_settings(recommendation)
+    user_list = recommendation._get_user_list()
+    chunks = [(user_list[i:i + chunk_size], based, top_n, debiasing)
+              for i in range(0, len(user_list), chunk_size)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, 'snapshot')
+        recommendation.save_snapshot(snapshot_path, include_similarity=True)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_init_worker,
+                initargs=(snapshot_path, settings)) as executor, \
+                open(output_file, 'w') as f:
+            for results in executor.map(_recommend_chunk, chunks):
+                for user_name, items in results:
+                    f.write(json.dumps(
+                        {'user': user_name, 'items': items}, ensure_ascii=False) + '\n')
+    seconds = time.perf_counter() - start
+    return {
+        'n_users': len(user_list),
+        'seconds': seconds,
+        'users_per_second': len(user_list) / seconds if seconds > 0 else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description='全ユーザの推薦リストを複数プロセスで事前計算する')
+    parser.add_argument('--file-name', default='data/ratings.json')
+    parser.add_argument('--file-format', default='json')
+    parser.add_argument('--storage', default='dense')
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--output', default='recommendations.jsonl')
+    parser.add_argument('--based', default='user')
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    args = parser.parse_args()
+    recommendation = Recommendation(file_name=args.file_name, file_format=args.file_format,
+                                    storage=args.storage, metric=args.metric)
+    report = precompute_recommendations(recommendation, args.output, based=args.based, top_n=args.top_n,
+                                        n_workers=args.workers, chunk_size=args.chunk_size)
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
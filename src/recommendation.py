@@ -1,8 +1,69 @@
 import numpy as np
-from typing import Union, List, Dict
-from similarity import calc_similarity_with_missing_value
+from typing import Callable, Hashable, Iterable, Iterator, Union, List, Dict, Tuple, Set
+from similarity import calc_similarity_with_missing_value, calc_similarity_matrix_with_missing_value, \
+    calc_similarity_vector_with_missing_value, calc_similarity_vector_with_sparse_matrix, \
+    calc_similarity_vector_with_sparse_rows, calc_co_rating_count_matrix, \
+    calc_co_rating_count_vector_with_sparse_matrix, calc_co_rating_count_vector_with_sparse_rows, \
+    shrink_similarity, get_block_shape, collect_similarity_blocks, calc_similarity_matrix_in_blocks, \
+    select_top_k_neighbors, calc_top_k_similarity, prepare_similarity_operands, calc_similarity_from_operands
+from sparse_matrix import SparseRatingMatrix, last_occurrence, expand_ranges
+from ann import RandomProjectionLSH
+from factorization import MatrixFactorization, BaselineEstimator
+from cooccurrence import CooccurrenceModel
+from loader import load_triplets
+from cache import ResultCache
+from id_table import IdTable
+from instrumentation import registry
 import dataclasses
 import json
+import os
+import threading
+
+# スナップショットに保存する疎行列の配列
+_SPARSE_ARRAYS = ['indptr', 'indices', 'data',
+                  'col_indptr', 'col_indices', 'col_data']
+# 評価値行列に使える型。uint8は0〜255の整数の評価値をそのまま格納し、スケールやオフセットによる量子化は行わない
+_RATING_DTYPES = {'float64': np.float64, 'float32': np.float32, 'uint8': np.uint8}
+# 類似度行列に使える型
+_SIMILARITY_DTYPES = {'float64': np.float64, 'float32': np.float32}
+# 評価値の読み込みで作成する属性。lazy=Trueの場合は、いずれかに初めてアクセスした時点で読み込む
+_LOADED_ATTRIBUTES = {
+    '_similarity_cache', '_similarity_row_cache', '_dirty_similarity', '_similarity_operands', '_buffers',
+    '_ann_index',
+    '_neighbors', '_neighbor_lookup', '_factor_model', '_baseline_model', '_cooccurrence_model',
+    '_users', '_items', 'matrix', '_ratings_dict', '_user_rating_sum', '_user_rating_count',
+    '_item_rating_sum', '_item_rating_count', '_rating_sum_total', '_rating_count_total',
+}
+# 評価数と評価値の和から、初めてアクセスした時点で計算する属性
+_MEAN_ATTRIBUTES = {'_user_mean', '_item_mean', '_global_mean'}
+# viewで作成した推薦器と共有する属性
+_SHARED_ATTRIBUTES = [
+    '_users', '_items', 'matrix', '_ratings_dict', '_user_rating_sum', '_user_rating_count',
+    '_item_rating_sum', '_item_rating_count', '_rating_sum_total', '_rating_count_total',
+    '_factor_model', '_baseline_model', '_cooccurrence_model',
+]
+# スナップショットに保存する行列分解のモデルの配列
+_FACTOR_ARRAYS = ['user_factors', 'item_factors', 'user_bias', 'item_bias']
+
+
+def _select_top_n(values: np.ndarray, top_n: int = 0) -> np.ndarray:
+    """値の降順に並べたindexを返却する。同じ値はindexの昇順とする。
+    top_nが正の場合は、部分選択で上位top_n件を取り出してからそれらだけをソートする
+
+    Args:
+        values (np.ndarray): 値のベクトル
+        top_n (int, optional): 上位n件のみを取得
+
+    Returns:
+        np.ndarray: index
+    """
+    idx = np.arange(len(values))
+    if 0 < top_n < len(values):
+        kth = np.partition(values, len(values) - top_n)[len(values) - top_n]
+        above = idx[values > kth]
+        ties = idx[values == kth][:top_n - len(above)]
+        idx = np.concatenate([above, ties])
+    return idx[np.argsort(-values[idx], kind='stable')]
 
 
 @dataclasses.dataclass
@@ -10,13 +71,125 @@ class Recommendation:
     missing_value: float = 0.0
     file_name: str = 'data/ratings.json'
     file_format: str = 'json'
+    chunk_size: int = 100000
+    metric: str = 'euclidean'
+    storage: str = 'dense'
+    n_neighbors: int = 0
+    shrinkage: float = 0.0
+    min_overlap: int = 0
+    cold_start: str = None
+    cache_size: int = 0
+    cache_ttl: float = 0.0
+    cache_max_bytes: int = 0
+    rating_dtype: str = 'float64'
+    implicit: bool = False
+    similarity_dtype: str = 'float32'
+    memory_budget: int = 2 ** 28
+    lazy: bool = False
 
     def __post_init__(self):
-        self._load_ratings()
+        # get_recommendationsの結果のキャッシュ。keyは(user_name, based, top_n, debiasing)。cache_sizeが0の場合は使わない
+        self._result_cache: ResultCache = ResultCache(
+            self.cache_size, self.cache_ttl, self.cache_max_bytes) if self.cache_size > 0 else None
+        # viewで評価値行列を共有している場合はTrue。評価値を更新できない
+        self._read_only = False
+        self._load_lock = threading.RLock()
+        self._loaded = False
+        if not self.lazy:
+            self._load()
+
+    def __getattr__(self, name: str):
+        """通常の属性の探索で見つからなかった場合に呼ばれる。
+        lazy=Trueで読み込み前の属性は評価値を読み込んでから、平均評価値は計算してから返却する
+
+        Args:
+            name (str): 属性名
+
+        Returns:
+            属性の値
+        """
+        if name in _LOADED_ATTRIBUTES | _MEAN_ATTRIBUTES and not self.__dict__.get('_loaded', True):
+            # 他のスレッドが読み込み中の場合は、_load_lockで読み込みの完了を待つ
+            self._load()
+        if name in _MEAN_ATTRIBUTES and name not in self.__dict__ and '_user_rating_sum' in self.__dict__:
+            self._update_average_ratings()
+        if name not in self.__dict__:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        return self.__dict__[name]
+
+    def _load(self):
+        """キャッシュとモデルを初期化し、評価値を読み込む。複数のスレッドから呼ばれても一度だけ読み込む。
+        読み込みは読み込むスレッドだけが参照する作業用のインスタンスで行い、完了してから属性を移す。
+        そのため他のスレッドから見える属性は常に読み込み済みの値で、未作成の属性へのアクセスは読み込みの完了を待つ
+        """
+        with self._load_lock:
+            if self._loaded:
+                return
+            staging = object.__new__(type(self))
+            staging.__dict__.update(self.__dict__)
+            # 作業用のインスタンスで未作成の属性にアクセスしても、読み込みを繰り返さずにAttributeErrorとする
+            staging._loaded = True
+            staging._init_caches()
+            staging._load_ratings()
+            for name, value in staging.__dict__.items():
+                if name != '_loaded':
+                    self.__dict__[name] = value
+            self._loaded = True
+
+    def __getstate__(self) -> Dict:
+        """pickleとdeepcopyのために、ロックを除いた属性を返却する
 
+        Returns:
+            Dict: 属性
+        """
+        state = self.__dict__.copy()
+        del state['_load_lock']
+        return state
+
+    def __setstate__(self, state: Dict):
+        """pickleとdeepcopyで復元した属性に、新しいロックを加える
+
+        Args:
+            state (Dict): 属性
+        """
+        self.__dict__.update(state)
+        self._load_lock = threading.RLock()
+
+    def _init_caches(self):
+        """類似度行列などのキャッシュと、学習したモデルを空にする
+        """
+        # 類似度行列のキャッシュ。keyは(object_type, metric)
+        self._similarity_cache: Dict[Tuple[str, str], np.ndarray] = {}
+        # 疎行列の場合は行単位でキャッシュする。keyは(object_type, metric, index)
+        self._similarity_row_cache: Dict[Tuple[str, str, int], np.ndarray] = {}
+        # 評価値の更新により計算し直す必要がある類似度行列の行。keyは(object_type, metric)
+        self._dirty_similarity: Dict[Tuple[str, str], Set[int]] = {}
+        # 密行列で類似度行列の行を計算し直すときに使う、比較対象側の前処理済みの行列。keyは(object_type, metric)
+        self._similarity_operands: Dict[Tuple[str, str], tuple] = {}
+        # 追加に備えて容量を確保した配列。keyは属性名、またはキャッシュの名前とそのkeyの組
+        self._buffers: Dict[Hashable, np.ndarray] = {}
+        # 近似最近傍探索のインデックス。keyはobject_type。評価値を更新しても、作り直すまでは変わらない
+        self._ann_index: Dict[str, RandomProjectionLSH] = {}
+        # fit_neighborsで作成した上位k件の近傍のindexと類似度。keyはobject_type。評価値を更新しても、作り直すまでは変わらない
+        self._neighbors: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        # 近傍リストを逆引きする疎行列。行jの要素(i, 類似度)は、iの近傍にjが含まれることを表す
+        self._neighbor_lookup: Dict[str, SparseRatingMatrix] = {}
+        # based='mf'で使う行列分解のモデル。評価値を更新しても、fit_factorsを呼び直すまでは変わらない
+        self._factor_model: MatrixFactorization = None
+        # based='baseline'とdebiasing='baseline'で使うベースライン推定のモデル
+        self._baseline_model: BaselineEstimator = None
+        # based='cooccurrence'で使う共起行列のモデル。評価値を更新しても、fit_cooccurrenceを呼び直すまでは変わらない
+        self._cooccurrence_model: CooccurrenceModel = None
+
+    @registry.timed('load')
     def _load_ratings(self):
         if self.file_format == 'json':
             return self._load_ratings_json()
+        elif self.file_format == 'snapshot':
+            return self._load_ratings_snapshot()
+        elif self.file_format in ('csv', 'jsonl'):
+            return self._load_ratings_log()
+        raise Exception("Unknown file_format: {}".format(self.file_format))
 
     def _load_ratings_json(self):
         """ratingsをロードし、user-item行列、辞書を作成する
@@ -29,25 +202,278 @@ class Recommendation:
             user_set.add(user_k)
             for item_k, item_v in user_v.items():
                 item_set.add(item_k)
-        # ソートしてリストとして保持
-        self._user_list: List[str] = sorted(list(user_set))
-        self._item_list: List[str] = sorted(list(item_set))
-        # 辞書に変換。valueとして0-originのindexを付与する
-        self._user_dic: Dict[str, int] = dict(
-            zip(self._user_list, range(len(self._user_list))))
-        self._item_dic: Dict[str, int] = dict(
-            zip(self._item_list, range(len(self._item_list))))
-        # 行列は、行方向がユーザで列方向がアイテム
-        self.matrix = np.zeros(
-            (len(self._user_dic), len(self._item_dic)))
-        # もう一度ループして、ratingを格納
+        # ソートした順に0-originのindexを付与する
+        self._users = IdTable(sorted(user_set))
+        self._items = IdTable(sorted(item_set))
+        # もう一度ループして、ratingを(user_idx, item_idx, rating)の三つ組に変換
+        user_idx = []
+        item_idx = []
+        values = []
         for user_k, user_v in ratings.items():
-            user_idx = self._user_dic[user_k]
             for item_k, item_v in user_v.items():
-                item_idx = self._item_dic[item_k]
-                self.matrix[user_idx][item_idx] = item_v
+                user_idx.append(self._users[user_k])
+                item_idx.append(self._items[item_k])
+                values.append(item_v)
+        self._build_matrix(np.array(user_idx, dtype=np.int64), np.array(item_idx, dtype=np.int64),
+                           np.array(values, dtype=np.float64))
+
+    def _load_ratings_log(self):
+        """user,item,ratingの三つ組が並んだCSVまたはJSON Linesの評価ログを、chunk_size行ずつ読み込む
+        """
+        user_list, item_list, user_idx, item_idx, values = load_triplets(
+            self.file_name, self.file_format, self.chunk_size)
+        # JSONと同じく、ソートしたリストのindexに振り直す
+        user_order = sorted(range(len(user_list)), key=user_list.__getitem__)
+        item_order = sorted(range(len(item_list)), key=item_list.__getitem__)
+        user_rank = np.empty(len(user_list), dtype=np.int64)
+        user_rank[user_order] = np.arange(len(user_list))
+        item_rank = np.empty(len(item_list), dtype=np.int64)
+        item_rank[item_order] = np.arange(len(item_list))
+        self._users = IdTable(user_list[i] for i in user_order)
+        self._items = IdTable(item_list[i] for i in item_order)
+        self._build_matrix(user_rank[user_idx], item_rank[item_idx], values)
+
+    def _build_matrix(self, user_idx: np.ndarray, item_idx: np.ndarray, values: np.ndarray):
+        """(ユーザ, アイテム, 評価値)の三つ組から評価値行列を作成する。同じ組が複数ある場合は最後の評価値を採用する
+
+        Args:
+            user_idx (np.ndarray): ユーザのindex
+            item_idx (np.ndarray): アイテムのindex
+            values (np.ndarray): 評価値
+        """
+        # 行列は、行方向がユーザで列方向がアイテム
+        shape = (len(self._users), len(self._items))
+        dtype = self._get_rating_dtype()
+        if self.implicit:
+            # 暗黙的フィードバックでは、評価値によらず1回以上の接触を1とする
+            values = np.ones(len(values))
+        self._validate_ratings(values)
+        if self.storage == 'dense':
+            self._validate_ratings(np.array([self.missing_value]))
+            keep = last_occurrence(user_idx * shape[1] + item_idx)
+            self.matrix = np.full(shape, self.missing_value, dtype=dtype)
+            self.matrix[user_idx[keep], item_idx[keep]] = values[keep]
+        elif self.storage == 'sparse':
+            self.matrix = SparseRatingMatrix.from_triplets(
+                user_idx, item_idx, values, shape, dtype)
+        else:
+            raise Exception("Unknown storage: {}".format(self.storage))
+        # [user][item]の辞書は保持せず、必要になった時点で行列から作成する
+        self._ratings_dict = None
+        self._calc_rating_statistics()
+
+    def _get_rating_dtype(self) -> type:
+        """評価値行列の型を返却する
+
+        Returns:
+            type: 型
+        """
+        if self.rating_dtype not in _RATING_DTYPES:
+            raise Exception("Unknown rating_dtype: {}".format(self.rating_dtype))
+        return _RATING_DTYPES[self.rating_dtype]
+
+    def _validate_ratings(self, ratings: np.ndarray):
+        """評価値が評価値行列の型で正確に表せることを確認する。uint8では0〜255の整数に限る。
+        uint8は量子化を行わないため、小数の評価値は丸めずに例外とする。小数の評価値にはfloat32を使う
+
+        Args:
+            ratings (np.ndarray): 評価値
+        """
+        if self.rating_dtype == 'uint8':
+            ratings = np.asarray(ratings, dtype=np.float64)
+            if np.any((ratings != np.round(ratings)) | (ratings < 0) | (ratings > 255)):
+                raise Exception("rating_dtype='uint8' can only store integer ratings from 0 to 255.")
+
+    def _load_ratings_snapshot(self):
+        """save_snapshotで保存したディレクトリから、配列をメモリマップして読み込む。
+        コピーオンライトでマップするため、更新しない限り複数のプロセスで同じページを共有する
+        """
+        with open(os.path.join(self.file_name, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['storage'] != self.storage:
+            raise Exception("The snapshot was saved with storage={}.".format(
+                meta['storage']))
+        if self.storage == 'dense' and meta['missing_value'] != self.missing_value:
+            raise Exception("The snapshot was saved with missing_value={}.".format(
+                meta['missing_value']))
+        if meta.get('rating_dtype', 'float64') != self.rating_dtype:
+            raise Exception("The snapshot was saved with rating_dtype={}.".format(
+                meta.get('rating_dtype', 'float64')))
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(self.file_name, name + '.npy'), mmap_mode='c')
+
+        self._users = IdTable(load('users').tolist())
+        self._items = IdTable(load('items').tolist())
+        if self.storage == 'sparse':
+            self.matrix = SparseRatingMatrix(
+                tuple(meta['shape']), *[load(name) for name in _SPARSE_ARRAYS])
+        else:
+            self.matrix = load('matrix')
+        self._user_rating_sum = load('user_rating_sum')
+        self._user_rating_count = load('user_rating_count')
+        self._item_rating_sum = load('item_rating_sum')
+        self._item_rating_count = load('item_rating_count')
+        self._rating_sum_total = float(self._user_rating_sum.sum())
+        self._rating_count_total = int(self._user_rating_count.sum())
+        # 類似度の縮小の設定が異なる場合は、保存された類似度行列は使わずに計算し直す
+        if meta.get('shrinkage', 0.0) == self.shrinkage and meta.get('min_overlap', 0) == self.min_overlap:
+            for object_type, metric in meta['similarities']:
+                self._similarity_cache[(object_type, metric)] = load(
+                    'similarity_{}_{}'.format(object_type, metric))
+        if 'factors' in meta:
+            self._factor_model = MatrixFactorization(**meta['factors']['settings'])
+            self._factor_model.global_mean = meta['factors']['global_mean']
+            for name in _FACTOR_ARRAYS:
+                setattr(self._factor_model, name, load('mf_' + name))
+        if 'baseline' in meta:
+            self._baseline_model = BaselineEstimator(**meta['baseline']['settings'])
+            self._baseline_model.global_mean = meta['baseline']['global_mean']
+            self._baseline_model.user_bias = load('baseline_user_bias')
+            self._baseline_model.item_bias = load('baseline_item_bias')
+        if 'cooccurrence' in meta:
+            self._cooccurrence_model = CooccurrenceModel(**meta['cooccurrence']['settings'])
+            self._cooccurrence_model.matrix = SparseRatingMatrix(
+                tuple(meta['cooccurrence']['shape']), *[load('cooccurrence_' + name) for name in _SPARSE_ARRAYS])
+        for object_type in meta.get('neighbors', []):
+            self._set_neighbors(object_type, load('neighbors_{}_indices'.format(object_type)),
+                                load('neighbors_{}_scores'.format(object_type)))
+        # 辞書は必要になった時点で行列から作成する
+        self._ratings_dict = None
+
+    def save_snapshot(self, path: str, include_similarity: bool = False):
+        """評価値行列、ユーザ・アイテムのid表、評価数と評価値の和、fit_neighborsで作成した近傍リスト、行列分解とベースライン推定と共起行列のモデルを、
+        .npyのバイナリ形式でディレクトリに保存する。
+        file_format='snapshot'、file_name=pathとして読み込むと、JSONを解析せずにメモリマップで読み込める
+
+        Args:
+            path (str): 保存先のディレクトリ
+            include_similarity (bool, optional): キャッシュ済みの類似度行列も保存する
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            'users': self._users.names.astype(str),
+            'items': self._items.names.astype(str),
+            'user_rating_sum': self._user_rating_sum,
+            'user_rating_count': self._user_rating_count,
+            'item_rating_sum': self._item_rating_sum,
+            'item_rating_count': self._item_rating_count,
+        }
+        if self.storage == 'sparse':
+            for name in _SPARSE_ARRAYS:
+                arrays[name] = getattr(self.matrix, name)
+        else:
+            arrays['matrix'] = self.matrix
+        similarities = []
+        if include_similarity:
+            for object_type, metric in list(self._similarity_cache):
+                arrays['similarity_{}_{}'.format(object_type, metric)] = \
+                    self._get_similarity_matrix(object_type, metric)
+                similarities.append([object_type, metric])
+        for object_type, (indices, scores) in self._neighbors.items():
+            arrays['neighbors_{}_indices'.format(object_type)] = indices
+            arrays['neighbors_{}_scores'.format(object_type)] = scores
+        if self._baseline_model is not None:
+            arrays['baseline_user_bias'] = self._baseline_model.user_bias
+            arrays['baseline_item_bias'] = self._baseline_model.item_bias
+        if self._factor_model is not None:
+            for name in _FACTOR_ARRAYS:
+                arrays['mf_' + name] = getattr(self._factor_model, name)
+        if self._cooccurrence_model is not None:
+            for name in _SPARSE_ARRAYS:
+                arrays['cooccurrence_' + name] = getattr(self._cooccurrence_model.matrix, name)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'),
+                    np.ascontiguousarray(array))
+        meta = {
+            'storage': self.storage,
+            'missing_value': self.missing_value,
+            'rating_dtype': self.rating_dtype,
+            'shape': [len(self._users), len(self._items)],
+            'similarities': similarities,
+            'neighbors': list(self._neighbors),
+            'shrinkage': self.shrinkage,
+            'min_overlap': self.min_overlap,
+        }
+        if self._factor_model is not None:
+            meta['factors'] = {
+                'settings': dataclasses.asdict(self._factor_model),
+                'global_mean': self._factor_model.global_mean,
+            }
+        if self._baseline_model is not None:
+            meta['baseline'] = {
+                'settings': dataclasses.asdict(self._baseline_model),
+                'global_mean': self._baseline_model.global_mean,
+            }
+        if self._cooccurrence_model is not None:
+            meta['cooccurrence'] = {
+                'settings': dataclasses.asdict(self._cooccurrence_model),
+                'shape': list(self._cooccurrence_model.matrix.shape),
+            }
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def view(self, **settings) -> 'Recommendation':
+        """評価値行列、id表、評価数と評価値の和、学習済みのモデルをコピーせずに参照し、設定だけが異なる推薦器を作成する。
+        類似度行列と近傍リストは、類似度の設定(metric、shrinkage、min_overlap、similarity_dtype)が同じ場合だけ共有する。
+        評価値行列を共有するため、作成後はこの推薦器とビューのいずれも評価値を更新できない
+
+        Args:
+            **settings: 変更する設定。storage、rating_dtype、implicitは変更できず、
+                密行列ではmissing_valueも変更できない
+
+        Returns:
+            Recommendation: ビュー
+        """
+        view = dataclasses.replace(self, lazy=True, **settings)
+        for name in ('storage', 'rating_dtype', 'implicit'):
+            if getattr(view, name) != getattr(self, name):
+                raise Exception("A view must use the same {} as the shared model.".format(name))
+        if self.storage == 'dense' and view.missing_value != self.missing_value:
+            raise Exception("A dense view must use the same missing_value as the shared model.")
+        self._load()
+        if self.storage == 'sparse':
+            # 共有した後は評価値を更新しないため、差分を統合しておけば読み込み時に統合が走らない
+            self.matrix.compact()
+        with view._load_lock:
+            view._loaded = True
+            view._init_caches()
+            for name in _SHARED_ATTRIBUTES:
+                setattr(view, name, getattr(self, name))
+            similarity_settings = ('shrinkage', 'min_overlap', 'similarity_dtype')
+            if all(getattr(view, name) == getattr(self, name) for name in similarity_settings):
+                for key, sim_matrix in self._similarity_cache.items():
+                    if key not in self._dirty_similarity:
+                        view._similarity_cache[key] = sim_matrix
+                if view.metric == self.metric:
+                    for object_type, (indices, scores) in self._neighbors.items():
+                        view._neighbors[object_type] = (indices, scores)
+                        view._neighbor_lookup[object_type] = self._neighbor_lookup[object_type]
+        self._read_only = view._read_only = True
+        return view
+
+    def _check_writable(self):
+        """評価値を更新できることを確認する。viewで評価値行列を共有している場合は例外とする
+        """
+        if self._read_only:
+            raise Exception("The ratings are shared with views and cannot be updated.")
+
+    @property
+    def ratings_dict(self) -> Dict[str, Dict[str, float]]:
+        """[user][item]の評価値の辞書。スナップショットから読み込んだ場合は、初回アクセス時に行列から作成する
 
-        self.ratings_dict = ratings  # [user][item]
+        Returns:
+            Dict[str, Dict[str, float]]: 評価値の辞書
+        """
+        if self._ratings_dict is None:
+            ratings = {}
+            for user_idx, user_name in enumerate(self._users.names):
+                item_idx, values = self._get_observed_ratings_for_one_user(
+                    user_idx)
+                ratings[user_name] = dict(
+                    zip(self._items.decode(item_idx), values.astype(np.float64).tolist()))
+            self._ratings_dict = ratings
+        return self._ratings_dict
 
     def _get_ratings_for_one_user(self, user_name: str) -> np.ndarray:
         """指定されたユーザの評価値ベクトルを返却する
@@ -58,7 +484,7 @@ class Recommendation:
         Returns:
             np.ndarray: 評価値ベクトル
         """
-        return self.matrix[self._user_dic[user_name]]
+        return self._get_rating_vector('user', self._users[user_name])
 
     def _get_ratings_for_one_item(self, item_name: str) -> np.ndarray:
         """指定されたアイテムの評価値ベクトルを返却する
@@ -69,7 +495,7 @@ class Recommendation:
         Returns:
             np.ndarray: 評価値ベクトル
         """
-        return self.matrix[:, self._item_dic[item_name]]
+        return self._get_rating_vector('item', self._items[item_name])
 
     def _get_ratings_for_one_object(self, object_type: str, object_name: str) -> np.ndarray:
         """指定されたユーザまたはアイテムの評価値ベクトルを返却する
@@ -86,13 +512,168 @@ class Recommendation:
         elif object_type == 'item':
             return self._get_ratings_for_one_item(object_name)
 
+    def _get_rating_vector(self, object_type: str, object_idx: int) -> np.ndarray:
+        """指定されたユーザまたはアイテムの評価値ベクトルをfloat64で返却する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (int): キーとなるユーザまたはアイテムのindex
+
+        Returns:
+            np.ndarray: 評価値ベクトル
+        """
+        if object_type == 'user':
+            if self.storage == 'sparse':
+                return self.matrix.row_to_dense(object_idx, self.missing_value)
+            return np.asarray(self.matrix[object_idx], dtype=np.float64)
+        elif object_type == 'item':
+            if self.storage == 'sparse':
+                return self.matrix.col_to_dense(object_idx, self.missing_value)
+            return np.asarray(self.matrix[:, object_idx], dtype=np.float64)
+
+    def _get_observed_ratings_for_one_user(self, user_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """指定されたユーザが評価済みのアイテムindexと評価値を返却する
+
+        Args:
+            user_idx (int): キーとなるユーザのindex
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: アイテムindexと評価値
+        """
+        if self.storage == 'sparse':
+            return self.matrix.get_row(user_idx)
+        ratings = self.matrix[user_idx]
+        idx = np.where(ratings != self.missing_value)[0]
+        return idx, ratings[idx]
+
+    def _get_observed_ratings_for_one_item(self, item_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """指定されたアイテムを評価済みのユーザindexと評価値を返却する
+
+        Args:
+            item_idx (int): キーとなるアイテムのindex
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: ユーザindexと評価値
+        """
+        if self.storage == 'sparse':
+            return self.matrix.get_col(item_idx)
+        ratings = self.matrix[:, item_idx]
+        idx = np.where(ratings != self.missing_value)[0]
+        return idx, ratings[idx]
+
+    def _get_observed_block(self, user_idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """指定されたユーザ群の評価値行列と評価済みマスクを返却する
+
+        Args:
+            user_idx (np.ndarray): ユーザindexの配列
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 評価値行列と評価済みマスク (len(user_idx), アイテム数)
+        """
+        if self.storage == 'sparse':
+            return self.matrix.rows_to_dense(user_idx, self.missing_value)
+        block = self.matrix[user_idx]
+        return block, block != self.missing_value
+
+    def _calc_rating_statistics(self):
+        """ユーザ・アイテムごとの評価数と評価値の和、全体の評価数と評価値の和をまとめて計算し、保持する。
+        平均評価値は初めてアクセスした時点で計算する。評価値が変わった場合は再度呼び出す
+        """
+        if self.storage == 'sparse':
+            self._user_rating_sum = self.matrix.row_sums()
+            self._user_rating_count = self.matrix.row_counts()
+            self._item_rating_sum = self.matrix.col_sums()
+            self._item_rating_count = self.matrix.col_counts()
+        else:
+            mask = self.matrix != self.missing_value
+            values = np.where(mask, self.matrix, 0)
+            self._user_rating_sum = values.sum(axis=1, dtype=np.float64)
+            self._user_rating_count = mask.sum(axis=1)
+            self._item_rating_sum = values.sum(axis=0, dtype=np.float64)
+            self._item_rating_count = mask.sum(axis=0)
+        self._rating_sum_total = float(self._user_rating_sum.sum())
+        self._rating_count_total = int(self._user_rating_count.sum())
+        for name in _MEAN_ATTRIBUTES:
+            self.__dict__.pop(name, None)
+
+    def _update_average_ratings(self, user_idx: np.ndarray = None, item_idx: np.ndarray = None):
+        """保持している評価数と評価値の和から平均評価値を更新する。評価が1つもない場合はnanとなる
+
+        Args:
+            user_idx (np.ndarray, optional): 更新するユーザのindex。省略時は全ユーザ
+            item_idx (np.ndarray, optional): 更新するアイテムのindex。省略時は全アイテム
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if user_idx is None:
+                self._user_mean = self._user_rating_sum / self._user_rating_count
+            else:
+                self._user_mean[user_idx] = self._user_rating_sum[user_idx] / \
+                    self._user_rating_count[user_idx]
+            if item_idx is None:
+                self._item_mean = self._item_rating_sum / self._item_rating_count
+            else:
+                self._item_mean[item_idx] = self._item_rating_sum[item_idx] / \
+                    self._item_rating_count[item_idx]
+            self._global_mean = np.float64(
+                self._rating_sum_total) / self._rating_count_total
+
+    def _update_rating_statistics(self, user_idx: np.ndarray, item_idx: np.ndarray,
+                                  delta_sum: np.ndarray, delta_count: np.ndarray):
+        """評価値の追加・変更・削除に合わせて、評価数と評価値の和、平均評価値を差分で更新する
+
+        Args:
+            user_idx (np.ndarray): 変更があったユーザのindex
+            item_idx (np.ndarray): 変更があったアイテムのindex
+            delta_sum (np.ndarray): 評価値の和の増分
+            delta_count (np.ndarray): 評価数の増分
+        """
+        np.add.at(self._user_rating_sum, user_idx, delta_sum)
+        np.add.at(self._user_rating_count, user_idx, delta_count)
+        np.add.at(self._item_rating_sum, item_idx, delta_sum)
+        np.add.at(self._item_rating_count, item_idx, delta_count)
+        self._rating_sum_total += float(np.sum(delta_sum))
+        self._rating_count_total += int(np.sum(delta_count))
+        self._update_average_ratings(np.unique(user_idx), np.unique(item_idx))
+
+    def _get_average_ratings(self, object_type: str) -> np.ndarray:
+        """全ユーザ(アイテム)の平均評価値を返却する。評価が1つもない場合はnanとなる
+
+        Args:
+            object_type (str): 'user' or 'item'
+
+        Returns:
+            np.ndarray: 平均評価値のベクトル
+        """
+        if object_type == 'user':
+            return self._user_mean
+        elif object_type == 'item':
+            return self._item_mean
+
+    @property
+    def _user_dic(self) -> IdTable:
+        """ユーザ名からindexへの対応。_usersと同じ
+
+        Returns:
+            IdTable: ユーザのid表
+        """
+        return self._users
+
+    @property
+    def _item_dic(self) -> IdTable:
+        """アイテム名からindexへの対応。_itemsと同じ
+
+        Returns:
+            IdTable: アイテムのid表
+        """
+        return self._items
+
     def _get_user_list(self) -> List[str]:
         """ユーザリストを返却する
 
         Returns:
             List[str]: ユーザリスト
         """
-        return self._user_list
+        return self._users.names.tolist()
 
     def _get_item_list(self) -> List[str]:
         """アイテムリストを返却する
@@ -100,7 +681,7 @@ class Recommendation:
         Returns:
             List[str]: アイテムリスト
         """
-        return self._item_list
+        return self._items.names.tolist()
 
     def _calc_similarity_with_missing_value_by_name(self, object_type: str, object_name_1: str, object_name_2: str,
                                                     metric: str = 'euclidean',
@@ -117,40 +698,630 @@ class Recommendation:
         Returns:
             float: 類似度
         """
-        v1: np.ndarray = self._get_ratings_for_one_object(
-            object_type, object_name_1)
-        v2: np.ndarray = self._get_ratings_for_one_object(
-            object_type, object_name_2)
+        table = self._users if object_type == 'user' else self._items
+        v1: np.ndarray = self._get_rating_vector(object_type, table[object_name_1])
+        v2: np.ndarray = self._get_rating_vector(object_type, table[object_name_2])
         sim: float = calc_similarity_with_missing_value(
-            v1, v2, metric, missing_value)
+            v1, v2, metric, missing_value, self._get_dimension_means(object_type, metric))
+        if self._shrinks_similarity():
+            n = np.count_nonzero((v1 != missing_value) & (v2 != missing_value))
+            sim = float(shrink_similarity(
+                sim, n, self.shrinkage, self.min_overlap))
         return sim
 
-    def _get_similar_objects(self, object_type: str, object_name: str) -> List[List[Union[str, float]]]:
+    def _get_similarity_dtype(self) -> type:
+        """類似度行列の型を返却する
+
+        Returns:
+            type: 型
+        """
+        if self.similarity_dtype not in _SIMILARITY_DTYPES:
+            raise Exception("Unknown similarity_dtype: {}".format(self.similarity_dtype))
+        return _SIMILARITY_DTYPES[self.similarity_dtype]
+
+    def _shrinks_similarity(self) -> bool:
+        """共通評価数による類似度の縮小、または共通評価数の下限が指定されているか
+
+        Returns:
+            bool: 指定されていればTrue
+        """
+        return self.shrinkage > 0 or self.min_overlap > 0
+
+    def _get_dimension_means(self, object_type: str, metric: str) -> np.ndarray:
+        """adjusted_cosineで評価値から引く平均評価値を返却する。
+        ユーザ同士ではアイテムの、アイテム同士ではユーザの平均評価値となる
+
+        Args:
+            object_type (str): 'user' or 'item'
+            metric (str): スコア計算のメトリック
+
+        Returns:
+            np.ndarray: 平均評価値。adjusted_cosine以外ではNone
+        """
+        if metric != 'adjusted_cosine':
+            return None
+        if object_type == 'user':
+            return self._item_mean
+        elif object_type == 'item':
+            return self._user_mean
+
+    def _get_n_objects(self, object_type: str) -> int:
+        """ユーザ(アイテム)数を返却する
+
+        Args:
+            object_type (str): 'user' or 'item'
+
+        Returns:
+            int: ユーザ(アイテム)数
+        """
+        if object_type == 'user':
+            return len(self._users)
+        elif object_type == 'item':
+            return len(self._items)
+
+    @registry.timed('similarity')
+    def _calc_similarity_rows(self, object_type: str, object_idx: np.ndarray, metric: str) -> np.ndarray:
+        """指定されたユーザ(アイテム)群と全ユーザ(アイテム)との類似度を、キャッシュを使わずに計算する。
+        shrinkage、min_overlapが指定されている場合は、共通評価数に応じて縮小した類似度を返す
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (np.ndarray): キーとなるユーザ(アイテム)のindexの配列
+            metric (str): スコア計算のメトリック
+
+        Returns:
+            np.ndarray: 類似度行列 (len(object_idx), ユーザ(アイテム)数)
+        """
+        n_objects = self._get_n_objects(object_type)
+        dimension_means = self._get_dimension_means(object_type, metric)
+        if self.storage == 'sparse':
+            m = self.matrix
+            rows = []
+            for idx in object_idx:
+                if object_type == 'user':
+                    indices, values = m.get_row(idx)
+                    rows.append(calc_similarity_vector_with_sparse_matrix(
+                        indices, values, m.col_indptr, m.col_indices, m.col_data, n_objects, metric,
+                        self._user_rating_count, dimension_means))
+                elif object_type == 'item':
+                    indices, values = m.get_col(idx)
+                    rows.append(calc_similarity_vector_with_sparse_matrix(
+                        indices, values, m.indptr, m.indices, m.data, n_objects, metric,
+                        self._item_rating_count, dimension_means))
+            sim_rows = np.array(rows).reshape(len(rows), n_objects)
+        else:
+            m = self._get_dense_object_matrix(object_type)
+            sim_rows = calc_similarity_matrix_with_missing_value(
+                m[object_idx], m, metric, self.missing_value, dimension_means)
+        if self._shrinks_similarity():
+            sim_rows = shrink_similarity(sim_rows, self._calc_co_rating_count_rows(object_type, object_idx),
+                                         self.shrinkage, self.min_overlap)
+        return sim_rows
+
+    def _iter_sparse_similarity_blocks(self, object_type: str, metric: str,
+                                       block_size: int = None) -> Iterator[Tuple[int, np.ndarray]]:
+        """疎行列から、全ユーザ(アイテム)同士の類似度をユーザ(アイテム)のblock_size件ごとに順に計算する。
+        block_sizeを省略した場合は、ブロックの作業領域がmemory_budgetバイトに収まる件数とする
+
+        Args:
+            object_type (str): 'user' or 'item'
+            metric (str): スコア計算のメトリック
+            block_size (int, optional): 一度に類似度を計算するユーザ(アイテム)数
+
+        Yields:
+            Tuple[int, np.ndarray]: ブロックの先頭のindexと、類似度 (ブロックの件数, ユーザ(アイテム)数)
+        """
+        n_objects = self._get_n_objects(object_type)
+        if block_size is None:
+            block_size = get_block_shape(n_objects, 0, self.memory_budget)[0]
+        for start in range(0, n_objects, block_size):
+            yield start, self._calc_similarity_rows(
+                object_type, np.arange(start, min(start + block_size, n_objects)), metric)
+
+    def _get_dense_object_matrix(self, object_type: str) -> np.ndarray:
+        """密行列で、ユーザ(アイテム)を行とする評価値行列を返却する
+
+        Args:
+            object_type (str): 'user' or 'item'
+
+        Returns:
+            np.ndarray: 評価値行列。アイテムの場合は転置したビュー
+        """
+        if object_type == 'user':
+            return self.matrix
+        elif object_type == 'item':
+            return self.matrix.T
+
+    def _calc_co_rating_count_rows(self, object_type: str, object_idx: np.ndarray) -> np.ndarray:
+        """指定されたユーザ(アイテム)群と全ユーザ(アイテム)との共通評価数を計算する。
+        全ユーザ(アイテム)を指定すると共起行列全体を一度に計算する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (np.ndarray): キーとなるユーザ(アイテム)のindexの配列
+
+        Returns:
+            np.ndarray: 共通評価数 (len(object_idx), ユーザ(アイテム)数)
+        """
+        n_objects = self._get_n_objects(object_type)
+        if self.storage == 'sparse':
+            m = self.matrix
+            rows = []
+            for idx in object_idx:
+                if object_type == 'user':
+                    rows.append(calc_co_rating_count_vector_with_sparse_matrix(
+                        m.get_row(idx)[0], m.col_indptr, m.col_indices, n_objects))
+                elif object_type == 'item':
+                    rows.append(calc_co_rating_count_vector_with_sparse_matrix(
+                        m.get_col(idx)[0], m.indptr, m.indices, n_objects))
+            return np.array(rows).reshape(len(rows), n_objects)
+        m = self._get_dense_object_matrix(object_type)
+        return calc_co_rating_count_matrix(m[object_idx], m, self.missing_value)
+
+    def _get_similarity_matrix(self, object_type: str, metric: str = None) -> np.ndarray:
+        """ユーザ同士(アイテム同士)の類似度行列を返却する。初回に行ブロックごとに計算してsimilarity_dtypeの行列に書き込み、
+        以降はキャッシュを返す。評価値の更新があった場合は、影響を受けた行と列だけを計算し直す
+
+        Args:
+            object_type (str): 'user' or 'item'
+            metric (str, optional): スコア計算のメトリック。省略時はself.metric
+
+        Returns:
+            np.ndarray: 類似度行列。行・列ともに_users(_items)のindexに対応する
+        """
+        if metric is None:
+            metric = self.metric
+        key = (object_type, metric)
+        n_objects = self._get_n_objects(object_type)
+        if key not in self._similarity_cache:
+            registry.increment('similarity_cache_misses')
+            dtype = self._get_similarity_dtype()
+            if self.storage == 'sparse':
+                sim_matrix = collect_similarity_blocks(
+                    self._iter_sparse_similarity_blocks(object_type, metric), (n_objects, n_objects), dtype)
+            else:
+                m = self._get_dense_object_matrix(object_type)
+                with registry.timer('similarity'):
+                    sim_matrix = calc_similarity_matrix_in_blocks(
+                        m, m, metric, self.missing_value, self._get_dimension_means(object_type, metric),
+                        dtype, self.memory_budget, self.shrinkage, self.min_overlap)
+            self._discard_similarity_matrix(key)
+            self._similarity_cache[key] = sim_matrix
+            return self._similarity_cache[key]
+        registry.increment('similarity_cache_hits')
+        sim_matrix = self._similarity_cache[key]
+        if len(sim_matrix) < n_objects:
+            # 追加されたユーザ(アイテム)は評価がないため、類似度は0となる
+            sim_matrix = self._grow_buffer(('_similarity_cache',) + key, sim_matrix, (n_objects, n_objects), 0)
+            self._similarity_cache[key] = sim_matrix
+        dirty = self._dirty_similarity.pop(key, None)
+        if dirty:
+            idx = np.array(sorted(dirty), dtype=np.int64)
+            if self.storage == 'sparse':
+                rows = self._calc_similarity_rows(object_type, idx, metric)
+            else:
+                rows = self._calc_dirty_similarity_rows(object_type, idx, metric)
+            sim_matrix[idx, :] = rows
+            sim_matrix[:, idx] = rows.T
+        return sim_matrix
+
+    def _calc_dirty_similarity_rows(self, object_type: str, object_idx: np.ndarray, metric: str) -> np.ndarray:
+        """密行列で、評価値が変わったユーザ(アイテム)群と全ユーザ(アイテム)との類似度を計算する。
+        比較対象側の前処理済みの行列をキャッシュしておき、object_idxの行だけを前処理し直して書き込む。
+        追加されたユーザ(アイテム)や次元の分は、容量を倍々に確保したバッファで拡張する。
+        前処理済みの行列がmemory_budgetバイトに収まらない場合はキャッシュせず、_calc_similarity_rowsで計算する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (np.ndarray): 評価値が変わったユーザ(アイテム)のindexの配列
+            metric (str): スコア計算のメトリック
+
+        Returns:
+            np.ndarray: 類似度行列 (len(object_idx), ユーザ(アイテム)数)
+        """
+        key = (object_type, metric)
+        m = self._get_dense_object_matrix(object_type)
+        dimension_means = self._get_dimension_means(object_type, metric)
+        operands = self._similarity_operands.get(key)
+        n_arrays = 1 if metric == 'jaccard' else 3
+        if operands is None and n_arrays * m.size * 8 > self.memory_budget:
+            return self._calc_similarity_rows(object_type, object_idx, metric)
+        with registry.timer('similarity'):
+            if operands is None:
+                operands = prepare_similarity_operands(m, metric, self.missing_value, dimension_means)
+            else:
+                # 追加されたユーザ(アイテム)と次元は評価がないため、前処理済みの値は0となる
+                operands = tuple(
+                    self._grow_buffer(('_similarity_operands',) + key + (k,), operand,
+                                      (len(m),) + m.shape[1:operand.ndim], 0)
+                    for k, operand in enumerate(operands))
+                for operand, updated in zip(operands, prepare_similarity_operands(
+                        m[object_idx], metric, self.missing_value, dimension_means)):
+                    operand[object_idx] = updated
+            self._similarity_operands[key] = operands
+            return calc_similarity_from_operands(tuple(operand[object_idx] for operand in operands), operands,
+                                                 metric, self.shrinkage, self.min_overlap)
+
+    def _discard_similarity_matrix(self, key: Tuple[str, str]):
+        """類似度行列のキャッシュと、それを更新するための前処理済みの行列とバッファを破棄する
+
+        Args:
+            key (Tuple[str, str]): (object_type, metric)
+        """
+        self._similarity_cache.pop(key, None)
+        self._dirty_similarity.pop(key, None)
+        self._similarity_operands.pop(key, None)
+        for buffer_key in [buffer_key for buffer_key in self._buffers
+                           if isinstance(buffer_key, tuple) and buffer_key[1:3] == key]:
+            del self._buffers[buffer_key]
+
+    def _get_similarity_row(self, object_type: str, object_idx: int, metric: str = None) -> np.ndarray:
+        """指定されたユーザ(アイテム)と全ユーザ(アイテム)との類似度ベクトルを返却する。
+        密行列の場合は類似度行列の行を、疎行列の場合は評価済みの要素だけから行を計算してキャッシュする
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (int): キーとなるユーザ(アイテム)のindex
+            metric (str, optional): スコア計算のメトリック。省略時はself.metric
+
+        Returns:
+            np.ndarray: 類似度ベクトル
+        """
+        if metric is None:
+            metric = self.metric
+        if self.storage != 'sparse' or (object_type, metric) in self._similarity_cache:
+            return self._get_similarity_matrix(object_type, metric)[object_idx]
+        key = (object_type, metric, object_idx)
+        if key not in self._similarity_row_cache:
+            registry.increment('similarity_cache_misses')
+            self._similarity_row_cache[key] = self._calc_similarity_rows(
+                object_type, np.array([object_idx]), metric)[0]
+        else:
+            registry.increment('similarity_cache_hits')
+        row = self._similarity_row_cache[key]
+        n_objects = self._get_n_objects(object_type)
+        if len(row) < n_objects:
+            row = np.pad(row, (0, n_objects - len(row)))
+            self._similarity_row_cache[key] = row
+        return row
+
+    def _invalidate_similarity(self, object_type: str, object_idx: np.ndarray):
+        """評価値が変わったユーザ(アイテム)について、キャッシュしている類似度を無効にする。
+        類似度行列は読み出し時に該当する行と列を計算し直し、疎行列の行キャッシュはここで更新する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (np.ndarray): 評価値が変わったユーザ(アイテム)のindexの配列
+        """
+        # adjusted_cosineは平均評価値を通じて全ての類似度が変わりうるため、キャッシュを破棄する
+        for key in [key for key in self._similarity_cache if key[1] == 'adjusted_cosine']:
+            self._discard_similarity_matrix(key)
+        for key in [key for key in self._similarity_row_cache if key[1] == 'adjusted_cosine']:
+            del self._similarity_row_cache[key]
+        for key in self._similarity_cache:
+            if key[0] == object_type:
+                self._dirty_similarity.setdefault(
+                    key, set()).update(int(idx) for idx in object_idx)
+        cached = [key for key in self._similarity_row_cache if key[0] == object_type]
+        if len(cached) == 0:
+            return
+        n_objects = self._get_n_objects(object_type)
+        object_idx = np.unique(object_idx)
+        for metric in set(key[1] for key in cached):
+            rows = self._calc_similarity_rows(object_type, object_idx, metric)
+            for idx, row in zip(object_idx, rows):
+                self._similarity_row_cache[(object_type, metric, int(idx))] = row
+            for key in cached:
+                if key[1] == metric and key[2] not in object_idx:
+                    row = self._similarity_row_cache[key]
+                    if len(row) < n_objects:
+                        row = np.pad(row, (0, n_objects - len(row)))
+                        self._similarity_row_cache[key] = row
+                    # 類似度は対称なので、更新した行から該当する要素を取り出す
+                    row[object_idx] = rows[:, key[2]]
+
+    def _get_similarity_rows(self, object_type: str, object_idx: np.ndarray, metric: str = None) -> np.ndarray:
+        """指定されたユーザ(アイテム)群と全ユーザ(アイテム)との類似度行列を返却する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (np.ndarray): キーとなるユーザ(アイテム)のindexの配列
+            metric (str, optional): スコア計算のメトリック。省略時はself.metric
+
+        Returns:
+            np.ndarray: 類似度行列 (len(object_idx), ユーザ(アイテム)数)
+        """
+        if metric is None:
+            metric = self.metric
+        if self.storage != 'sparse' or (object_type, metric) in self._similarity_cache:
+            return self._get_similarity_matrix(object_type, metric)[object_idx]
+        n_objects = self.matrix.shape[0 if object_type == 'user' else 1]
+        rows = [self._get_similarity_row(object_type, idx, metric)
+                for idx in object_idx]
+        return np.array(rows).reshape(len(rows), n_objects)
+
+    def _get_rating_vectors(self, object_type: str, object_idx: np.ndarray) -> np.ndarray:
+        """指定されたユーザ(アイテム)群の評価値ベクトルを、欠損値で埋めた密な行列として返却する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (np.ndarray): ユーザ(アイテム)のindexの配列
+
+        Returns:
+            np.ndarray: 評価値行列 (len(object_idx), アイテム(ユーザ)数)
+        """
+        if self.storage == 'sparse':
+            if object_type == 'user':
+                return self.matrix.rows_to_dense(object_idx, self.missing_value)[0]
+            vectors = [self.matrix.col_to_dense(idx, self.missing_value)
+                       for idx in object_idx]
+            return np.array(vectors).reshape(len(vectors), self.matrix.shape[0])
+        if object_type == 'user':
+            return self.matrix[object_idx]
+        return self.matrix[:, object_idx].T
+
+    def fit_neighbors(self, object_type: str = 'item', k: int = 50,
+                      block_size: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """ユーザ(アイテム)ごとに、自身を除いて類似度が上位k件の近傍とその類似度を計算して保持する。
+        類似度は行ブロックごとに計算して上位k件だけを残すため、全体の類似度行列は作らない。
+        作成後は予測にこの近傍だけを使い、save_snapshotでモデルと一緒に保存される
+
+        Args:
+            object_type (str, optional): 'user' or 'item'
+            k (int, optional): 近傍数
+            block_size (int, optional): 一度に類似度を計算するユーザ(アイテム)数。省略時はmemory_budgetから決める
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 近傍のindex(int32)と類似度(float32)。いずれも (ユーザ(アイテム)数, k)
+        """
+        if self.storage == 'sparse':
+            indices, scores = select_top_k_neighbors(
+                self._iter_sparse_similarity_blocks(object_type, self.metric, block_size),
+                self._get_n_objects(object_type), k)
+        else:
+            m = self._get_dense_object_matrix(object_type)
+            with registry.timer('similarity'):
+                indices, scores = calc_top_k_similarity(
+                    m, k, self.metric, self.missing_value, self._get_dimension_means(object_type, self.metric),
+                    self.memory_budget, self.shrinkage, self.min_overlap, block_size)
+        self._set_neighbors(object_type, indices, scores)
+        self._invalidate_results()
+        return indices, scores
+
+    def _set_neighbors(self, object_type: str, indices: np.ndarray, scores: np.ndarray):
+        """近傍リストを保持し、予測で使う逆引きの疎行列を作成する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            indices (np.ndarray): 近傍のindex (ユーザ(アイテム)数, k)
+            scores (np.ndarray): 近傍の類似度 (ユーザ(アイテム)数, k)
+        """
+        n_objects, k = indices.shape
+        self._neighbors[object_type] = (indices, scores)
+        self._neighbor_lookup[object_type] = SparseRatingMatrix.from_triplets(
+            indices.ravel(), np.repeat(np.arange(n_objects), k), scores.ravel(), (n_objects, n_objects))
+
+    def _get_rating_triplets(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """評価済みの(ユーザ, アイテム, 評価値)の三つ組を返却する
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: ユーザindex、アイテムindex、評価値
+        """
+        if self.storage == 'sparse':
+            return self.matrix.to_triplets()
+        user_idx, item_idx = np.where(self.matrix != self.missing_value)
+        return user_idx, item_idx, self.matrix[user_idx, item_idx]
+
+    def fit_factors(self, n_factors: int = 20, n_epochs: int = 15, regularization: float = 0.1,
+                    seed: int = 0) -> MatrixFactorization:
+        """読み込んだ評価値から、based='mf'で使う行列分解のモデルを学習する
+
+        Args:
+            n_factors (int, optional): 因子数
+            n_epochs (int, optional): ALSの反復回数
+            regularization (float, optional): 正則化の強さ
+            seed (int, optional): 因子の初期値の乱数のシード
+
+        Returns:
+            MatrixFactorization: 学習したモデル
+        """
+        replaced = self._factor_model is not None
+        self._factor_model = MatrixFactorization(n_factors, n_epochs, regularization, seed).fit(
+            *self._get_rating_triplets(), (len(self._users), len(self._items)))
+        # 初めての学習ではこのモデルによる結果はキャッシュにないため、無効化はモデルを置き換えた場合だけ行う
+        if replaced:
+            self._invalidate_results()
+        return self._factor_model
+
+    def _get_factor_model(self) -> MatrixFactorization:
+        """行列分解のモデルを返却する。未学習の場合は既定の設定で学習する
+
+        Returns:
+            MatrixFactorization: モデル
+        """
+        if self._factor_model is None:
+            self.fit_factors()
+        return self._factor_model
+
+    def fit_baseline(self, n_epochs: int = 3, user_regularization: float = 10.0,
+                     item_regularization: float = 25.0) -> BaselineEstimator:
+        """読み込んだ評価値から、ベースライン推定のモデルを学習する
+
+        Args:
+            n_epochs (int, optional): 交互の更新の回数
+            user_regularization (float, optional): ユーザのバイアスの正則化の強さ
+            item_regularization (float, optional): アイテムのバイアスの正則化の強さ
+
+        Returns:
+            BaselineEstimator: 学習したモデル
+        """
+        replaced = self._baseline_model is not None
+        self._baseline_model = BaselineEstimator(n_epochs, user_regularization, item_regularization).fit(
+            *self._get_rating_triplets(), (len(self._users), len(self._items)))
+        # 初めての学習ではこのモデルによる結果はキャッシュにないため、無効化はモデルを置き換えた場合だけ行う
+        if replaced:
+            self._invalidate_results()
+        return self._baseline_model
+
+    def _get_baseline_model(self) -> BaselineEstimator:
+        """ベースライン推定のモデルを返却する。未学習の場合は既定の設定で学習する
+
+        Returns:
+            BaselineEstimator: モデル
+        """
+        if self._baseline_model is None:
+            self.fit_baseline()
+        return self._baseline_model
+
+    def fit_cooccurrence(self, normalization: str = 'cosine', max_pairs: int = 2 ** 24) -> CooccurrenceModel:
+        """評価済み(接触済み)のアイテムの組から、based='cooccurrence'で使うアイテム同士の共起行列を作成する
+
+        Args:
+            normalization (str, optional): 'count', 'cosine', 'jaccard' or 'lift'
+            max_pairs (int, optional): 共起回数を数えるときに一度に並べるアイテムの組の数の上限
+
+        Returns:
+            CooccurrenceModel: 作成したモデル
+        """
+        replaced = self._cooccurrence_model is not None
+        user_idx, item_idx, _ = self._get_rating_triplets()
+        self._cooccurrence_model = CooccurrenceModel(normalization, max_pairs).fit(
+            user_idx, item_idx, (len(self._users), len(self._items)))
+        # 初めての作成ではこのモデルによる結果はキャッシュにないため、無効化はモデルを置き換えた場合だけ行う
+        if replaced:
+            self._invalidate_results()
+        return self._cooccurrence_model
+
+    def _get_cooccurrence_model(self) -> CooccurrenceModel:
+        """共起行列のモデルを返却する。未作成の場合は既定の設定で作成する
+
+        Returns:
+            CooccurrenceModel: モデル
+        """
+        if self._cooccurrence_model is None:
+            self.fit_cooccurrence()
+        return self._cooccurrence_model
+
+    def build_ann_index(self, object_type: str, n_tables: int = 8, n_bits: int = 12,
+                        seed: int = 0) -> RandomProjectionLSH:
+        """類似ユーザ(アイテム)の近似最近傍探索に使うインデックスを作成する。
+        評価値は平均評価値を引いて中心化し、未評価は0とみなして射影する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            n_tables (int, optional): ハッシュテーブル数。増やすと再現率が上がり、検索は遅くなる
+            n_bits (int, optional): 1テーブルあたりのビット数。増やすと候補が減り、検索は速くなる
+            seed (int, optional): 乱数のシード
+
+        Returns:
+            RandomProjectionLSH: 作成したインデックス
+        """
+        if self.storage == 'sparse':
+            m = self.matrix
+        else:
+            row, col = np.where(self.matrix != self.missing_value)
+            m = SparseRatingMatrix.from_triplets(
+                row, col, self.matrix[row, col], self.matrix.shape)
+        if object_type == 'user':
+            data = m.data - self._user_mean[m.row_of_entries()]
+            index = RandomProjectionLSH(n_tables, n_bits, seed).fit(
+                m.indptr, m.indices, data, m.shape[1])
+        elif object_type == 'item':
+            cols = np.repeat(np.arange(m.shape[1]), m.col_counts())
+            data = m.col_data - self._item_mean[cols]
+            index = RandomProjectionLSH(n_tables, n_bits, seed).fit(
+                m.col_indptr, m.col_indices, data, m.shape[0])
+        self._ann_index[object_type] = index
+        return index
+
+    def _get_centered_ratings(self, object_type: str, object_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """指定されたユーザ(アイテム)の評価済みindexと、平均評価値を引いて中心化した評価値を返却する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (int): ユーザ(アイテム)のindex
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 評価済みのアイテム(ユーザ)indexと中心化した評価値
+        """
+        if object_type == 'user':
+            indices, values = self._get_observed_ratings_for_one_user(
+                object_idx)
+            return indices, values - self._user_mean[object_idx]
+        elif object_type == 'item':
+            indices, values = self._get_observed_ratings_for_one_item(
+                object_idx)
+            return indices, values - self._item_mean[object_idx]
+
+    def _get_similar_objects_approximately(self, object_type: str, object_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """近似最近傍探索のインデックスで候補を絞り込み、候補についてのみ類似度を計算する
+
+        Args:
+            object_type (str): 'user' or 'item'
+            object_idx (int): 類似リストを取得したいユーザ(アイテム)のindex
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 候補のindexと類似度
+        """
+        if object_type not in self._ann_index:
+            raise Exception(
+                "ANN index for {} is not built.".format(object_type))
+        candidates = self._ann_index[object_type].query_candidates(
+            *self._get_centered_ratings(object_type, object_idx))
+        query = self._get_rating_vectors(object_type, np.array([object_idx]))
+        dimension_means = self._get_dimension_means(object_type, self.metric)
+        if self.storage == 'sparse':
+            # 候補の評価済みの要素だけを走査して類似度を計算する
+            m = self.matrix
+            if object_type == 'user':
+                compressed = (m.indptr, m.indices, m.data)
+            elif object_type == 'item':
+                compressed = (m.col_indptr, m.col_indices, m.col_data)
+            sim_list = calc_similarity_vector_with_sparse_rows(
+                query[0], query[0] != self.missing_value, *compressed, candidates, self.metric,
+                dimension_means)
+            if self._shrinks_similarity():
+                counts = calc_co_rating_count_vector_with_sparse_rows(
+                    query[0] != self.missing_value, compressed[0], compressed[1], candidates)
+        else:
+            vectors = self._get_rating_vectors(object_type, candidates)
+            sim_list = calc_similarity_vector_with_missing_value(
+                query[0], vectors, self.metric, self.missing_value, dimension_means)
+            if self._shrinks_similarity():
+                counts = calc_co_rating_count_matrix(
+                    query, vectors, self.missing_value)[0]
+        if self._shrinks_similarity():
+            sim_list = shrink_similarity(
+                sim_list, counts, self.shrinkage, self.min_overlap)
+        return candidates, sim_list
+
+    def _get_similar_objects(self, object_type: str, object_name: str,
+                             top_n: int = 0, approximate: bool = False) -> List[List[Union[str, float]]]:
         """類似度が高いユーザ(アイテム)とその類似度のリストを、類似度の降順に返却する
 
         Args:
             object_type (str): ユーザかアイテムかを指定
             object_name (str): 類似リストを取得したいユーザ(アイテム)
+            top_n (int, optional): 上位n件のみを取得
+            approximate (bool, optional): build_ann_indexで作成したインデックスで近似的に探索する。
+                既定は全件走査による厳密な探索
 
         Returns:
             List[List[Union[str, float]]]: 類似ユーザ(アイテム)と類似度のリスト
         """
-        v1 = self._get_ratings_for_one_object(object_type, object_name)
-        sim_list = []
         if object_type == 'user':
-            object_list = self._get_user_list()
+            table = self._users
         elif object_type == 'item':
-            object_list = self._get_item_list()
-        for key in object_list:
-            v2 = self._get_ratings_for_one_object(object_type, key)
-            sim = calc_similarity_with_missing_value(
-                v1, v2, 'euclidean', self.missing_value)
-            sim_list.append(sim)
-        idx = np.argsort(np.array(sim_list))[::-1]
-        object_sim = []
-        for i in idx:
-            object_sim.append([object_list[i], sim_list[i]])
-        return object_sim
+            table = self._items
+        object_idx = table[object_name]
+        if approximate:
+            candidates, sim_list = self._get_similar_objects_approximately(
+                object_type, object_idx)
+        else:
+            sim_list = self._get_similarity_row(object_type, object_idx)
+            candidates = np.arange(len(sim_list))
+        idx = _select_top_n(sim_list, top_n)
+        return [list(pair) for pair in zip(table.decode(candidates[idx]), sim_list[idx].tolist())]
 
     def _get_item_list_not_rated_by(self, user_name: str) -> List[str]:
         """対象ユーザが未評価であるアイテムのリスト
@@ -161,9 +1332,21 @@ class Recommendation:
         Returns:
             List[str]: アイテムのリスト
         """
-        ratings = self._get_ratings_for_one_user(user_name)
-        idx = np.where(ratings == self.missing_value)[0]
-        return np.array(self._item_list)[idx].tolist()
+        return self._items.decode(self._get_item_idx_not_rated_by(self._users[user_name]))
+
+    def _get_item_idx_not_rated_by(self, user_idx: int) -> np.ndarray:
+        """対象ユーザが未評価であるアイテムのindex
+
+        Args:
+            user_idx (int): 対象ユーザのindex
+
+        Returns:
+            np.ndarray: アイテムのindex
+        """
+        rated_idx, _ = self._get_observed_ratings_for_one_user(user_idx)
+        not_rated = np.ones(len(self._items), dtype=bool)
+        not_rated[rated_idx] = False
+        return np.where(not_rated)[0]
 
     def _get_item_list_rated_by(self, user_name: str) -> List[str]:
         """対象ユーザが評価済みであるアイテムのリスト
@@ -174,68 +1357,248 @@ class Recommendation:
         Returns:
             List[str]: アイテムのリスト
         """
-        ratings = self._get_ratings_for_one_user(user_name)
-        idx = np.where(ratings != self.missing_value)[0]
-        return np.array(self._item_list)[idx].tolist()
+        idx, _ = self._get_observed_ratings_for_one_user(
+            self._users[user_name])
+        return self._items.decode(idx)
 
-    def _predict_ratings(self, user_name: str, based: str, debiasing: bool = True) -> Dict[str, float]:
+    def _predict_ratings(self, user_name: str, based: str, debiasing: Union[bool, str] = True) -> Dict[str, float]:
         """対象ユーザの未評価アイテム集合の評価値を予測
 
         Args:
             user_name (str): 対象ユーザ
-            based (str): user or item
-            debiasing (bool, optional): バイアス除去フラグ
+            based (str): user, item, mf, baseline or cooccurrence
+            debiasing (Union[bool, str], optional): バイアス除去フラグ
 
         Returns:
             Dict[str, float]: 未評価のアイテム集合とそれらの予測評価値
         """
-        predictions = {}
-        unrated_item_list = self._get_item_list_not_rated_by(user_name)
-        if based == 'user':
-            user_bias = self._get_average_rating_for_one_user(
-                user_name) if debiasing else 0.0
-            for unrated_item_name in unrated_item_list:
-                user_list = self._get_user_who_rated_item(unrated_item_name)
-                sum_similarity: float = 0.0
-                weighted_sum: float = 0.0
-                for other_user_name in user_list:  # 定義から、自分自身は含まれない
-                    similarity = self._calc_similarity_with_missing_value_by_name(
-                        'user', user_name, other_user_name)
-                    rating = self._get_rating(
-                        other_user_name, unrated_item_name)
-                    if debiasing:
-                        rating -= self._get_average_rating_for_one_user(
-                            other_user_name)
-                    weighted_sum += similarity * rating
-                    sum_similarity += abs(similarity)
-                prediction: float = user_bias
-                if sum_similarity != 0.0:
-                    prediction += weighted_sum / sum_similarity
-                predictions[unrated_item_name] = prediction
-        elif based == 'item':
-            rated_item_list = self._get_item_list_rated_by(user_name)
-            for unrated_item_name in unrated_item_list:
-                item_bias = self._get_average_rating_for_one_item(
-                    unrated_item_name) if debiasing else 0.0
-                sum_similarity: float = 0.0
-                weighted_sum: float = 0.0
-                for rated_item_name in rated_item_list:
-                    similarity = self._calc_similarity_with_missing_value_by_name(
-                        'item', unrated_item_name, rated_item_name)
-                    rating = self._get_rating(user_name, rated_item_name)
-                    if debiasing:
-                        rating -= self._get_average_rating_for_one_item(
-                            rated_item_name)
-                    weighted_sum += similarity * rating
-                    sum_similarity += abs(similarity)
-                prediction: float = item_bias
-                if sum_similarity != 0.0:
-                    prediction += weighted_sum / sum_similarity
-                predictions[unrated_item_name] = prediction
+        user_idx = self._users[user_name]
+        predictions = self._predict_ratings_vector(user_idx, based, debiasing)
+        idx = self._get_item_idx_not_rated_by(user_idx)
+        return dict(zip(self._items.decode(idx), predictions[idx].tolist()))
+
+    def _predict_ratings_vector(self, user_idx: int, based: str, debiasing: Union[bool, str] = True,
+                                candidate_mask: np.ndarray = None) -> np.ndarray:
+        """対象ユーザの全アイテムの評価値を予測し、ベクトルとして返却する
+
+        Args:
+            user_idx (int): 対象ユーザのindex
+            based (str): user, item, mf, baseline or cooccurrence
+            debiasing (Union[bool, str], optional): バイアス除去フラグ
+            candidate_mask (np.ndarray, optional): 予測するアイテムのマスク。省略時は全アイテム
+
+        Returns:
+            np.ndarray: 予測評価値のベクトル。評価済みのアイテムと候補外のアイテムはnan
+        """
+        if based == 'user' and debiasing is True and self.cold_start is None:
+            # 評価済みアイテムがないユーザはバイアスを計算できないため、ここで例外を送出する
+            self._get_user_average_rating(user_idx)
+        user_idx = np.array([user_idx])
+        if candidate_mask is None:
+            return self._predict_ratings_matrix(user_idx, based, debiasing)[0]
+        return self._predict_candidate_ratings(user_idx, based, debiasing, candidate_mask[np.newaxis])[0]
+
+    def _predict_candidate_ratings(self, user_idx: np.ndarray, based: str, debiasing: Union[bool, str],
+                                   candidate_mask: np.ndarray) -> np.ndarray:
+        """対象ユーザ群の候補アイテムの評価値だけを予測する。
+        類似度の計算と予測はいずれかのユーザの候補となっているアイテムの列に限って行う
+
+        Args:
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+            based (str): user, item, mf, baseline or cooccurrence
+            debiasing (Union[bool, str]): バイアス除去フラグ
+            candidate_mask (np.ndarray): ユーザごとの候補アイテムのマスク (len(user_idx), アイテム数)
+
+        Returns:
+            np.ndarray: 予測評価値 (len(user_idx), アイテム数)。評価済みのアイテムと候補外のアイテムはnan
+        """
+        item_idx = np.where(candidate_mask.any(axis=0))[0]
+        predictions = np.full(candidate_mask.shape, np.nan)
+        if len(item_idx) > 0:
+            predictions[:, item_idx] = self._predict_ratings_matrix(user_idx, based, debiasing, item_idx)
+        predictions[~candidate_mask] = np.nan
         return predictions
 
+    def _get_candidate_mask(self, user_idx: np.ndarray, allow: Iterable[str] = None, deny: Iterable[str] = None,
+                            candidates: Callable[['Recommendation', np.ndarray], np.ndarray] = None) -> np.ndarray:
+        """推薦の候補とするアイテムのマスクを作成する。条件を指定しない場合はNone
+
+        Args:
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+            allow (Iterable[str], optional): 候補とするアイテム。未知のアイテムは無視する
+            deny (Iterable[str], optional): 候補から除くアイテム。未知のアイテムは無視する
+            candidates (Callable[[Recommendation, np.ndarray], np.ndarray], optional):
+                推薦器と対象ユーザのindexの配列を受け取り、ユーザごとの候補アイテムのマスクを返す関数
+
+        Returns:
+            np.ndarray: 候補アイテムのマスク (len(user_idx), アイテム数)
+        """
+        if allow is None and deny is None and candidates is None:
+            return None
+        n_items = len(self._items)
+        item_mask = np.ones(n_items, dtype=bool)
+        if allow is not None:
+            item_mask[:] = False
+            item_mask[[idx for idx in map(self._items.get, allow) if idx is not None]] = True
+        if deny is not None:
+            item_mask[[idx for idx in map(self._items.get, deny) if idx is not None]] = False
+        mask = np.repeat(item_mask[np.newaxis, :], len(user_idx), axis=0)
+        if candidates is not None:
+            mask &= candidates(self, user_idx)
+        return mask
+
+    @registry.timed('predict')
+    def _predict_ratings_matrix(self, user_idx: np.ndarray, based: str,
+                                debiasing: Union[bool, str] = True, item_idx: np.ndarray = None) -> np.ndarray:
+        """対象ユーザ群の全アイテムの評価値を行列演算でまとめて予測する。
+        類似度で重み付けした(バイアス除去済みの)評価値の和を、類似度の絶対値の和で正規化する。
+        n_neighborsが正の場合は、予測ごとに類似度が上位n_neighbors件の近傍のみを使う。
+        fit_neighborsで近傍リストを作成済みの場合は、n_neighborsより優先してその近傍のみを使う。
+        based='mf'の場合は行列分解の因子の積で、based='baseline'の場合はベースライン推定値で予測する。
+        based='cooccurrence'の場合は評価済みアイテムとの共起行列の値の和をスコアとする。
+        cold_startが指定されている場合、評価のないユーザはcold_startの方法で予測する。
+        item_idxを指定した場合は、そのアイテムの列だけを予測する
+
+        Args:
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+            based (str): user, item, mf, baseline or cooccurrence
+            debiasing (Union[bool, str], optional): バイアス除去フラグ。
+                'baseline'の場合は、平均評価値の代わりにベースライン推定値を引いてから近傍で予測する
+            item_idx (np.ndarray, optional): 予測するアイテムのindex。省略時は全アイテム
+
+        Returns:
+            np.ndarray: 予測評価値 (len(user_idx), アイテム数) または (len(user_idx), len(item_idx))。評価済みのアイテムはnan
+        """
+        user_idx = np.asarray(user_idx, dtype=np.int64)
+        values, mask = self._get_observed_block(user_idx)
+        n_items = len(self._items)
+        columns = slice(None) if item_idx is None else item_idx
+        if based == 'mf':
+            predictions = self._get_factor_model().predict(user_idx, n_items, item_idx)
+        elif based == 'baseline':
+            predictions = self._get_baseline_model().predict(user_idx, n_items, item_idx)
+        elif based == 'cooccurrence':
+            rows, items = np.nonzero(mask)
+            predictions = self._get_cooccurrence_model().predict(rows, items, len(user_idx), n_items, item_idx)
+        elif based in ('user', 'item'):
+            user_offset, item_offset = self._get_rating_offsets(
+                based, debiasing)
+            weighted_sum, sum_similarity = self._sum_neighbors(
+                user_idx, based, user_offset, item_offset, values, mask, item_idx)
+            bias = user_offset[user_idx][:, np.newaxis] + \
+                item_offset[np.newaxis, columns]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                predictions = bias + np.where(sum_similarity != 0,
+                                              weighted_sum / sum_similarity, 0.0)
+        else:
+            raise Exception("Unknown based: {}".format(based))
+        if self.cold_start is not None and based != self.cold_start:
+            cold = self._user_rating_count[user_idx] == 0
+            if np.any(cold):
+                predictions[cold] = self._predict_ratings_matrix(
+                    user_idx[cold], self.cold_start, debiasing, item_idx)
+        predictions[mask[:, columns]] = np.nan
+        return predictions
+
+    @registry.timed('offsets')
+    def _get_rating_offsets(self, based: str, debiasing: Union[bool, str]) -> Tuple[np.ndarray, np.ndarray]:
+        """近傍による予測で評価値から引くバイアスを、ユーザごとの値とアイテムごとの値の和として返却する。
+        ユーザベースではユーザの平均評価値、アイテムベースではアイテムの平均評価値、
+        'baseline'ではμ + b_u + b_iを引く
+
+        Args:
+            based (str): user or item
+            debiasing (Union[bool, str]): バイアス除去フラグ
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: ユーザごとの値とアイテムごとの値
+        """
+        n_users, n_items = len(self._users), len(self._items)
+        if debiasing == 'baseline':
+            model = self._get_baseline_model()
+            user_bias, item_bias = model.get_biases(n_users, n_items)
+            return model.global_mean + user_bias, item_bias
+        elif not debiasing:
+            return np.zeros(n_users), np.zeros(n_items)
+        elif based == 'user':
+            return self._get_average_ratings('user'), np.zeros(n_items)
+        elif based == 'item':
+            return np.zeros(n_users), self._get_average_ratings('item')
+
+    @registry.timed('neighbors')
+    def _sum_neighbors(self, user_idx: np.ndarray, based: str, user_offset: np.ndarray, item_offset: np.ndarray,
+                       values: np.ndarray, mask: np.ndarray,
+                       item_idx: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """近傍の(バイアス除去済みの)評価値を類似度で重み付けした和と、類似度の絶対値の和を計算する。
+        item_idxを指定した場合は、そのアイテムの列だけを計算する
+
+        Args:
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+            based (str): user or item
+            user_offset (np.ndarray): 評価値から引くユーザごとの値
+            item_offset (np.ndarray): 評価値から引くアイテムごとの値
+            values (np.ndarray): 対象ユーザ群の評価値 (対象ユーザ数, アイテム数)
+            mask (np.ndarray): 対象ユーザ群の評価済みマスク (対象ユーザ数, アイテム数)
+            item_idx (np.ndarray, optional): 計算するアイテムのindex。省略時は全アイテム
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 類似度で重み付けした評価値の和と、類似度の絶対値の和
+        """
+        if registry.enabled:
+            # 予測対象1件あたりの近傍の候補数 × 対象ユーザ数を数える
+            n_candidates = self._get_n_objects(based)
+            if based in self._neighbors:
+                n_candidates = self._neighbors[based][0].shape[1]
+            elif self.n_neighbors > 0:
+                n_candidates = min(self.n_neighbors, n_candidates)
+            registry.increment('neighbors_considered', len(user_idx) * n_candidates)
+        columns = slice(None) if item_idx is None else item_idx
+        if based == 'user':
+            if 'user' in self._neighbors:
+                weighted_sum, sum_similarity = self._sum_fitted_user_neighbors(user_idx, user_offset, item_offset)
+                return weighted_sum[:, columns], sum_similarity[:, columns]
+            # 候補のアイテムを指定した場合、密行列で類似度行列をまだ計算していなければ、
+            # 行列全体を作らずに対象ユーザの行だけを計算する
+            if item_idx is not None and self.storage == 'dense' and ('user', self.metric) not in self._similarity_cache:
+                similarities = self._calc_similarity_rows('user', user_idx, self.metric)
+            else:
+                similarities = self._get_similarity_rows('user', user_idx)
+            if self.storage == 'sparse':
+                cols = np.repeat(
+                    np.arange(self.matrix.shape[1]), self.matrix.col_counts())
+                deviations = self.matrix.col_data - \
+                    user_offset[self.matrix.col_indices] - item_offset[cols]
+                if self.n_neighbors > 0:
+                    weighted_sum, sum_similarity = self._sum_user_neighbors_sparse(similarities, deviations)
+                    return weighted_sum[:, columns], sum_similarity[:, columns]
+                return (self.matrix.left_matmul(similarities, deviations, item_idx),
+                        self.matrix.left_matmul(np.abs(similarities), np.ones(self.matrix.nnz), item_idx))
+            matrix = self.matrix[:, columns]
+            observed = matrix != self.missing_value
+            deviations = np.where(observed, matrix - user_offset[:, np.newaxis] -
+                                  item_offset[np.newaxis, columns], 0)
+            if self.n_neighbors > 0:
+                return self._sum_user_neighbors_dense(similarities, deviations, observed)
+            return similarities @ deviations, np.abs(similarities) @ observed
+        deviations = np.where(mask, values - user_offset[user_idx][:, np.newaxis] -
+                              item_offset[np.newaxis, :], 0)
+        if 'item' in self._neighbors:
+            weighted_sum, sum_similarity = self._sum_fitted_item_neighbors(deviations, mask)
+            return weighted_sum[:, columns], sum_similarity[:, columns]
+        # 候補のアイテムを指定した場合は、その行の類似度だけを使う。
+        # 密行列で類似度行列をまだ計算していない場合は、行列全体を作らずに候補の行だけを計算する
+        if item_idx is None:
+            similarities = self._get_similarity_matrix('item')
+        elif self.storage == 'dense' and ('item', self.metric) not in self._similarity_cache:
+            similarities = self._calc_similarity_rows('item', item_idx, self.metric)
+        else:
+            similarities = self._get_similarity_rows('item', item_idx)
+        if self.n_neighbors > 0:
+            return self._sum_item_neighbors(similarities, deviations, mask)
+        return deviations @ similarities.T, mask @ np.abs(similarities).T
+
     def _get_average_rating_for_one_user(self, user_name: str) -> float:
-        """対象ユーザの評価済みアイテムの平均評価値を計算する
+        """対象ユーザの評価済みアイテムの平均評価値を返却する
 
         Args:
             user_name (str): 対象ユーザ
@@ -243,14 +1606,23 @@ class Recommendation:
         Returns:
             float: 平均評価値
         """
-        array = self._get_ratings_for_one_user(user_name)
-        idx = np.where(array != self.missing_value)[0]
-        if len(idx) == 0:
+        return self._get_user_average_rating(self._users[user_name])
+
+    def _get_user_average_rating(self, user_idx: int) -> float:
+        """対象ユーザの評価済みアイテムの平均評価値を返却する
+
+        Args:
+            user_idx (int): 対象ユーザのindex
+
+        Returns:
+            float: 平均評価値
+        """
+        if self._user_rating_count[user_idx] == 0:
             raise Exception("There is no item evaluated by the target user.")
-        return array[idx].mean()
+        return float(self._user_mean[user_idx])
 
     def _get_average_rating_for_one_item(self, item_name: str) -> float:
-        """対象アイテムの平均評価値を計算する
+        """対象アイテムの平均評価値を返却する
 
         Args:
             item_name (str): 対象アイテム
@@ -258,9 +1630,7 @@ class Recommendation:
         Returns:
             float: 平均評価値
         """
-        array = self._get_ratings_for_one_item(item_name)
-        idx = np.where(array != self.missing_value)[0]
-        return array[idx].mean()
+        return float(self._item_mean[self._items[item_name]])
 
     def _get_user_who_rated_item(self, item_name: str) -> List[str]:
         """対象アイテムを評価したユーザのリスト
@@ -271,9 +1641,9 @@ class Recommendation:
         Returns:
             List[str]: ユーザのリスト
         """
-        ratings = self._get_ratings_for_one_item(item_name)
-        idx = np.where(ratings != self.missing_value)[0]
-        return np.array(self._user_list)[idx].tolist()
+        idx, _ = self._get_observed_ratings_for_one_item(
+            self._items[item_name])
+        return self._users.decode(idx)
 
     def _get_rating(self, user_name: str, item_name: str) -> float:
         """対象ユーザの対象アイテムに対する評価値を取得する
@@ -285,57 +1655,493 @@ class Recommendation:
         Returns:
             float: 評価値
         """
-        return self.ratings_dict[user_name][item_name]
+        rating = self._get_ratings_by_index(
+            np.array([self._users[user_name]]), np.array([self._items[item_name]]))[0]
+        if np.isnan(rating):
+            raise Exception("The target user has not rated the target item.")
+        return float(rating)
+
+    def _get_ratings_by_index(self, user_idx: np.ndarray, item_idx: np.ndarray) -> np.ndarray:
+        """(ユーザ, アイテム)の組ごとの評価値を返却する。未評価の場合はnanとする
+
+        Args:
+            user_idx (np.ndarray): ユーザのindex
+            item_idx (np.ndarray): アイテムのindex
+
+        Returns:
+            np.ndarray: 評価値
+        """
+        if self.storage == 'sparse':
+            return np.array([self.matrix.get(u, i, np.nan) for u, i in zip(user_idx, item_idx)],
+                            dtype=np.float64)
+        ratings = self.matrix[user_idx, item_idx]
+        return np.where(ratings != self.missing_value, ratings, np.nan)
+
+    def _resize_array(self, name: str, shape: Tuple[int, ...], fill_value: float):
+        """属性nameの配列をshapeに拡張する。容量を倍々に確保したバッファのビューとして保持し、
+        1件ずつの追加でも償却O(1)で拡張できるようにする
+
+        Args:
+            name (str): 属性名
+            shape (Tuple[int, ...]): 新しいサイズ
+            fill_value (float): 拡張した要素に入れる値
+        """
+        setattr(self, name, self._grow_buffer(name, getattr(self, name), shape, fill_value))
+
+    def _grow_buffer(self, key: Hashable, array: np.ndarray, shape: Tuple[int, ...],
+                     fill_value: float) -> np.ndarray:
+        """配列をshapeに拡張したビューを返却する。容量を倍々に確保したバッファを_buffers[key]に保持し、
+        容量が足りる間はコピーせずにビューを広げる
+
+        Args:
+            key (Hashable): バッファのkey
+            array (np.ndarray): 拡張する配列。前回この関数が返したビューか、新しい配列
+            shape (Tuple[int, ...]): 新しいサイズ
+            fill_value (float): 拡張した要素に入れる値
+
+        Returns:
+            np.ndarray: バッファのビュー
+        """
+        buffer = self._buffers.get(key)
+        if buffer is None or (array is not buffer and array.base is not buffer):
+            buffer = array
+        if any(c < n for c, n in zip(buffer.shape, shape)):
+            capacity = tuple(max(n, 2 * c) if c < n else c
+                             for c, n in zip(buffer.shape, shape))
+            buffer = np.full(capacity, fill_value, dtype=array.dtype)
+            buffer[tuple(slice(0, n) for n in array.shape)] = array
+        self._buffers[key] = buffer
+        return buffer[tuple(slice(0, n) for n in shape)]
+
+    def add_user(self, user_name: str) -> int:
+        """評価のないユーザを追加する。既に存在する場合は何もしない
+
+        Args:
+            user_name (str): 追加するユーザ
+
+        Returns:
+            int: ユーザのindex
+        """
+        if user_name in self._users:
+            return self._users[user_name]
+        self._check_writable()
+        user_idx = self._users.add(user_name)
+        if self._ratings_dict is not None:
+            self._ratings_dict[user_name] = {}
+        n_users, n_items = user_idx + 1, len(self._items)
+        if self.storage == 'sparse':
+            self.matrix.resize((n_users, n_items))
+        else:
+            self._resize_array('matrix', (n_users, n_items), self.missing_value)
+        self._resize_array('_user_rating_sum', (n_users,), 0)
+        self._resize_array('_user_rating_count', (n_users,), 0)
+        self._resize_array('_user_mean', (n_users,), np.nan)
+        return user_idx
+
+    def add_item(self, item_name: str) -> int:
+        """評価のないアイテムを追加する。既に存在する場合は何もしない
+
+        Args:
+            item_name (str): 追加するアイテム
+
+        Returns:
+            int: アイテムのindex
+        """
+        if item_name in self._items:
+            return self._items[item_name]
+        self._check_writable()
+        item_idx = self._items.add(item_name)
+        n_users, n_items = len(self._users), item_idx + 1
+        if self.storage == 'sparse':
+            self.matrix.resize((n_users, n_items))
+        else:
+            self._resize_array('matrix', (n_users, n_items), self.missing_value)
+        self._resize_array('_item_rating_sum', (n_items,), 0)
+        self._resize_array('_item_rating_count', (n_items,), 0)
+        self._resize_array('_item_mean', (n_items,), np.nan)
+        # 全ユーザの推薦の候補が変わる
+        self._invalidate_results()
+        return item_idx
+
+    def add_rating(self, user_name: str, item_name: str, rating: float):
+        """評価値を追加する。評価済みの場合は更新し、未知のユーザ・アイテムは追加する
+
+        Args:
+            user_name (str): 対象ユーザ
+            item_name (str): 対象アイテム
+            rating (float): 評価値
+        """
+        self.add_ratings([user_name], [item_name], [rating])
+
+    def add_ratings(self, user_names: List[str], item_names: List[str], ratings: List[float]):
+        """評価値をまとめて追加する。同じ組が複数ある場合は最後の評価値を採用する。
+        疎行列では新しい要素を差分に溜め、差分が大きくなったときにまとめて圧縮形式へ統合する
+
+        Args:
+            user_names (List[str]): 対象ユーザのリスト
+            item_names (List[str]): 対象アイテムのリスト
+            ratings (List[float]): 評価値のリスト
+        """
+        self._check_writable()
+        user_idx = np.array([self.add_user(user_name)
+                            for user_name in user_names], dtype=np.int64)
+        item_idx = np.array([self.add_item(item_name)
+                            for item_name in item_names], dtype=np.int64)
+        ratings = np.asarray(ratings, dtype=np.float64)
+        if self.implicit:
+            ratings = np.ones(len(ratings))
+        if self.storage == 'dense' and np.any(ratings == self.missing_value):
+            raise Exception("A rating equal to missing_value cannot be stored.")
+        self._validate_ratings(ratings)
+        keep = last_occurrence(user_idx * len(self._items) + item_idx)
+        user_idx, item_idx, ratings = user_idx[keep], item_idx[keep], ratings[keep]
+        old_ratings = self._get_ratings_by_index(user_idx, item_idx)
+        if self.storage == 'sparse':
+            self.matrix.set_values(user_idx, item_idx, ratings)
+        else:
+            self.matrix[user_idx, item_idx] = ratings
+        self._update_rating_statistics(user_idx, item_idx, ratings - np.nan_to_num(old_ratings),
+                                       np.isnan(old_ratings).astype(np.int64))
+        if self._ratings_dict is not None:
+            for user_name, item_name, rating in zip(self._users.decode(user_idx), self._items.decode(item_idx),
+                                                    ratings.tolist()):
+                self._ratings_dict[user_name][item_name] = rating
+        self._invalidate_similarity('user', user_idx)
+        self._invalidate_similarity('item', item_idx)
+        self._invalidate_results(user_idx)
 
-    def get_recommendations(self, user_name: str, based: str = 'user', top_n: int = 0) -> List[str]:
-        """予測評価値を利用して、ユーザに対する推薦リストを提示する関数
+    def remove_rating(self, user_name: str, item_name: str):
+        """評価値を削除する
+
+        Args:
+            user_name (str): 対象ユーザ
+            item_name (str): 対象アイテム
+        """
+        self._check_writable()
+        user_idx = np.array([self._users[user_name]])
+        item_idx = np.array([self._items[item_name]])
+        old_ratings = self._get_ratings_by_index(user_idx, item_idx)
+        if np.isnan(old_ratings[0]):
+            raise Exception("The target user has not rated the target item.")
+        if self.storage == 'sparse':
+            self.matrix.remove_values(user_idx, item_idx)
+        else:
+            self.matrix[user_idx, item_idx] = self.missing_value
+        self._update_rating_statistics(
+            user_idx, item_idx, -old_ratings, np.array([-1]))
+        if self._ratings_dict is not None:
+            del self._ratings_dict[user_name][item_name]
+        self._invalidate_similarity('user', user_idx)
+        self._invalidate_similarity('item', item_idx)
+        self._invalidate_results(user_idx)
+
+    @registry.timed('get_recommendations')
+    def get_recommendations(self, user_name: str, based: str = 'user', top_n: int = 0,
+                            debiasing: Union[bool, str] = True, allow: Iterable[str] = None,
+                            deny: Iterable[str] = None,
+                            candidates: Callable[['Recommendation', np.ndarray], np.ndarray] = None) -> List[str]:
+        """予測評価値を利用して、ユーザに対する推薦リストを提示する関数。
+        cache_sizeが正の場合は結果をキャッシュし、評価値の更新やモデルの学習し直しで無効化する。
+        allow、deny、candidatesを指定した場合は、候補のアイテムだけを予測し、結果はキャッシュしない
 
         Args:
             user_name (str): 対象ユーザ
             based ([str], optional): ユーザまたはアイテム
             top_n (int, optional): 上位n件のみを取得
+            debiasing (Union[bool, str], optional): バイアス除去フラグ
+            allow (Iterable[str], optional): 推薦してよいアイテム
+            deny (Iterable[str], optional): 推薦しないアイテム
+            candidates (Callable[[Recommendation, np.ndarray], np.ndarray], optional):
+                候補アイテムのマスクを返す関数 (candidates.PopularItemsなど)
 
         Returns:
             List[str]: 予測評価値で降順ソートされたアイテムのリスト
         """
-        ratings = self._predict_ratings(user_name, based)
-        sorted_items = [k for k, _ in sorted(
-            ratings.items(), key=lambda ratings: ratings[1], reverse=True)]
-        if top_n != 0 and len(sorted_items) > top_n:
-            sorted_items = sorted_items[:top_n]
-        return sorted_items
+        user_idx = self._users[user_name]
+        candidate_mask = self._get_candidate_mask(np.array([user_idx]), allow, deny, candidates)
+        if candidate_mask is not None:
+            predictions = self._predict_ratings_vector(user_idx, based, debiasing, candidate_mask[0])
+            return self._sort_items_by_prediction(predictions, top_n)
+        if self._result_cache is None:
+            predictions = self._predict_ratings_vector(user_idx, based, debiasing)
+            return self._sort_items_by_prediction(predictions, top_n)
+        key = (user_name, based, top_n, debiasing)
+        recommendations = self._result_cache.get(key)
+        registry.increment('result_cache_misses' if recommendations is None else 'result_cache_hits')
+        if recommendations is None:
+            generation = self._result_cache.generation
+            predictions = self._predict_ratings_vector(user_idx, based, debiasing)
+            recommendations = self._sort_items_by_prediction(predictions, top_n)
+            self._result_cache.put(key, recommendations, generation)
+        # 呼び出し側での変更がキャッシュに及ばないように複製して返す
+        return list(recommendations)
+
+    def _invalidate_results(self, user_idx: np.ndarray = None):
+        """評価値の更新に合わせて推薦結果のキャッシュを無効化する。
+        近傍による推薦は類似度と平均評価値を通じて全ユーザの評価値に依存するため全て削除する。
+        行列分解、ベースライン推定、共起行列のモデルは学習し直すまで変わらないため、評価値が更新されたユーザの分だけ削除する
+
+        Args:
+            user_idx (np.ndarray, optional): 評価値が更新されたユーザのindex。省略時は全て削除する
+        """
+        if self._result_cache is None:
+            return
+        if user_idx is None:
+            self._result_cache.invalidate()
+            return
+        user_names = set(self._users.decode(user_idx))
+        self._result_cache.invalidate(
+            lambda key: key[0] in user_names or key[1] in ('user', 'item'))
+
+    def cache_info(self) -> Dict[str, int]:
+        """推薦結果のキャッシュのカウンタを返却する
+
+        Returns:
+            Dict[str, int]: hits, misses, evictions, expirations, invalidations, entries, bytes。
+            キャッシュを使わない場合は空
+        """
+        if self._result_cache is None:
+            return {}
+        return self._result_cache.info()
+
+    def _sum_user_neighbors_dense(self, similarities: np.ndarray, deviations: np.ndarray,
+                                  observed: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """アイテムごとに、評価済みユーザのうち類似度が上位n_neighbors件のユーザだけで重み付き和を計算する(密行列)
+
+        Args:
+            similarities (np.ndarray): 対象ユーザ群と全ユーザとの類似度 (対象ユーザ数, ユーザ数)
+            deviations (np.ndarray): 全ユーザの(バイアス除去済みの)評価値。未評価は0 (ユーザ数, アイテム数)
+            observed (np.ndarray): 評価済みマスク (ユーザ数, アイテム数)
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 類似度で重み付けした評価値の和と、類似度の絶対値の和
+        """
+        n_users = observed.shape[0]
+        weighted_sum = np.zeros((len(similarities), observed.shape[1]))
+        sum_similarity = np.zeros_like(weighted_sum)
+        for row, similarity in enumerate(similarities):
+            weights = np.where(observed, similarity[:, np.newaxis], 0.0)
+            if self.n_neighbors < n_users:
+                # アイテムごとに上位n_neighbors番目の類似度をしきい値とする(同値は含める)
+                candidates = np.where(
+                    observed, similarity[:, np.newaxis], -np.inf)
+                kth = np.partition(candidates, n_users - self.n_neighbors,
+                                   axis=0)[n_users - self.n_neighbors]
+                weights[similarity[:, np.newaxis] < kth] = 0.0
+            weighted_sum[row] = (weights * deviations).sum(axis=0)
+            sum_similarity[row] = np.abs(weights).sum(axis=0)
+        return weighted_sum, sum_similarity
+
+    def _sum_user_neighbors_sparse(self, similarities: np.ndarray,
+                                   deviations: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """アイテムごとに、評価済みユーザのうち類似度が上位n_neighbors件のユーザだけで重み付き和を計算する(疎行列)
+
+        Args:
+            similarities (np.ndarray): 対象ユーザ群と全ユーザとの類似度 (対象ユーザ数, ユーザ数)
+            deviations (np.ndarray): CSCの並びで与える(バイアス除去済みの)評価値
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 類似度で重み付けした評価値の和と、類似度の絶対値の和
+        """
+        n_items = self.matrix.shape[1]
+        cols = np.repeat(np.arange(n_items), self.matrix.col_counts())
+        weighted_sum = np.zeros((len(similarities), n_items))
+        sum_similarity = np.zeros_like(weighted_sum)
+        for row, similarity in enumerate(similarities):
+            weights = similarity[self.matrix.col_indices]
+            # 列ごとに類似度の降順に並べ、上位n_neighbors番目の類似度をしきい値とする(同値は含める)
+            order = np.lexsort((-weights, cols))
+            rank = np.arange(len(order)) - self.matrix.col_indptr[cols[order]]
+            kth_pos = order[rank == self.n_neighbors - 1]
+            kth = np.full(n_items, -np.inf)
+            kth[cols[kth_pos]] = weights[kth_pos]
+            weights = np.where(weights >= kth[cols], weights, 0.0)
+            weighted_sum[row] = np.bincount(
+                cols, weights=weights * deviations, minlength=n_items)
+            sum_similarity[row] = np.bincount(
+                cols, weights=np.abs(weights), minlength=n_items)
+        return weighted_sum, sum_similarity
+
+    def _sum_item_neighbors(self, similarities: np.ndarray, deviations: np.ndarray,
+                            mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """アイテムごとに、対象ユーザの評価済みアイテムのうち類似度が上位n_neighbors件のアイテムだけで重み付き和を計算する
+
+        Args:
+            similarities (np.ndarray): 予測するアイテムと全アイテムとの類似度 (予測するアイテム数, アイテム数)
+            deviations (np.ndarray): 対象ユーザ群の(バイアス除去済みの)評価値。未評価は0 (対象ユーザ数, アイテム数)
+            mask (np.ndarray): 対象ユーザ群の評価済みマスク (対象ユーザ数, アイテム数)
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 類似度で重み付けした評価値の和と、類似度の絶対値の和
+        """
+        weighted_sum = np.zeros((len(deviations), len(similarities)))
+        sum_similarity = np.zeros_like(weighted_sum)
+        for row in range(len(deviations)):
+            rated_idx = np.where(mask[row])[0]
+            weights = similarities[:, rated_idx]
+            if self.n_neighbors < len(rated_idx):
+                # アイテムごとに上位n_neighbors番目の類似度をしきい値とする(同値は含める)
+                kth = np.partition(weights, len(rated_idx) - self.n_neighbors,
+                                   axis=1)[:, len(rated_idx) - self.n_neighbors]
+                weights = np.where(weights >= kth[:, np.newaxis], weights, 0.0)
+            weighted_sum[row] = weights @ deviations[row, rated_idx]
+            sum_similarity[row] = np.abs(weights).sum(axis=1)
+        return weighted_sum, sum_similarity
+
+    def _sum_fitted_item_neighbors(self, deviations: np.ndarray,
+                                   mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """fit_neighborsで作成した近傍リストを使い、対象ユーザの評価済みアイテムを近傍に持つアイテムについてだけ重み付き和を計算する。
+        計算量は評価済みアイテム数とk件の近傍に比例する
+
+        Args:
+            deviations (np.ndarray): 対象ユーザ群の(バイアス除去済みの)評価値。未評価は0 (対象ユーザ数, アイテム数)
+            mask (np.ndarray): 対象ユーザ群の評価済みマスク (対象ユーザ数, アイテム数)
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 類似度で重み付けした評価値の和と、類似度の絶対値の和
+        """
+        lookup = self._neighbor_lookup['item']
+        n_items = deviations.shape[1]
+        weighted_sum = np.zeros(deviations.shape)
+        sum_similarity = np.zeros_like(weighted_sum)
+        for row in range(len(deviations)):
+            # 近傍リスト作成後に追加されたアイテムは近傍を持たない
+            rated_idx = np.where(mask[row, :lookup.shape[0]])[0]
+            starts = lookup.indptr[rated_idx]
+            lengths = lookup.indptr[rated_idx + 1] - starts
+            pos = expand_ranges(starts, lengths)
+            targets = lookup.indices[pos]
+            weights = lookup.data[pos]
+            weighted_sum[row] = np.bincount(
+                targets, weights=weights * np.repeat(deviations[row, rated_idx], lengths), minlength=n_items)
+            sum_similarity[row] = np.bincount(
+                targets, weights=np.abs(weights), minlength=n_items)
+        return weighted_sum, sum_similarity
+
+    def _sum_fitted_user_neighbors(self, user_idx: np.ndarray, user_offset: np.ndarray,
+                                   item_offset: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """fit_neighborsで作成した近傍リストを使い、対象ユーザごとにk人の近傍ユーザの評価値だけで重み付き和を計算する
+
+        Args:
+            user_idx (np.ndarray): 対象ユーザのindexの配列
+            user_offset (np.ndarray): 評価値から引くユーザごとの値
+            item_offset (np.ndarray): 評価値から引くアイテムごとの値
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 類似度で重み付けした評価値の和と、類似度の絶対値の和
+        """
+        indices, scores = self._neighbors['user']
+        weighted_sum = np.zeros((len(user_idx), len(self._items)))
+        sum_similarity = np.zeros_like(weighted_sum)
+        for row, idx in enumerate(user_idx):
+            if idx >= len(indices):
+                # 近傍リスト作成後に追加されたユーザは近傍を持たない
+                continue
+            neighbor_idx = indices[idx].astype(np.int64)
+            weights = scores[idx].astype(np.float64)
+            values, observed = self._get_observed_block(neighbor_idx)
+            deviations = values - \
+                user_offset[neighbor_idx][:, np.newaxis] - item_offset
+            weighted_sum[row] = weights @ np.where(observed, deviations, 0)
+            sum_similarity[row] = np.abs(weights) @ observed
+        return weighted_sum, sum_similarity
+
+    @registry.timed('get_recommendations_batch')
+    def get_recommendations_batch(self, user_names: List[str], based: str = 'user', top_n: int = 0,
+                                  debiasing: bool = True, block_size: int = 256, allow: Iterable[str] = None,
+                                  deny: Iterable[str] = None,
+                                  candidates: Callable[['Recommendation', np.ndarray], np.ndarray] = None) \
+            -> Dict[str, List[str]]:
+        """複数ユーザに対する推薦リストを、block_size人ずつ行列演算でまとめて計算する。
+        allow、deny、candidatesを指定した場合は、ブロック内のいずれかのユーザの候補となっているアイテムだけを予測する
+
+        Args:
+            user_names (List[str]): 対象ユーザのリスト
+            based (str, optional): ユーザまたはアイテム
+            top_n (int, optional): 上位n件のみを取得
+            debiasing (bool, optional): バイアス除去フラグ
+            block_size (int, optional): 一度に計算するユーザ数
+            allow (Iterable[str], optional): 推薦してよいアイテム
+            deny (Iterable[str], optional): 推薦しないアイテム
+            candidates (Callable[[Recommendation, np.ndarray], np.ndarray], optional): 候補アイテムのマスクを返す関数
+
+        Returns:
+            Dict[str, List[str]]: ユーザごとの、予測評価値で降順ソートされたアイテムのリスト。
+            評価済みアイテムがないユーザをバイアス除去して予測する場合は空リスト
+        """
+        if allow is not None or deny is not None or candidates is not None:
+            # 候補の条件はユーザのブロックごとに評価するため、集合にしておく
+            allow = set(allow) if allow is not None else None
+            deny = set(deny) if deny is not None else None
+            recommendations = {}
+            for start in range(0, len(user_names), block_size):
+                block = user_names[start:start + block_size]
+                user_idx = self._users.encode(block)
+                predictions = self._predict_candidate_ratings(
+                    user_idx, based, debiasing, self._get_candidate_mask(user_idx, allow, deny, candidates))
+                for user_name, prediction in zip(block, predictions):
+                    recommendations[user_name] = self._sort_items_by_prediction(prediction, top_n)
+            return {user_name: recommendations[user_name] for user_name in user_names}
+        recommendations = {}
+        targets = user_names
+        if self._result_cache is not None:
+            generation = self._result_cache.generation
+            for user_name in user_names:
+                cached = self._result_cache.get((user_name, based, top_n, debiasing))
+                registry.increment('result_cache_misses' if cached is None else 'result_cache_hits')
+                if cached is not None:
+                    recommendations[user_name] = list(cached)
+            targets = [user_name for user_name in user_names if user_name not in recommendations]
+        for start in range(0, len(targets), block_size):
+            block = targets[start:start + block_size]
+            user_idx = self._users.encode(block)
+            predictions = self._predict_ratings_matrix(
+                user_idx, based, debiasing)
+            for user_name, u, prediction in zip(block, user_idx, predictions):
+                recommendations[user_name] = self._sort_items_by_prediction(
+                    prediction, top_n)
+                # 評価のないユーザはget_recommendationsでは例外となる場合があるため、空リストをキャッシュしない
+                if self._result_cache is not None and self._user_rating_count[u] > 0:
+                    self._result_cache.put((user_name, based, top_n, debiasing),
+                                           list(recommendations[user_name]), generation)
+        return {user_name: recommendations[user_name] for user_name in user_names}
+
+    @registry.timed('sort')
+    def _sort_items_by_prediction(self, prediction: np.ndarray, top_n: int = 0) -> List[str]:
+        """予測評価値ベクトルから、nanを除いたアイテムを予測評価値の降順に並べる
+
+        Args:
+            prediction (np.ndarray): アイテムごとの予測評価値
+            top_n (int, optional): 上位n件のみを取得
+
+        Returns:
+            List[str]: アイテムのリスト
+        """
+        idx = np.where(~np.isnan(prediction))[0]
+        # 同じ予測評価値の場合はアイテムの並び順を保つ
+        idx = idx[_select_top_n(prediction[idx], top_n)]
+        return self._items.decode(idx)
 
     def _calculate_average_ratings(self) -> float:
-        """全ユーザ・全アイテムの評価値の平均を計算し、返却する関数
+        """全ユーザ・全アイテムの評価値の平均を返却する関数
 
         Returns:
             float: 平均評価値
         """
-        ratings = []
-        user_list = self._get_user_list()
-        for user_name in user_list:
-            item_list = self._get_item_list_rated_by(user_name)
-            for item_name in item_list:
-                rating = self._get_rating(user_name, item_name)
-                ratings.append(rating)
-        if len(ratings) == 0:
+        if self._user_rating_count.sum() == 0:
             raise Exception(
                 "The average cannot be calculated because there is no rating.")
-        mu = np.mean(ratings)
-        return mu
+        return float(self._global_mean)
 
-    def _predict_ratings_with_baseline_estimation(self, user_name: str) -> Dict[str, float]:
-        """対象ユーザの未評価アイテム集合の評価値をベースライン推定
+    def _predict_ratings_with_baseline_estimation(self, user_name: str,
+                                                  based: str = 'baseline') -> Dict[str, float]:
+        """対象ユーザの未評価アイテム集合の評価値をベースライン推定 b_ui = μ + b_u + b_i を使って予測する。
+        based='user'、'item'の場合は、評価値からベースライン推定値を引いた残差を近傍で補正する
 
         Args:
             user_name (str): 対象ユーザ
+            based (str, optional): baseline, user or item
         Returns:
             Dict[str, float]: 未評価のアイテム集合とそれらの予測評価値
         """
-        mu = self._calculate_average_ratings()
-        print(mu)
-        unrated_item_list = self._get_item_list_not_rated_by(user_name)
-        for unrated_item_name in unrated_item_list:
-            bias_item = self._get_average_rating_for_one_item(
-                unrated_item_name) - mu
-            print(bias_item)
+        return self._predict_ratings(user_name, based, debiasing='baseline')
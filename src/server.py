@@ -0,0 +1,254 @@
+from recommendation import Recommendation
+from parallel import _init_worker, _recommend_chunk, _get_worker_settings
+from typing import Dict, List, Set, Tuple, Union
+import argparse
+import asyncio
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import os
+import tempfile
+
+
+def _recommend_batch(recommendation: Recommendation,
+                     args: Tuple[List[str], str, int, Union[bool, str]]) -> List[Tuple[str, List[str]]]:
+    """スレッドで、共有の推薦器を使ってユーザ群の推薦リストを計算する
+
+    Args:
+        recommendation (Recommendation): 推薦器
+        args (Tuple[List[str], str, int, Union[bool, str]]): ユーザのリスト、based、top_n、debiasing
+
+    Returns:
+        List[Tuple[str, List[str]]]: ユーザと推薦リストの組
+    """
+    user_names, based, top_n, debiasing = args
+    recommendations = recommendation.get_recommendations_batch(
+        user_names, based=based, top_n=top_n, debiasing=debiasing, block_size=len(user_names))
+    return list(recommendations.items())
+
+
+@dataclasses.dataclass
+class RecommendationService:
+    """推薦器をasyncioから使うためのサービス。
+    予測はスレッドまたはプロセスのプールで行い、イベントループを止めない。
+    同じリクエストが計算中の場合はその結果を待ち、異なるユーザへのリクエストは
+    batch_wait秒またはmax_batch_size件まで溜めてget_recommendations_batchでまとめて計算する。
+    executor='thread'では推薦器を共有し、'process'ではスナップショットをメモリマップで共有する
+    """
+    recommendation: Recommendation
+    executor: str = 'thread'
+    n_workers: int = 1
+    max_batch_size: int = 64
+    batch_wait: float = 0.002
+
+    def __post_init__(self):
+        # 計算中のリクエスト。keyは(user_name, based, top_n, debiasing)
+        self._pending: Dict[Tuple, asyncio.Future] = {}
+        # 計算を待っているユーザ。keyは(based, top_n, debiasing)
+        self._batches: Dict[Tuple, List[str]] = {}
+        self._timers: Dict[Tuple, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._executor: concurrent.futures.Executor = None
+        # プールで実行する関数。引数は(ユーザのリスト, based, top_n, debiasing)
+        self._function = None
+        self._tmp_dir: tempfile.TemporaryDirectory = None
+        self.stats = {'requests': 0, 'coalesced': 0, 'batches': 0, 'batched_users': 0}
+
+    def start(self):
+        """プールを作成する
+        """
+        if self.executor == 'thread':
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.n_workers)
+            self._function = functools.partial(_recommend_batch, self.recommendation)
+        elif self.executor == 'process':
+            self._tmp_dir = tempfile.TemporaryDirectory()
+            snapshot_path = os.path.join(self._tmp_dir.name, 'snapshot')
+            self.recommendation.save_snapshot(snapshot_path, include_similarity=True)
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.n_workers, initializer=_init_worker,
+                initargs=(snapshot_path, _get_worker_settings(self.recommendation)))
+            self._function = _recommend_chunk
+        else:
+            raise Exception("Unknown executor: {}".format(self.executor))
+
+    def close(self):
+        """プールを終了し、スナップショットを削除する
+        """
+        for timer in self._timers.values():
+            timer.cancel()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self._tmp_dir is not None:
+            self._tmp_dir.cleanup()
+            self._tmp_dir = None
+
+    async def __aenter__(self) -> 'RecommendationService':
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        # 計算中のバッチを待ってからプールを終了する
+        for group in list(self._batches):
+            self._flush(group)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.close()
+
+    async def recommend(self, user_name: str, based: str = 'user', top_n: int = 0,
+                        debiasing: Union[bool, str] = True) -> List[str]:
+        """ユーザに対する推薦リストを返却する。結果はget_recommendations_batchと同じ
+
+        Args:
+            user_name (str): 対象ユーザ
+            based (str, optional): user, item, mf, baseline or cooccurrence
+            top_n (int, optional): 上位n件のみを取得
+            debiasing (Union[bool, str], optional): バイアス除去フラグ
+
+        Returns:
+            List[str]: 予測評価値で降順ソートされたアイテムのリスト
+        """
+        if self._executor is None:
+            raise Exception("The service has not been started.")
+        self.stats['requests'] += 1
+        key = (user_name, based, top_n, debiasing)
+        future = self._pending.get(key)
+        if future is not None:
+            self.stats['coalesced'] += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[key] = future
+            group = (based, top_n, debiasing)
+            batch = self._batches.setdefault(group, [])
+            batch.append(user_name)
+            if len(batch) >= self.max_batch_size:
+                self._flush(group)
+            elif len(batch) == 1:
+                self._timers[group] = loop.call_later(self.batch_wait, self._flush, group)
+        # 待っている1つのリクエストが取り消されても、同じ結果を待つ他のリクエストに影響しないようにする
+        return list(await asyncio.shield(future))
+
+    def _flush(self, group: Tuple):
+        """溜めたユーザの推薦リストの計算を開始する
+
+        Args:
+            group (Tuple): (based, top_n, debiasing)
+        """
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        user_names = self._batches.pop(group, [])
+        if not user_names:
+            return
+        self.stats['batches'] += 1
+        self.stats['batched_users'] += len(user_names)
+        task = asyncio.ensure_future(self._run_batch(group, user_names))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, group: Tuple, user_names: List[str]):
+        """プールでユーザ群の推薦リストを計算し、待っているリクエストに結果を渡す。
+        未知のユーザはバッチから除き、そのリクエストだけを例外とする
+
+        Args:
+            group (Tuple): (based, top_n, debiasing)
+            user_names (List[str]): 対象ユーザのリスト
+        """
+        based, top_n, debiasing = group
+        known = [user_name for user_name in user_names if user_name in self.recommendation._users]
+        results, error = {}, None
+        try:
+            if known:
+                results = dict(await asyncio.get_running_loop().run_in_executor(
+                    self._executor, self._function, (known, based, top_n, debiasing)))
+        except Exception as e:
+            error = e
+        for user_name in user_names:
+            future = self._pending.pop((user_name,) + group)
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif user_name in results:
+                future.set_result(results[user_name])
+            else:
+                future.set_exception(Exception("Unknown user: {}".format(user_name)))
+
+
+async def _handle_connection(service: RecommendationService, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter):
+    """1行1リクエストのJSONを受け取り、1行1レスポンスのJSONを返す。
+    リクエストは {"user": ..., "based": ..., "top_n": ..., "debiasing": ...} で、user以外は省略できる。
+    レスポンスは {"user": ..., "items": [...]} または {"user": ..., "error": ...}
+
+    Args:
+        service (RecommendationService): サービス
+        reader (asyncio.StreamReader): 入力
+        writer (asyncio.StreamWriter): 出力
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            user_name = None
+            try:
+                request = json.loads(line)
+                user_name = request['user']
+                items = await service.recommend(
+                    user_name, based=request.get('based', 'user'), top_n=request.get('top_n', 0),
+                    debiasing=request.get('debiasing', True))
+                response = {'user': user_name, 'items': items}
+            except Exception as e:
+                response = {'user': user_name, 'error': str(e)}
+            writer.write((json.dumps(response, ensure_ascii=False) + '\n').encode())
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(service: RecommendationService, host: str = '127.0.0.1', port: int = 8765) -> asyncio.AbstractServer:
+    """サービスをTCPで公開する
+
+    Args:
+        service (RecommendationService): 開始済みのサービス
+        host (str, optional): ホスト
+        port (int, optional): ポート。0の場合は空いているポート
+
+    Returns:
+        asyncio.AbstractServer: サーバ
+    """
+    return await asyncio.start_server(functools.partial(_handle_connection, service), host, port)
+
+
+async def _main(args: argparse.Namespace):
+    recommendation = Recommendation(file_name=args.file_name, file_format=args.file_format,
+                                    storage=args.storage, metric=args.metric, cache_size=args.cache_size)
+    async with RecommendationService(recommendation, executor=args.executor, n_workers=args.workers,
+                                     max_batch_size=args.max_batch_size,
+                                     batch_wait=args.batch_wait_ms / 1000) as service:
+        server = await serve(service, args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='推薦リストを1行1リクエストのJSONで返すサーバ')
+    parser.add_argument('--file-name', default='data/ratings.json')
+    parser.add_argument('--file-format', default='json')
+    parser.add_argument('--storage', default='dense')
+    parser.add_argument('--metric', default='euclidean')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--executor', default='thread')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--batch-wait-ms', type=float, default=2.0)
+    parser.add_argument('--cache-size', type=int, default=0)
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
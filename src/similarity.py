@@ -1,4 +1,13 @@
 import numpy as np
+from typing import Iterable, Iterator, Tuple
+from sparse_matrix import expand_ranges
+from instrumentation import registry
+
+# 類似度をブロックごとに計算するときに、同時に確保する (ブロックの行数, ブロックの列数) のfloat64の配列の数。
+# 統計量6つと計算途中の配列の分
+_BLOCK_ARRAYS = 8
+# 前処理で同時に確保する (行数, 次元数) のfloat64の配列の数。評価済みマスク、評価値、その二乗と、作成途中の配列の分
+_OPERAND_ARRAYS = 5
 
 
 def calc_euclidean_distance(v1: np.ndarray, v2: np.ndarray) -> float:
@@ -31,23 +40,68 @@ def calc_euclidean_similarity(v1: np.ndarray, v2: np.ndarray) -> float:
     return sim
 
 
+def calc_cosine_similarity(v1: np.ndarray, v2: np.ndarray) -> float:
+    """コサイン類似度を計算する
+
+    Args:
+        v1 (np.ndarray): ベクトル
+        v2 (np.ndarray): ベクトル
+
+    Returns:
+        float: コサイン類似度
+    """
+    square_denominator: float = np.sum(v1**2) * np.sum(v2**2)
+    if square_denominator == 0:
+        return 0
+    sim: float = np.sum(v1 * v2) / np.sqrt(square_denominator)
+    return sim
+
+
+def calc_jaccard_similarity(mask1: np.ndarray, mask2: np.ndarray) -> float:
+    """評価済みidxの集合同士のJaccard係数を計算する
+
+    Args:
+        mask1 (np.ndarray): 評価済みマスク
+        mask2 (np.ndarray): 評価済みマスク
+
+    Returns:
+        float: Jaccard係数
+    """
+    union: int = np.count_nonzero(mask1 | mask2)
+    if union == 0:
+        return 0
+    sim: float = np.count_nonzero(mask1 & mask2) / union
+    return sim
+
+
 def calc_similarity_with_missing_value(v1: np.ndarray, v2: np.ndarray,
                                        metric: str = 'euclidean',
-                                       missing_value: float = 0) -> float:
+                                       missing_value: float = 0,
+                                       dimension_means: np.ndarray = None) -> float:
     """類似度を計算する関数。ベクトルのどちらかに欠損値が含まれる場合、該当idxは無視する。
+    jaccardは評価済みidxの集合を比較し、adjusted_cosineは次元ごとの平均を引いてからコサイン類似度を計算する
 
     Args:
         v1 (np.ndarray): ベクトル
         v2 (np.ndarray): ベクトル
         metric (str, optional): スコア計算のメトリック
         missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): 次元ごとの平均。adjusted_cosineでは必須
 
     Returns:
         float: 類似度
     """
-    idx: np.array = np.where((v1 != missing_value) & (v2 != missing_value))[0]
+    registry.increment('similarity_evaluations')
+    if metric == 'jaccard':
+        return calc_jaccard_similarity(v1 != missing_value, v2 != missing_value)
+    with registry.timer('similarity.mask'):
+        idx: np.array = np.where((v1 != missing_value) & (v2 != missing_value))[0]
     if len(idx) == 0:
         return 0
+    if metric == 'adjusted_cosine':
+        if dimension_means is None:
+            raise Exception("adjusted_cosine requires dimension_means")
+        return calc_cosine_similarity(v1[idx] - dimension_means[idx], v2[idx] - dimension_means[idx])
     sim: float = calc_similarity(v1[idx], v2[idx], metric)
     return sim
 
@@ -70,6 +124,10 @@ def calc_similarity(v1: np.ndarray, v2: np.ndarray,
         sim = calc_euclidean_similarity(v1, v2)
     elif (metric == 'pearson'):
         sim = calc_pearson_correlation_coefficient(v1, v2)
+    elif (metric == 'cosine'):
+        sim = calc_cosine_similarity(v1, v2)
+    else:
+        raise Exception("Unknown metric: {}".format(metric))
     return sim
 
 
@@ -91,3 +149,649 @@ def calc_pearson_correlation_coefficient(v1: np.ndarray, v2: np.ndarray) \
         return 0
     coef: float = np.sum(v1_diff * v2_diff) / np.sqrt(square_denominator)
     return coef
+
+
+def _prepare_co_rated_operands(m: np.ndarray, missing_value: float = 0,
+                               dimension_means: np.ndarray = None) -> tuple:
+    """_calc_co_rated_statistics の行列積に使う、評価済みマスクと欠損値を0にした評価値を作成する
+
+    Args:
+        m (np.ndarray): 行列 (n, d)
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): 評価値から引く次元ごとの平均 (d,)
+
+    Returns:
+        tuple: 評価済みマスク、評価値。いずれもfloat64の (n, d)
+    """
+    w = (m != missing_value).astype(np.float64)
+    if dimension_means is not None:
+        # 評価のない次元の平均(nan)は使われないため0とする
+        m = m - np.nan_to_num(dimension_means)
+    # 欠損値を0に置き換えておけば、行列積がそのまま共通評価idxに限定した和になる
+    x = np.where(w > 0, m, 0).astype(np.float64)
+    return w, x
+
+
+def _calc_statistics_from_operands(operands1: tuple, operands2: tuple) -> tuple:
+    """_prepare_co_rated_operands で作成した2つの行列の行同士について、共通評価idxに限定した統計量を計算する
+
+    Args:
+        operands1 (tuple): 対象側の評価済みマスクと評価値
+        operands2 (tuple): 比較対象側の評価済みマスク、評価値と、評価値の二乗
+
+    Returns:
+        tuple: _calc_co_rated_statistics と同じ形式の統計量
+    """
+    w1, x1 = operands1
+    w2, x2, square_x2 = operands2
+    n = w1 @ w2.T
+    s1 = x1 @ w2.T
+    s2 = w1 @ x2.T
+    s11 = np.square(x1) @ w2.T
+    s22 = w1 @ square_x2.T
+    s12 = x1 @ x2.T
+    return n, s1, s2, s11, s22, s12
+
+
+def _calc_co_rated_statistics(m1: np.ndarray, m2: np.ndarray,
+                              missing_value: float = 0,
+                              dimension_means: np.ndarray = None) -> tuple:
+    """行列の行同士について、共通評価idxに限定した統計量をまとめて計算する
+
+    Args:
+        m1 (np.ndarray): 行列 (n1, d)
+        m2 (np.ndarray): 行列 (n2, d)
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): 評価値から引く次元ごとの平均 (d,)
+
+    Returns:
+        tuple: 共通評価数、m1側の和、m2側の和、m1側の二乗和、m2側の二乗和、積和。いずれも (n1, n2)
+    """
+    w2, x2 = _prepare_co_rated_operands(m2, missing_value, dimension_means)
+    return _calc_statistics_from_operands(
+        _prepare_co_rated_operands(m1, missing_value, dimension_means), (w2, x2, np.square(x2)))
+
+
+def _calc_similarity_from_statistics(statistics: tuple, metric: str = 'euclidean',
+                                     counts1: np.ndarray = None, counts2: np.ndarray = None) -> np.ndarray:
+    """共通評価idxに限定した統計量から類似度行列を計算する。
+    adjusted_cosineの統計量は、次元ごとの平均を引いた評価値から計算しておく
+
+    Args:
+        statistics (tuple): _calc_co_rated_statistics の返り値
+        metric (str, optional): スコア計算のメトリック
+        counts1 (np.ndarray, optional): 対象側の評価数。jaccardでは必須
+        counts2 (np.ndarray, optional): 比較対象側の評価数。jaccardでは必須
+
+    Returns:
+        np.ndarray: 類似度行列
+    """
+    n, s1, s2, s11, s22, s12 = statistics
+    # 丸め誤差で負になった値は0とみなす
+    tol = 1e-10
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric == 'euclidean':
+            square_dist = s11 + s22 - 2 * s12
+            square_dist[square_dist < tol * (s11 + s22)] = 0
+            sim = 1 / (1 + np.sqrt(square_dist))
+        elif metric == 'pearson':
+            safe_n = np.where(n > 0, n, 1)
+            cov = s12 - s1 * s2 / safe_n
+            var1 = s11 - np.square(s1) / safe_n
+            var2 = s22 - np.square(s2) / safe_n
+            var1[var1 < tol * s11] = 0
+            var2[var2 < tol * s22] = 0
+            square_denominator = var1 * var2
+            sim = np.where(square_denominator > 0,
+                           cov / np.sqrt(square_denominator), 0)
+            sim = np.clip(sim, -1, 1)
+        elif metric in ('cosine', 'adjusted_cosine'):
+            square_denominator = s11 * s22
+            sim = np.where(square_denominator > 0,
+                           s12 / np.sqrt(square_denominator), 0)
+            sim = np.clip(sim, -1, 1)
+        elif metric == 'jaccard':
+            union = counts1 + counts2 - n
+            sim = np.where(union > 0, n / union, 0)
+        else:
+            raise Exception("Unknown metric: {}".format(metric))
+    sim[n == 0] = 0
+    return sim
+
+
+def calc_similarity_matrix_with_missing_value(m1: np.ndarray, m2: np.ndarray,
+                                              metric: str = 'euclidean',
+                                              missing_value: float = 0,
+                                              dimension_means: np.ndarray = None) -> np.ndarray:
+    """行列の行同士の類似度をまとめて計算する関数。calc_similarity_with_missing_valueと同様に、
+    どちらかの行に欠損値が含まれるidxは無視する。
+
+    Args:
+        m1 (np.ndarray): 行列 (n1, d)
+        m2 (np.ndarray): 行列 (n2, d)
+        metric (str, optional): スコア計算のメトリック
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均 (d,)。
+            省略時はm2の評価済みの値から計算する
+
+    Returns:
+        np.ndarray: 類似度行列 (n1, n2)
+    """
+    registry.increment('similarity_evaluations', len(m1) * len(m2))
+    if metric == 'jaccard':
+        w1 = (m1 != missing_value).astype(np.float64)
+        w2 = (m2 != missing_value).astype(np.float64)
+        n = w1 @ w2.T
+        statistics = (n, None, None, None, None, None)
+        return _calc_similarity_from_statistics(
+            statistics, metric, w1.sum(axis=1)[:, np.newaxis], w2.sum(axis=1)[np.newaxis, :])
+    if metric == 'adjusted_cosine' and dimension_means is None:
+        dimension_means = _calc_dimension_means(m2, missing_value)
+    elif metric != 'adjusted_cosine':
+        dimension_means = None
+    statistics = _calc_co_rated_statistics(
+        m1, m2, missing_value, dimension_means)
+    return _calc_similarity_from_statistics(statistics, metric)
+
+
+def calc_similarity_vector_with_missing_value(v: np.ndarray, m: np.ndarray,
+                                              metric: str = 'euclidean',
+                                              missing_value: float = 0,
+                                              dimension_means: np.ndarray = None) -> np.ndarray:
+    """ベクトルと行列の各行との類似度をまとめて計算する関数
+
+    Args:
+        v (np.ndarray): ベクトル (d,)
+        m (np.ndarray): 行列 (n, d)
+        metric (str, optional): スコア計算のメトリック
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均 (d,)。
+            省略時はmの評価済みの値から計算する
+
+    Returns:
+        np.ndarray: 類似度ベクトル (n,)
+    """
+    return calc_similarity_matrix_with_missing_value(
+        v[np.newaxis, :], m, metric, missing_value, dimension_means)[0]
+
+
+def _calc_dimension_means(m: np.ndarray, missing_value: float = 0, block_size: int = None) -> np.ndarray:
+    """行列の評価済みの値から、次元ごとの平均を計算する。評価のない次元はnanとなる。
+    block_sizeを指定した場合は、その行数ずつ集計して作業領域を抑える
+
+    Args:
+        m (np.ndarray): 行列 (n, d)
+        missing_value (float, optional): 欠損値
+        block_size (int, optional): 一度に集計する行数。省略時は全行
+
+    Returns:
+        np.ndarray: 次元ごとの平均 (d,)
+    """
+    if block_size is None:
+        block_size = max(len(m), 1)
+    sums = np.zeros(m.shape[1])
+    counts = np.zeros(m.shape[1])
+    for start in range(0, len(m), block_size):
+        block = m[start:start + block_size]
+        w = block != missing_value
+        sums += np.where(w, block, 0).sum(axis=0)
+        counts += w.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return sums / counts
+
+
+def prepare_similarity_operands(m: np.ndarray, metric: str = 'euclidean', missing_value: float = 0,
+                                dimension_means: np.ndarray = None) -> tuple:
+    """calc_similarity_from_operandsに渡す前処理済みの行列を作成する。いずれも行がmの行に対応する
+
+    Args:
+        m (np.ndarray): 行列 (n, d)
+        metric (str, optional): スコア計算のメトリック
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): adjusted_cosineで評価値から引く次元ごとの平均 (d,)
+
+    Returns:
+        tuple: jaccardでは評価済みマスク (n, d) と評価数 (n,)、それ以外では評価済みマスク、評価値、その二乗。
+            いずれもfloat64
+    """
+    # jaccardでは評価済みマスクだけを使う
+    if metric == 'jaccard':
+        w = (m != missing_value).astype(np.float64)
+        return w, w.sum(axis=1)
+    w, x = _prepare_co_rated_operands(m, missing_value, dimension_means)
+    return w, x, np.square(x)
+
+
+def calc_similarity_from_operands(operands1: tuple, operands2: tuple, metric: str = 'euclidean',
+                                  shrinkage: float = 0.0, min_overlap: int = 0) -> np.ndarray:
+    """prepare_similarity_operandsで作成した2つの行列の行同士の類似度を計算する
+
+    Args:
+        operands1 (tuple): 対象側の前処理済みの行列 (n1, d)
+        operands2 (tuple): 比較対象側の前処理済みの行列 (n2, d)
+        metric (str, optional): スコア計算のメトリック
+        shrinkage (float, optional): 共通評価数による類似度の縮小の強さ
+        min_overlap (int, optional): 必要な共通評価数の下限
+
+    Returns:
+        np.ndarray: 類似度行列 (n1, n2)
+    """
+    registry.increment('similarity_evaluations', len(operands1[0]) * len(operands2[0]))
+    if metric == 'jaccard':
+        n = operands1[0] @ operands2[0].T
+        sim = _calc_similarity_from_statistics(
+            (n, None, None, None, None, None), metric,
+            operands1[1][:, np.newaxis], operands2[1][np.newaxis, :])
+    else:
+        statistics = _calc_statistics_from_operands(operands1[:2], operands2)
+        n = statistics[0]
+        sim = _calc_similarity_from_statistics(statistics, metric)
+    if shrinkage > 0 or min_overlap > 0:
+        sim = shrink_similarity(sim, n, shrinkage, min_overlap)
+    return sim
+
+
+def get_block_shape(n_columns: int, n_dims: int, memory_budget: int) -> Tuple[int, int]:
+    """類似度を行と列のブロックに分けて計算するときに、作業領域がmemory_budgetバイトに収まるブロックの大きさを返却する。
+    作業領域として、比較対象側と対象側の前処理の配列 (列数, d)、(行数, d) を_OPERAND_ARRAYS個ずつ、
+    結果の行 (行数, n_columns)、統計量と計算途中の配列 (行数, 列数) _BLOCK_ARRAYS個を、いずれもfloat64として数える。
+    比較対象側の前処理済みの行列が予算の半分に収まる場合は、列は分けずに前処理を一度だけ行う
+
+    Args:
+        n_columns (int): 比較対象の数
+        n_dims (int): 次元数
+        memory_budget (int): 作業領域のバイト数
+
+    Returns:
+        Tuple[int, int]: ブロックの行数と列数。いずれも1以上
+    """
+    n_columns = max(n_columns, 1)
+    column_bytes = _OPERAND_ARRAYS * n_dims * 8
+    if n_columns * column_bytes <= memory_budget // 2:
+        n_block_columns = n_columns
+    else:
+        n_block_columns = max(1, min(n_columns, memory_budget // 2 // column_bytes))
+    row_bytes = 8 * (_OPERAND_ARRAYS * n_dims + _BLOCK_ARRAYS * n_block_columns + n_columns)
+    n_block_rows = max(1, (memory_budget - n_block_columns * column_bytes) // row_bytes)
+    return int(n_block_rows), int(n_block_columns)
+
+
+def iter_similarity_blocks(m1: np.ndarray, m2: np.ndarray, metric: str = 'euclidean',
+                           missing_value: float = 0, dimension_means: np.ndarray = None,
+                           block_size: int = 256, column_block_size: int = None, shrinkage: float = 0.0,
+                           min_overlap: int = 0) -> Iterator[Tuple[int, np.ndarray]]:
+    """m1をblock_size行ずつに分けて、m2の全行との類似度を順に計算する。
+    column_block_sizeを省略した場合はm2側の前処理を最初に一度だけ行い、
+    指定した場合はm2もその行数ずつに分けて、ブロックごとに前処理する。
+    統計量は丸め誤差を抑えるためfloat64で計算する
+
+    Args:
+        m1 (np.ndarray): 行列 (n1, d)
+        m2 (np.ndarray): 行列 (n2, d)
+        metric (str, optional): スコア計算のメトリック
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均 (d,)。
+            省略時はm2の評価済みの値から計算する
+        block_size (int, optional): 一度に計算するm1の行数
+        column_block_size (int, optional): 一度に計算するm2の行数。省略時は全行
+        shrinkage (float, optional): 共通評価数による類似度の縮小の強さ
+        min_overlap (int, optional): 必要な共通評価数の下限
+
+    Yields:
+        Tuple[int, np.ndarray]: ブロックの先頭の行と、類似度 (ブロックの行数, n2)
+    """
+    if column_block_size is None:
+        column_block_size = max(len(m2), 1)
+    if metric == 'adjusted_cosine' and dimension_means is None:
+        dimension_means = _calc_dimension_means(m2, missing_value, column_block_size)
+    elif metric != 'adjusted_cosine':
+        dimension_means = None
+    # 列を分けない場合は、m2側の前処理を全てのブロックで使い回す
+    column_operands = None
+    if column_block_size >= len(m2):
+        column_operands = prepare_similarity_operands(m2, metric, missing_value, dimension_means)
+    for start in range(0, len(m1), block_size):
+        operands1 = prepare_similarity_operands(m1[start:start + block_size], metric, missing_value, dimension_means)
+        sim = np.empty((len(operands1[0]), len(m2)))
+        for column_start in range(0, len(m2), column_block_size):
+            operands2 = column_operands
+            if operands2 is None:
+                operands2 = prepare_similarity_operands(
+                    m2[column_start:column_start + column_block_size], metric, missing_value, dimension_means)
+            tile = calc_similarity_from_operands(operands1, operands2, metric, shrinkage, min_overlap)
+            sim[:, column_start:column_start + tile.shape[1]] = tile
+        yield start, sim
+
+
+def collect_similarity_blocks(blocks: Iterable[Tuple[int, np.ndarray]], shape: Tuple[int, int],
+                              dtype: type = np.float32) -> np.ndarray:
+    """行ブロックごとに計算した類似度を、dtypeの類似度行列に書き込む
+
+    Args:
+        blocks (Iterable[Tuple[int, np.ndarray]]): ブロックの先頭の行と類似度の組
+        shape (Tuple[int, int]): 類似度行列の大きさ
+        dtype (type, optional): 類似度行列の型
+
+    Returns:
+        np.ndarray: 類似度行列
+    """
+    sim = np.empty(shape, dtype=dtype)
+    for start, block in blocks:
+        sim[start:start + len(block)] = block
+    return sim
+
+
+def calc_similarity_matrix_in_blocks(m1: np.ndarray, m2: np.ndarray, metric: str = 'euclidean',
+                                     missing_value: float = 0, dimension_means: np.ndarray = None,
+                                     dtype: type = np.float32, memory_budget: int = 2 ** 28,
+                                     shrinkage: float = 0.0, min_overlap: int = 0) -> np.ndarray:
+    """calc_similarity_matrix_with_missing_valueと同じ類似度行列を、ブロックごとに計算してdtypeの行列に書き込む。
+    必要なメモリは結果の行列と、memory_budgetバイトに収まるブロックの作業領域だけとなる
+
+    Args:
+        m1 (np.ndarray): 行列 (n1, d)
+        m2 (np.ndarray): 行列 (n2, d)
+        metric (str, optional): スコア計算のメトリック
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均 (d,)
+        dtype (type, optional): 結果の型
+        memory_budget (int, optional): 作業領域のバイト数
+        shrinkage (float, optional): 共通評価数による類似度の縮小の強さ
+        min_overlap (int, optional): 必要な共通評価数の下限
+
+    Returns:
+        np.ndarray: 類似度行列 (n1, n2)
+    """
+    block_size, column_block_size = get_block_shape(len(m2), m2.shape[1], memory_budget)
+    blocks = iter_similarity_blocks(m1, m2, metric, missing_value, dimension_means, block_size,
+                                    column_block_size, shrinkage, min_overlap)
+    return collect_similarity_blocks(blocks, (len(m1), len(m2)), dtype)
+
+
+def select_top_k_rows(sim: np.ndarray, k: int) -> np.ndarray:
+    """行ごとに、値が上位k件の列のindexを降順に並べて返却する。同じ値は列のindexの昇順とする。
+    部分選択で上位k件を取り出してからそれらだけをソートする
+
+    Args:
+        sim (np.ndarray): 類似度行列 (n1, n2)
+        k (int): 件数。n2を超える場合はn2件とする
+
+    Returns:
+        np.ndarray: 列のindex (n1, k)
+    """
+    n_rows, n_columns = sim.shape
+    k = max(0, min(k, n_columns))
+    if k == 0:
+        return np.zeros((n_rows, 0), dtype=np.int64)
+    if k < n_columns:
+        kth = np.partition(sim, n_columns - k, axis=1)[:, n_columns - k, np.newaxis]
+        above = sim > kth
+        ties = sim == kth
+        # k件に足りない分は、k番目と同じ値の列からindexの小さい順に選ぶ
+        selected = above | (ties & (np.cumsum(ties, axis=1) <= k - above.sum(axis=1, keepdims=True)))
+        top = np.nonzero(selected)[1].reshape(n_rows, k)
+    else:
+        top = np.broadcast_to(np.arange(n_columns), (n_rows, n_columns))
+    order = np.argsort(-np.take_along_axis(sim, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+def select_top_k_neighbors(blocks: Iterable[Tuple[int, np.ndarray]], n_objects: int,
+                           k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """全ての組の類似度を行ブロックごとに受け取り、行ごとに自身を除いて類似度が上位k件の列とその類似度を残す
+
+    Args:
+        blocks (Iterable[Tuple[int, np.ndarray]]): ブロックの先頭の行と類似度 (ブロックの行数, n_objects) の組
+        n_objects (int): 行(列)の数
+        k (int): 近傍数。n_objects - 1を超える場合はn_objects - 1とする
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 近傍のindex(int32)と類似度(float32)。いずれも (n_objects, k)
+    """
+    k = max(0, min(k, n_objects - 1))
+    indices = np.empty((n_objects, k), dtype=np.int32)
+    scores = np.empty((n_objects, k), dtype=np.float32)
+    for start, block in blocks:
+        rows = np.arange(start, start + len(block))
+        block[np.arange(len(block)), rows] = -np.inf
+        top = select_top_k_rows(block, k)
+        indices[rows] = top
+        scores[rows] = np.take_along_axis(block, top, axis=1)
+    return indices, scores
+
+
+def calc_top_k_similarity(m: np.ndarray, k: int, metric: str = 'euclidean', missing_value: float = 0,
+                          dimension_means: np.ndarray = None, memory_budget: int = 2 ** 28,
+                          shrinkage: float = 0.0, min_overlap: int = 0,
+                          block_size: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    """行列の行ごとに、自身を除いて類似度が上位k件の行とその類似度を計算する。
+    類似度はブロックごとに計算して上位k件だけを残すため、全体の類似度行列は作らない
+
+    Args:
+        m (np.ndarray): 行列 (n, d)
+        k (int): 近傍数。n - 1を超える場合はn - 1とする
+        metric (str, optional): スコア計算のメトリック
+        missing_value (float, optional): 欠損値
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均 (d,)
+        memory_budget (int, optional): 作業領域のバイト数
+        shrinkage (float, optional): 共通評価数による類似度の縮小の強さ
+        min_overlap (int, optional): 必要な共通評価数の下限
+        block_size (int, optional): 一度に計算する行数。省略時はmemory_budgetから決める
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: 近傍のindex(int32)と類似度(float32)。いずれも (n, k)
+    """
+    default_block_size, column_block_size = get_block_shape(len(m), m.shape[1], memory_budget)
+    blocks = iter_similarity_blocks(m, m, metric, missing_value, dimension_means,
+                                    block_size or default_block_size, column_block_size,
+                                    shrinkage, min_overlap)
+    return select_top_k_neighbors(blocks, len(m), k)
+
+
+def calc_similarity_vector_with_sparse_matrix(indices: np.ndarray, values: np.ndarray,
+                                              indptr: np.ndarray, object_indices: np.ndarray,
+                                              data: np.ndarray, n_objects: int,
+                                              metric: str = 'euclidean',
+                                              object_counts: np.ndarray = None,
+                                              dimension_means: np.ndarray = None) -> np.ndarray:
+    """疎ベクトルと疎行列の各行との類似度をまとめて計算する。
+    評価済みの要素だけを走査するため、計算量は関係する評価数に比例する。
+    object_counts、dimension_meansを省略した場合は行列全体から計算する
+
+    Args:
+        indices (np.ndarray): 対象ベクトルの評価済みidx
+        values (np.ndarray): 対象ベクトルの評価値
+        indptr (np.ndarray): 行列を次元方向に圧縮したindptr。次元kの要素は indptr[k]:indptr[k+1]
+        object_indices (np.ndarray): 各要素が属する行(比較対象)のindex
+        data (np.ndarray): 各要素の評価値
+        n_objects (int): 比較対象の数
+        metric (str, optional): スコア計算のメトリック
+        object_counts (np.ndarray, optional): jaccardで使う比較対象ごとの評価数
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均
+
+    Returns:
+        np.ndarray: 類似度ベクトル (n_objects,)
+    """
+    registry.increment('similarity_evaluations', n_objects)
+    indices = np.asarray(indices)
+    starts = indptr[indices]
+    lengths = indptr[indices + 1] - starts
+    pos = expand_ranges(starts, lengths)
+    obj = object_indices[pos]
+    x1 = np.repeat(np.asarray(values, dtype=np.float64), lengths)
+    x2 = data[pos].astype(np.float64)
+    if metric == 'adjusted_cosine':
+        if dimension_means is None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dimension_means = _calc_compressed_sums(indptr, data) / np.diff(indptr)
+        means = np.repeat(dimension_means[indices], lengths)
+        x1 = x1 - means
+        x2 = x2 - means
+    statistics = _calc_statistics_from_pairs(obj, x1, x2, n_objects)
+    if metric == 'jaccard' and object_counts is None:
+        object_counts = np.bincount(object_indices, minlength=n_objects)
+    return _calc_similarity_from_statistics(statistics, metric, len(indices), object_counts)
+
+
+def calc_similarity_vector_with_sparse_rows(query: np.ndarray, query_mask: np.ndarray,
+                                            indptr: np.ndarray, indices: np.ndarray,
+                                            data: np.ndarray, rows: np.ndarray,
+                                            metric: str = 'euclidean',
+                                            dimension_means: np.ndarray = None) -> np.ndarray:
+    """密なベクトルと、圧縮形式の行列から選んだ一部の行との類似度を計算する。
+    選んだ行の評価済みの要素だけを走査するため、計算量は選んだ行の評価数に比例する。
+    dimension_meansを省略した場合は行列全体から計算する
+
+    Args:
+        query (np.ndarray): 対象ベクトル
+        query_mask (np.ndarray): 対象ベクトルの評価済みマスク
+        indptr (np.ndarray): 行iの要素は indptr[i]:indptr[i+1]
+        indices (np.ndarray): 各要素の次元
+        data (np.ndarray): 各要素の評価値
+        rows (np.ndarray): 比較対象とする行のindex
+        metric (str, optional): スコア計算のメトリック
+        dimension_means (np.ndarray, optional): adjusted_cosineで引く次元ごとの平均
+
+    Returns:
+        np.ndarray: 類似度ベクトル (len(rows),)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    registry.increment('similarity_evaluations', len(rows))
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    pos = expand_ranges(starts, lengths)
+    obj = np.repeat(np.arange(len(rows)), lengths)
+    dims = indices[pos]
+    co_rated = query_mask[dims]
+    dims = dims[co_rated]
+    x1 = query[dims].astype(np.float64)
+    x2 = data[pos][co_rated].astype(np.float64)
+    if metric == 'adjusted_cosine':
+        if dimension_means is None:
+            n_dims = len(query)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dimension_means = np.bincount(indices, weights=data, minlength=n_dims) / \
+                    np.bincount(indices, minlength=n_dims)
+        x1 = x1 - dimension_means[dims]
+        x2 = x2 - dimension_means[dims]
+    statistics = _calc_statistics_from_pairs(obj[co_rated], x1, x2, len(rows))
+    return _calc_similarity_from_statistics(
+        statistics, metric, np.count_nonzero(query_mask), lengths)
+
+
+def _calc_statistics_from_pairs(obj: np.ndarray, x1: np.ndarray, x2: np.ndarray,
+                                n_objects: int) -> tuple:
+    """共通評価された要素の値の組から、比較対象ごとの統計量を集計する
+
+    Args:
+        obj (np.ndarray): 各組が属する比較対象のindex
+        x1 (np.ndarray): 対象ベクトル側の値
+        x2 (np.ndarray): 比較対象側の値
+        n_objects (int): 比較対象の数
+
+    Returns:
+        tuple: _calc_co_rated_statistics と同じ形式の統計量
+    """
+    return (
+        np.bincount(obj, minlength=n_objects).astype(np.float64),
+        np.bincount(obj, weights=x1, minlength=n_objects),
+        np.bincount(obj, weights=x2, minlength=n_objects),
+        np.bincount(obj, weights=np.square(x1), minlength=n_objects),
+        np.bincount(obj, weights=np.square(x2), minlength=n_objects),
+        np.bincount(obj, weights=x1 * x2, minlength=n_objects),
+    )
+
+
+def _calc_compressed_sums(indptr: np.ndarray, data: np.ndarray) -> np.ndarray:
+    """圧縮形式の行列について、圧縮した軸ごとの値の和を計算する
+
+    Args:
+        indptr (np.ndarray): 要素kの値は data[indptr[k]:indptr[k+1]]
+        data (np.ndarray): 値
+
+    Returns:
+        np.ndarray: 和 (len(indptr) - 1,)
+    """
+    sums = np.zeros(len(indptr) - 1)
+    nonempty = np.diff(indptr) > 0
+    if len(data) > 0:
+        sums[nonempty] = np.add.reduceat(data, indptr[:-1][nonempty], dtype=np.float64)
+    return sums
+
+
+def calc_co_rating_count_matrix(m1: np.ndarray, m2: np.ndarray, missing_value: float = 0) -> np.ndarray:
+    """行列の行同士の共通評価数をまとめて計算する
+
+    Args:
+        m1 (np.ndarray): 行列 (n1, d)
+        m2 (np.ndarray): 行列 (n2, d)
+        missing_value (float, optional): 欠損値
+
+    Returns:
+        np.ndarray: 共通評価数 (n1, n2)
+    """
+    w1 = (m1 != missing_value).astype(np.float64)
+    w2 = (m2 != missing_value).astype(np.float64)
+    return w1 @ w2.T
+
+
+def calc_co_rating_count_vector_with_sparse_matrix(indices: np.ndarray, indptr: np.ndarray,
+                                                   object_indices: np.ndarray, n_objects: int) -> np.ndarray:
+    """疎ベクトルと疎行列の各行との共通評価数を計算する。引数はcalc_similarity_vector_with_sparse_matrixと同じ
+
+    Args:
+        indices (np.ndarray): 対象ベクトルの評価済みidx
+        indptr (np.ndarray): 行列を次元方向に圧縮したindptr
+        object_indices (np.ndarray): 各要素が属する行(比較対象)のindex
+        n_objects (int): 比較対象の数
+
+    Returns:
+        np.ndarray: 共通評価数 (n_objects,)
+    """
+    indices = np.asarray(indices)
+    starts = indptr[indices]
+    pos = expand_ranges(starts, indptr[indices + 1] - starts)
+    return np.bincount(object_indices[pos], minlength=n_objects).astype(np.float64)
+
+
+def calc_co_rating_count_vector_with_sparse_rows(query_mask: np.ndarray, indptr: np.ndarray,
+                                                 indices: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """密なベクトルと、圧縮形式の行列から選んだ一部の行との共通評価数を計算する。
+    引数はcalc_similarity_vector_with_sparse_rowsと同じ
+
+    Args:
+        query_mask (np.ndarray): 対象ベクトルの評価済みマスク
+        indptr (np.ndarray): 行iの要素は indptr[i]:indptr[i+1]
+        indices (np.ndarray): 各要素の次元
+        rows (np.ndarray): 比較対象とする行のindex
+
+    Returns:
+        np.ndarray: 共通評価数 (len(rows),)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    pos = expand_ranges(starts, lengths)
+    obj = np.repeat(np.arange(len(rows)), lengths)
+    return np.bincount(obj[query_mask[indices[pos]]], minlength=len(rows)).astype(np.float64)
+
+
+def shrink_similarity(sim: np.ndarray, n: np.ndarray, shrinkage: float = 0.0,
+                      min_overlap: int = 0) -> np.ndarray:
+    """共通評価数が少ない組の類似度を、n / (n + shrinkage)倍に縮小する。
+    共通評価数がmin_overlap未満の組は類似度を0とする
+
+    Args:
+        sim (np.ndarray): 類似度
+        n (np.ndarray): 共通評価数
+        shrinkage (float, optional): 縮小の強さ。0なら縮小しない
+        min_overlap (int, optional): 必要な共通評価数の下限
+
+    Returns:
+        np.ndarray: 縮小した類似度
+    """
+    n = np.asarray(n, dtype=np.float64)
+    if shrinkage > 0:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim = np.where(n > 0, sim * n / (n + shrinkage), 0)
+    return np.where(n >= min_overlap, sim, 0)
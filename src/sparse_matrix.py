@@ -0,0 +1,554 @@
+import numpy as np
+from typing import Dict, Tuple
+import dataclasses
+
+
+def expand_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """[start, start + length) の区間を連結したindex配列を作成する
+
+    Args:
+        starts (np.ndarray): 区間の開始位置
+        lengths (np.ndarray): 区間の長さ
+
+    Returns:
+        np.ndarray: 連結したindex配列
+    """
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total)
+
+
+def last_occurrence(keys: np.ndarray) -> np.ndarray:
+    """同じkeyが複数ある場合に最後のものだけを残すためのindexを、元の並び順で返却する
+
+    Args:
+        keys (np.ndarray): key
+
+    Returns:
+        np.ndarray: 残す要素のindex
+    """
+    _, last = np.unique(keys[::-1], return_index=True)
+    return np.sort(len(keys) - 1 - last)
+
+
+# 差分の要素数と削除済みの要素数の合計が、この数と格納されている要素数のこの割合の大きいほうを超えたら統合する
+_MIN_DELTA = 1024
+_DELTA_RATIO = 0.125
+
+
+def _compress(major: np.ndarray, minor: np.ndarray, data: np.ndarray,
+              n_major: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(major, minor, data) の三つ組を圧縮形式(indptr, indices, data)に変換する
+
+    Args:
+        major (np.ndarray): 圧縮する側のindex
+        minor (np.ndarray): もう一方のindex
+        data (np.ndarray): 値
+        n_major (int): 圧縮する側の次元数
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: indptr, indices, data
+    """
+    order = np.lexsort((minor, major))
+    indptr = np.zeros(n_major + 1, dtype=np.int64)
+    np.cumsum(np.bincount(major, minlength=n_major), out=indptr[1:])
+    return indptr, minor[order], data[order]
+
+
+def _merge_compressed(indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, alive: np.ndarray,
+                      major: np.ndarray, minor: np.ndarray, values: np.ndarray,
+                      n_minor: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """圧縮形式から削除済みの要素を除き、新しい要素を挿入する。既存の要素は並べ替えないため、
+    計算量は要素数に比例する
+
+    Args:
+        indptr (np.ndarray): 圧縮形式のindptr
+        indices (np.ndarray): 圧縮形式のindices
+        data (np.ndarray): 圧縮形式のdata
+        alive (np.ndarray): 要素が削除されていないか。Noneの場合は全て残す
+        major (np.ndarray): 新しい要素の圧縮する側のindex
+        minor (np.ndarray): 新しい要素のもう一方のindex
+        values (np.ndarray): 新しい要素の値
+        n_minor (int): もう一方の次元数
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: indptr, indices, data
+    """
+    n_major = len(indptr) - 1
+    counts = np.diff(indptr)
+    if alive is not None:
+        counts = counts - np.bincount(np.searchsorted(indptr, np.flatnonzero(~alive), side='right') - 1,
+                                      minlength=n_major)
+        indices, data = indices[alive], data[alive]
+    entry_major = np.repeat(np.arange(n_major), counts)
+    order = np.lexsort((minor, major))
+    major, minor, values = major[order], minor[order], values[order]
+    pos = np.searchsorted(entry_major * n_minor + indices, major * n_minor + minor)
+    new_indptr = np.zeros(n_major + 1, dtype=np.int64)
+    np.cumsum(counts + np.bincount(major, minlength=n_major), out=new_indptr[1:])
+    return new_indptr, np.insert(indices, pos, minor), np.insert(data, pos, values)
+
+
+def _slice_compressed(indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, alive: np.ndarray,
+                      pending: Dict[int, float], idx: int) -> Tuple[np.ndarray, np.ndarray]:
+    """圧縮形式の1行(1列)に削除済みの印と差分の要素を反映して返却する
+
+    Args:
+        indptr (np.ndarray): 圧縮形式のindptr
+        indices (np.ndarray): 圧縮形式のindices
+        data (np.ndarray): 圧縮形式のdata
+        alive (np.ndarray): 要素が削除されていないか。Noneの場合は全て残す
+        pending (Dict[int, float]): その行(列)の差分の要素。もう一方のindexから値への辞書
+        idx (int): 行(列)index
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: もう一方のindexと値
+    """
+    start, end = indptr[idx], indptr[idx + 1]
+    indices, data = indices[start:end], data[start:end]
+    if alive is not None and not alive[start:end].all():
+        indices, data = indices[alive[start:end]], data[alive[start:end]]
+    if pending:
+        indices = np.concatenate([indices, np.fromiter(pending.keys(), dtype=indices.dtype, count=len(pending))])
+        data = np.concatenate([data, np.fromiter(pending.values(), dtype=data.dtype, count=len(pending))])
+        order = np.argsort(indices, kind='stable')
+        indices, data = indices[order], data[order]
+    return indices, data
+
+
+@dataclasses.dataclass
+class SparseRatingMatrix:
+    """評価値の疎行列。行方向(ユーザ)はCSR、列方向(アイテム)はCSCで同じ評価値を保持する。
+    格納されている要素がそのまま評価済みを表すため、欠損値の番兵は使わない。
+    新しい要素は差分として辞書に溜め、削除した要素は削除済みの印を付けるだけにして、
+    差分が大きくなったときや行列全体を読むときにまとめて圧縮形式へ統合する。
+    1行・1列・1要素を読むメソッドは統合せずに差分も読む
+    """
+    shape: Tuple[int, int]
+    _indptr: np.ndarray
+    _indices: np.ndarray
+    _data: np.ndarray
+    _col_indptr: np.ndarray
+    _col_indices: np.ndarray
+    _col_data: np.ndarray
+    # 行 -> {列: 値} と 列 -> {行: 値} の、圧縮形式にまだ入っていない要素
+    _pending_rows: Dict[int, Dict[int, float]] = dataclasses.field(default_factory=dict, repr=False)
+    _pending_cols: Dict[int, Dict[int, float]] = dataclasses.field(default_factory=dict, repr=False)
+    _n_pending: int = dataclasses.field(default=0, repr=False)
+    # 圧縮形式の要素が削除されていないか(CSRとCSCの並び)。削除がない間はNone
+    _alive: np.ndarray = dataclasses.field(default=None, repr=False)
+    _col_alive: np.ndarray = dataclasses.field(default=None, repr=False)
+    _n_removed: int = dataclasses.field(default=0, repr=False)
+
+    @classmethod
+    def from_triplets(cls, row: np.ndarray, col: np.ndarray, data: np.ndarray,
+                      shape: Tuple[int, int], dtype: type = np.float64) -> 'SparseRatingMatrix':
+        """(行, 列, 値) の三つ組から疎行列を作成する。同じ位置が重複する場合は後の値を採用する
+
+        Args:
+            row (np.ndarray): 行index
+            col (np.ndarray): 列index
+            data (np.ndarray): 値
+            shape (Tuple[int, int]): 行列のサイズ
+            dtype (type, optional): 値を保持する型
+
+        Returns:
+            SparseRatingMatrix: 疎行列
+        """
+        row = np.asarray(row, dtype=np.int64)
+        col = np.asarray(col, dtype=np.int64)
+        data = np.asarray(data, dtype=dtype)
+        if len(row) > 0:
+            # 重複は最後に現れたものだけを残す
+            keep = last_occurrence(row * shape[1] + col)
+            row, col, data = row[keep], col[keep], data[keep]
+        indptr, indices, values = _compress(row, col, data, shape[0])
+        col_indptr, col_indices, col_values = _compress(
+            col, row, data, shape[1])
+        return cls(tuple(shape), indptr, indices, values,
+                   col_indptr, col_indices, col_values)
+
+    @property
+    def indptr(self) -> np.ndarray:
+        """CSRのindptr。差分の要素と削除済みの印を統合してから返却する
+
+        Returns:
+            np.ndarray: CSRのindptr
+        """
+        self.compact()
+        return self._indptr
+
+    @property
+    def indices(self) -> np.ndarray:
+        """CSRのindices。差分の要素と削除済みの印を統合してから返却する
+
+        Returns:
+            np.ndarray: CSRのindices
+        """
+        self.compact()
+        return self._indices
+
+    @property
+    def data(self) -> np.ndarray:
+        """CSRのdata。差分の要素と削除済みの印を統合してから返却する
+
+        Returns:
+            np.ndarray: CSRのdata
+        """
+        self.compact()
+        return self._data
+
+    @property
+    def col_indptr(self) -> np.ndarray:
+        """CSCのindptr。差分の要素と削除済みの印を統合してから返却する
+
+        Returns:
+            np.ndarray: CSCのindptr
+        """
+        self.compact()
+        return self._col_indptr
+
+    @property
+    def col_indices(self) -> np.ndarray:
+        """CSCのindices。差分の要素と削除済みの印を統合してから返却する
+
+        Returns:
+            np.ndarray: CSCのindices
+        """
+        self.compact()
+        return self._col_indices
+
+    @property
+    def col_data(self) -> np.ndarray:
+        """CSCのdata。差分の要素と削除済みの印を統合してから返却する
+
+        Returns:
+            np.ndarray: CSCのdata
+        """
+        self.compact()
+        return self._col_data
+
+    @property
+    def nnz(self) -> int:
+        """格納されている評価値の数
+
+        Returns:
+            int: 評価値の数
+        """
+        return len(self._data) - self._n_removed + self._n_pending
+
+    def get_row(self, row_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """行の評価済み列indexと評価値を返却する
+
+        Args:
+            row_idx (int): 行index
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 列indexと評価値
+        """
+        return _slice_compressed(self._indptr, self._indices, self._data, self._alive,
+                                 self._pending_rows.get(row_idx), row_idx)
+
+    def get_col(self, col_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        """列の評価済み行indexと評価値を返却する
+
+        Args:
+            col_idx (int): 列index
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 行indexと評価値
+        """
+        return _slice_compressed(self._col_indptr, self._col_indices, self._col_data, self._col_alive,
+                                 self._pending_cols.get(col_idx), col_idx)
+
+    def get(self, row_idx: int, col_idx: int, default: float = None) -> float:
+        """1要素の値を返却する
+
+        Args:
+            row_idx (int): 行index
+            col_idx (int): 列index
+            default (float, optional): 未評価の場合に返す値
+
+        Returns:
+            float: 評価値
+        """
+        pending = self._pending_rows.get(row_idx)
+        if pending and col_idx in pending:
+            return float(pending[col_idx])
+        pos = self._find(np.array([row_idx]), np.array([col_idx]))[0][0]
+        if pos >= 0 and (self._alive is None or self._alive[pos]):
+            return float(self._data[pos])
+        return default
+
+    def row_to_dense(self, row_idx: int, fill_value: float = 0) -> np.ndarray:
+        """行を密なベクトルとして返却する
+
+        Args:
+            row_idx (int): 行index
+            fill_value (float, optional): 未評価の要素に入れる値
+
+        Returns:
+            np.ndarray: 評価値ベクトル
+        """
+        v = np.full(self.shape[1], fill_value, dtype=np.float64)
+        indices, data = self.get_row(row_idx)
+        v[indices] = data
+        return v
+
+    def col_to_dense(self, col_idx: int, fill_value: float = 0) -> np.ndarray:
+        """列を密なベクトルとして返却する
+
+        Args:
+            col_idx (int): 列index
+            fill_value (float, optional): 未評価の要素に入れる値
+
+        Returns:
+            np.ndarray: 評価値ベクトル
+        """
+        v = np.full(self.shape[0], fill_value, dtype=np.float64)
+        indices, data = self.get_col(col_idx)
+        v[indices] = data
+        return v
+
+    def toarray(self, fill_value: float = 0) -> np.ndarray:
+        """密な行列に変換する
+
+        Args:
+            fill_value (float, optional): 未評価の要素に入れる値
+
+        Returns:
+            np.ndarray: 行列
+        """
+        m = np.full(self.shape, fill_value, dtype=np.float64)
+        m[self.row_of_entries(), self.indices] = self.data
+        return m
+
+    def row_of_entries(self) -> np.ndarray:
+        """CSRの各要素が属する行indexを返却する
+
+        Returns:
+            np.ndarray: 行index
+        """
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def row_counts(self) -> np.ndarray:
+        """行ごとの評価数
+
+        Returns:
+            np.ndarray: 評価数
+        """
+        return np.diff(self.indptr)
+
+    def col_counts(self) -> np.ndarray:
+        """列ごとの評価数
+
+        Returns:
+            np.ndarray: 評価数
+        """
+        return np.diff(self.col_indptr)
+
+    def row_sums(self) -> np.ndarray:
+        """行ごとの評価値の和
+
+        Returns:
+            np.ndarray: 評価値の和
+        """
+        return np.bincount(self.row_of_entries(), weights=self.data,
+                           minlength=self.shape[0])
+
+    def col_sums(self) -> np.ndarray:
+        """列ごとの評価値の和
+
+        Returns:
+            np.ndarray: 評価値の和
+        """
+        return np.bincount(self.indices, weights=self.data,
+                           minlength=self.shape[1])
+
+    def rows_to_dense(self, row_idx: np.ndarray, fill_value: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """複数の行を密な行列と評価済みマスクとして返却する
+
+        Args:
+            row_idx (np.ndarray): 行indexの配列
+            fill_value (float, optional): 未評価の要素に入れる値
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: 評価値行列と評価済みマスク (len(row_idx), 列数)
+        """
+        row_idx = np.asarray(row_idx, dtype=np.int64)
+        starts = self._indptr[row_idx]
+        lengths = self._indptr[row_idx + 1] - starts
+        pos = expand_ranges(starts, lengths)
+        rows = np.repeat(np.arange(len(row_idx)), lengths)
+        if self._alive is not None:
+            alive = self._alive[pos]
+            pos, rows = pos[alive], rows[alive]
+        m = np.full((len(row_idx), self.shape[1]),
+                    fill_value, dtype=np.float64)
+        mask = np.zeros((len(row_idx), self.shape[1]), dtype=bool)
+        m[rows, self._indices[pos]] = self._data[pos]
+        mask[rows, self._indices[pos]] = True
+        if self._pending_rows:
+            for k, r in enumerate(row_idx.tolist()):
+                pending = self._pending_rows.get(r)
+                if pending:
+                    cols = np.fromiter(pending.keys(), dtype=np.int64, count=len(pending))
+                    m[k, cols] = np.fromiter(pending.values(), dtype=np.float64, count=len(pending))
+                    mask[k, cols] = True
+        return m, mask
+
+    def left_matmul(self, a: np.ndarray, col_values: np.ndarray = None, col_idx: np.ndarray = None) -> np.ndarray:
+        """密な行列aとの積 a @ M を計算する。計算量は a の行数 × 評価数に比例する。
+        col_idxを指定した場合はその列だけを計算し、計算量は a の行数 × その列の評価数に比例する
+
+        Args:
+            a (np.ndarray): 密な行列 (k, 行数)
+            col_values (np.ndarray, optional): CSCの並びで与える要素の値。省略時は評価値を使う
+            col_idx (np.ndarray, optional): 計算する列のindex。省略時は全ての列
+
+        Returns:
+            np.ndarray: 積 (k, 列数) またはcol_idxの列だけの積 (k, len(col_idx))
+        """
+        if col_values is None:
+            col_values = self.col_data
+        if col_idx is None:
+            starts = self.col_indptr[:-1]
+            counts = self.col_counts()
+            pos = slice(None)
+        else:
+            col_idx = np.asarray(col_idx, dtype=np.int64)
+            counts = self.col_indptr[col_idx + 1] - self.col_indptr[col_idx]
+            starts = np.cumsum(counts) - counts
+            pos = expand_ranges(self.col_indptr[col_idx], counts)
+        out = np.zeros((a.shape[0], len(counts)))
+        if counts.sum() == 0:
+            return out
+        prod = a[:, self.col_indices[pos]] * col_values[pos]
+        # 空の列はreduceatの区間から除く
+        nonempty = counts > 0
+        out[:, nonempty] = np.add.reduceat(
+            prod, starts[nonempty], axis=1)
+        return out
+
+    def to_triplets(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(行, 列, 値) の三つ組に変換する
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: 行index、列index、値
+        """
+        return self.row_of_entries(), self.indices, self.data
+
+    def _find(self, row: np.ndarray, col: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """要素のCSRとCSC上の位置を探す。存在しない要素の位置は-1とする。削除済みの印が付いた要素も位置を返す
+
+        Args:
+            row (np.ndarray): 行index
+            col (np.ndarray): 列index
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: CSR上の位置とCSC上の位置
+        """
+        csr_pos = np.full(len(row), -1, dtype=np.int64)
+        csc_pos = np.full(len(row), -1, dtype=np.int64)
+        for k, (r, c) in enumerate(zip(row, col)):
+            start, end = self._indptr[r], self._indptr[r + 1]
+            pos = start + np.searchsorted(self._indices[start:end], c)
+            if pos < end and self._indices[pos] == c:
+                csr_pos[k] = pos
+                start, end = self._col_indptr[c], self._col_indptr[c + 1]
+                csc_pos[k] = start + \
+                    np.searchsorted(self._col_indices[start:end], r)
+        return csr_pos, csc_pos
+
+    def resize(self, shape: Tuple[int, int]):
+        """行数・列数を増やす。増えた行・列は空とする
+
+        Args:
+            shape (Tuple[int, int]): 新しいサイズ
+        """
+        n_rows, n_cols = shape
+        self._indptr = np.concatenate([self._indptr, np.full(
+            n_rows - self.shape[0], self._indptr[-1], dtype=np.int64)])
+        self._col_indptr = np.concatenate([self._col_indptr, np.full(
+            n_cols - self.shape[1], self._col_indptr[-1], dtype=np.int64)])
+        self.shape = (n_rows, n_cols)
+
+    def set_values(self, row: np.ndarray, col: np.ndarray, data: np.ndarray):
+        """要素の値を設定する。既存の要素はその場で更新し、新しい要素は差分に加える
+
+        Args:
+            row (np.ndarray): 行index
+            col (np.ndarray): 列index
+            data (np.ndarray): 値
+        """
+        row = np.asarray(row, dtype=np.int64)
+        col = np.asarray(col, dtype=np.int64)
+        data = np.asarray(data, dtype=self._data.dtype)
+        csr_pos, csc_pos = self._find(row, col)
+        exists = csr_pos >= 0
+        self._data[csr_pos[exists]] = data[exists]
+        self._col_data[csc_pos[exists]] = data[exists]
+        if self._alive is not None:
+            # 削除済みの要素は印を外して戻す
+            self._n_removed -= int(np.count_nonzero(~self._alive[csr_pos[exists]]))
+            self._alive[csr_pos[exists]] = True
+            self._col_alive[csc_pos[exists]] = True
+        for r, c, value in zip(row[~exists].tolist(), col[~exists].tolist(), data[~exists].tolist()):
+            pending = self._pending_rows.setdefault(r, {})
+            if c not in pending:
+                self._n_pending += 1
+            pending[c] = value
+            self._pending_cols.setdefault(c, {})[r] = value
+        self._compact_if_large()
+
+    def remove_values(self, row: np.ndarray, col: np.ndarray):
+        """要素を削除する。存在しない要素は無視する。圧縮形式の要素には削除済みの印を付ける
+
+        Args:
+            row (np.ndarray): 行index
+            col (np.ndarray): 列index
+        """
+        row = np.asarray(row, dtype=np.int64)
+        col = np.asarray(col, dtype=np.int64)
+        for r, c in zip(row.tolist(), col.tolist()):
+            pending = self._pending_rows.get(r)
+            if pending and c in pending:
+                del pending[c]
+                del self._pending_cols[c][r]
+                self._n_pending -= 1
+        csr_pos, csc_pos = self._find(row, col)
+        exists = csr_pos >= 0
+        if exists.any():
+            if self._alive is None:
+                self._alive = np.ones(len(self._data), dtype=bool)
+                self._col_alive = np.ones(len(self._data), dtype=bool)
+            self._n_removed += int(np.count_nonzero(self._alive[np.unique(csr_pos[exists])]))
+            self._alive[csr_pos[exists]] = False
+            self._col_alive[csc_pos[exists]] = False
+        self._compact_if_large()
+
+    def _compact_if_large(self):
+        """差分の要素と削除済みの要素が多くなった場合に圧縮形式へ統合する
+        """
+        if self._n_pending + self._n_removed > max(_MIN_DELTA, _DELTA_RATIO * len(self._data)):
+            self.compact()
+
+    def compact(self):
+        """差分の要素と削除済みの印を圧縮形式に統合する。既存の要素は並べ替えないため、計算量は要素数に比例する
+        """
+        if self._n_pending == 0 and self._n_removed == 0:
+            return
+        row = np.array([r for r, pending in self._pending_rows.items() for _ in pending], dtype=np.int64)
+        col = np.array([c for pending in self._pending_rows.values() for c in pending], dtype=np.int64)
+        data = np.array([value for pending in self._pending_rows.values() for value in pending.values()],
+                        dtype=self._data.dtype)
+        csr = _merge_compressed(self._indptr, self._indices, self._data, self._alive,
+                                row, col, data, self.shape[1])
+        csc = _merge_compressed(self._col_indptr, self._col_indices, self._col_data, self._col_alive,
+                                col, row, data, self.shape[0])
+        self._indptr, self._indices, self._data = csr
+        self._col_indptr, self._col_indices, self._col_data = csc
+        self._pending_rows, self._pending_cols, self._n_pending = {}, {}, 0
+        self._alive, self._col_alive, self._n_removed = None, None, 0
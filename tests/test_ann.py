@@ -0,0 +1,100 @@
+import numpy as np
+from ann import RandomProjectionLSH, compare_with_exact
+from recommendation import Recommendation
+import pytest
+
+
+@pytest.fixture
+def vectors_fixture():
+    rng = np.random.default_rng(0)
+    m = rng.standard_normal((50, 20))
+    m[rng.random(m.shape) < 0.5] = 0
+    m[10] = m[3] * 2  # 向きが同じベクトル
+    row, col = np.nonzero(m)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(row, minlength=50))])
+    return m, indptr, col, m[row, col]
+
+
+def test_query_candidates(vectors_fixture):
+    m, indptr, indices, data = vectors_fixture
+    index = RandomProjectionLSH(n_tables=4, n_bits=3).fit(
+        indptr, indices, data, m.shape[1])
+    for i in range(len(m)):
+        query_indices = np.nonzero(m[i])[0]
+        candidates = index.query_candidates(
+            query_indices, m[i, query_indices])
+        assert i in candidates
+        expected = np.where((index._codes == index._codes[i]).any(axis=1))[0]
+        assert candidates.tolist() == expected.tolist()
+    # 向きが同じベクトルは全てのテーブルで同じバケットに入る
+    assert (index._codes[3] == index._codes[10]).all()
+
+
+def test_query_candidates_n_tables(vectors_fixture):
+    m, indptr, indices, data = vectors_fixture
+    query_indices = np.nonzero(m[0])[0]
+    n_candidates = []
+    for n_tables in [1, 4, 16]:
+        index = RandomProjectionLSH(n_tables=n_tables, n_bits=4).fit(
+            indptr, indices, data, m.shape[1])
+        n_candidates.append(
+            len(index.query_candidates(query_indices, m[0, query_indices])))
+    # テーブルを増やすと候補は増える(同じシードでは前のテーブルを含む)
+    assert n_candidates == sorted(n_candidates)
+
+
+@pytest.mark.parametrize('object_type', ['user', 'item'])
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test__get_similar_objects_approximate(object_type, storage):
+    recommendation = Recommendation(storage=storage)
+    if object_type == 'user':
+        object_name = recommendation._get_user_list()[0]
+    else:
+        object_name = recommendation._get_item_list()[0]
+    with pytest.raises(Exception):
+        recommendation._get_similar_objects(
+            object_type, object_name, approximate=True)
+    # 全ての候補を返すようなインデックスでは、厳密な探索と一致する
+    recommendation.build_ann_index(object_type, n_tables=64, n_bits=1)
+    expected = recommendation._get_similar_objects(object_type, object_name)
+    results = recommendation._get_similar_objects(
+        object_type, object_name, approximate=True)
+    assert [k for k, _ in results] == [k for k, _ in expected]
+    assert np.allclose([v for _, v in results], [v for _, v in expected])
+    results = recommendation._get_similar_objects(
+        object_type, object_name, top_n=2, approximate=True)
+    assert len(results) == 2
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('object_type', ['user', 'item'])
+def test__get_similar_objects_approximate_after_update(object_type, storage):
+    recommendation = Recommendation(storage=storage)
+    recommendation.build_ann_index(object_type, n_tables=64, n_bits=1)
+    # インデックスの作成後に、もう一方の次元に追加されたユーザ(アイテム)の評価を含むクエリ
+    if object_type == 'user':
+        object_name = 'Lisa Rose'
+        recommendation.add_item('new item')
+        recommendation.add_ratings([object_name], ['new item'], [4.0])
+    else:
+        object_name = 'Superman Returns'
+        recommendation.add_user('new user')
+        recommendation.add_ratings(['new user'], [object_name], [4.0])
+    expected = recommendation._get_similar_objects(object_type, object_name)
+    results = recommendation._get_similar_objects(object_type, object_name, approximate=True)
+    assert [k for k, _ in results] == [k for k, _ in expected]
+    assert np.allclose([v for _, v in results], [v for _, v in expected])
+
+
+def test_compare_with_exact():
+    recommendation = Recommendation()
+    recommendation.build_ann_index('user', n_tables=64, n_bits=1)
+    sim_matrix = recommendation._get_similarity_matrix('item')
+    results = compare_with_exact(recommendation, 'user', top_n=3)
+    # 計測のためにキャッシュを空にしても、終了後は元のキャッシュに戻る
+    assert list(recommendation._similarity_cache) == [('item', recommendation.metric)]
+    assert recommendation._get_similarity_matrix('item') is sim_matrix
+    assert results['recall'] == 1.0
+    assert 0.0 < results['candidate_ratio'] <= 1.0
+    assert results['exact_seconds'] >= 0
+    assert results['approximate_seconds'] >= 0
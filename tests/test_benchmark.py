@@ -0,0 +1,33 @@
+import numpy as np
+from benchmark import SyntheticRatings, run_benchmarks, compare_results
+
+
+def test_synthetic_ratings_generate():
+    generator = SyntheticRatings(n_users=200, n_items=100, density=0.05,
+                                 popularity_exponent=1.0, rating_probabilities=(0, 0, 1, 0, 0))
+    user_idx, item_idx, ratings = generator.generate()
+    assert len(ratings) == 1000
+    assert len(np.unique(user_idx * 100 + item_idx)) == len(ratings)
+    assert np.all(ratings == 3)
+    counts = np.bincount(item_idx, minlength=100)
+    # 人気上位のアイテムほど多く評価される
+    assert counts[:10].sum() > counts[-10:].sum()
+    # 同じシードなら同じデータになる
+    assert np.array_equal(generator.generate()[0], user_idx)
+
+
+def test_synthetic_ratings_full_density():
+    user_idx, item_idx, ratings = SyntheticRatings(
+        n_users=10, n_items=5, density=1.0).generate()
+    assert len(np.unique(user_idx * 5 + item_idx)) == 50
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(SyntheticRatings(n_users=30, n_items=20, density=0.2),
+                             storage='sparse', n_queries=5, repeats=1)
+    assert set(results['scenarios']) == {
+        'load', 'recommend_user', 'recommend_item', 'similar_users', 'similar_items',
+        'similarity_pair', 'batch_user', 'batch_item'}
+    assert results['scenarios']['recommend_user']['n'] == 5
+    assert results['scenarios']['batch_user']['throughput_per_second'] > 0
+    assert compare_results(results, results) == {}
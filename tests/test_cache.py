@@ -0,0 +1,86 @@
+from cache import ResultCache
+import cache
+import threading
+
+
+def test_result_cache_lru():
+    result_cache = ResultCache(max_entries=2)
+    assert result_cache.get('a') is None
+    result_cache.put('a', [1])
+    result_cache.put('b', [2])
+    assert result_cache.get('a') == [1]
+    # 最も長く使われていないbが追い出される
+    result_cache.put('c', [3])
+    assert result_cache.get('b') is None
+    assert result_cache.get('a') == [1]
+    assert result_cache.get('c') == [3]
+    info = result_cache.info()
+    assert info['hits'] == 3
+    assert info['misses'] == 2
+    assert info['evictions'] == 1
+    assert info['entries'] == 2
+
+
+def test_result_cache_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    result_cache = ResultCache(max_entries=10, ttl=5.0)
+    result_cache.put('a', [1])
+    now[0] += 4.0
+    assert result_cache.get('a') == [1]
+    now[0] += 1.0
+    assert result_cache.get('a') is None
+    info = result_cache.info()
+    assert info['expirations'] == 1
+    assert info['entries'] == 0
+    assert info['bytes'] == 0
+
+
+def test_result_cache_max_bytes():
+    size = cache._estimate_size('a', [1, 2, 3])
+    result_cache = ResultCache(max_entries=0, max_bytes=2 * size)
+    for key in ['a', 'b', 'c']:
+        result_cache.put(key, [1, 2, 3])
+    info = result_cache.info()
+    assert info['entries'] == 2
+    assert info['bytes'] <= 2 * size
+    assert info['evictions'] == 1
+    # 上限より大きいエントリは格納しない
+    result_cache.put('d', list(range(1000)))
+    assert result_cache.get('d') is None
+    assert result_cache.info()['entries'] == 2
+
+
+def test_result_cache_invalidate():
+    result_cache = ResultCache()
+    for key in [('u1', 'user'), ('u1', 'mf'), ('u2', 'mf')]:
+        result_cache.put(key, [])
+    generation = result_cache.generation
+    result_cache.invalidate(lambda key: key[0] == 'u1')
+    assert result_cache.get(('u1', 'mf')) is None
+    assert result_cache.get(('u2', 'mf')) == []
+    assert result_cache.info()['invalidations'] == 2
+    # 無効化の前に計算を始めた結果は格納しない
+    result_cache.put(('u1', 'mf'), [], generation)
+    assert result_cache.get(('u1', 'mf')) is None
+    result_cache.invalidate()
+    assert result_cache.info()['entries'] == 0
+
+
+def test_result_cache_threads():
+    result_cache = ResultCache(max_entries=50)
+
+    def work(offset):
+        for i in range(1000):
+            key = (offset + i) % 80
+            if result_cache.get(key) is None:
+                result_cache.put(key, [key])
+
+    threads = [threading.Thread(target=work, args=(i * 7,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = result_cache.info()
+    assert info['entries'] == 50
+    assert info['hits'] + info['misses'] == 8000
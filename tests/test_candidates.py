@@ -0,0 +1,50 @@
+import numpy as np
+from candidates import PopularItems, CooccurrenceCandidates, _count_cooccurring_items
+from recommendation import Recommendation
+import pytest
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_popular_items(storage):
+    recommendation = Recommendation(storage=storage)
+    user_idx = np.array([0, 1])
+    mask = PopularItems(n=2)(recommendation, user_idx)
+    assert mask.shape == (2, len(recommendation._items))
+    counts = recommendation._item_rating_count
+    assert mask[0].sum() == 2
+    assert counts[mask[0]].min() >= counts[~mask[0]].max()
+    assert np.array_equal(mask[0], mask[1])
+    user_name = recommendation._get_user_list()[0]
+    results = recommendation.get_recommendations(user_name, candidates=PopularItems(n=2))
+    assert set(results) <= set(np.array(recommendation._get_item_list())[mask[0]])
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_cooccurrence_candidates(storage):
+    recommendation = Recommendation(storage=storage)
+    ratings = recommendation.ratings_dict
+    user_list = recommendation._get_user_list()
+    user_idx = np.arange(len(user_list))
+    mask = CooccurrenceCandidates(n=0)(recommendation, user_idx)
+    for row, user_name in enumerate(user_list):
+        rated = set(ratings[user_name])
+        # 共通のアイテムを評価した他のユーザが評価した、未評価のアイテム
+        expected = set()
+        for other, other_ratings in ratings.items():
+            if other != user_name and rated & set(other_ratings):
+                expected |= set(other_ratings) - rated
+        assert {recommendation._items.decode([i])[0] for i in np.where(mask[row])[0]} == expected
+    mask = CooccurrenceCandidates(n=1)(recommendation, user_idx)
+    assert np.all(mask.sum(axis=1) <= 1)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_count_cooccurring_items(storage):
+    recommendation = Recommendation(storage=storage)
+    observed = (Recommendation().matrix != 0).astype(np.float64)
+    # 共通評価数 B Bᵀ (自身を除く) で重み付けした評価数
+    overlap = observed @ observed.T
+    np.fill_diagonal(overlap, 0)
+    user_idx = np.array([3, 0, 5])
+    counts = _count_cooccurring_items(recommendation, user_idx)
+    assert np.allclose(counts, (overlap @ observed)[user_idx])
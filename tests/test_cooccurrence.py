@@ -0,0 +1,51 @@
+import numpy as np
+from cooccurrence import CooccurrenceModel, calc_cooccurrence_counts
+from sparse_matrix import SparseRatingMatrix
+import pytest
+
+
+@pytest.fixture
+def interactions_fixture():
+    rng = np.random.default_rng(0)
+    return (rng.random((30, 12)) < 0.3).astype(np.float64)
+
+
+@pytest.mark.parametrize('max_pairs', [1, 50, 2 ** 24])
+def test_calc_cooccurrence_counts(interactions_fixture, max_pairs):
+    user_idx, item_idx = np.nonzero(interactions_fixture)
+    m = SparseRatingMatrix.from_triplets(user_idx, item_idx, np.ones(len(user_idx)), interactions_fixture.shape)
+    row, col, counts = calc_cooccurrence_counts(m, max_pairs)
+    dense = np.zeros((12, 12))
+    dense[row, col] = counts
+    assert np.array_equal(dense, interactions_fixture.T @ interactions_fixture)
+
+
+@pytest.mark.parametrize('normalization', ['count', 'cosine', 'jaccard', 'lift'])
+def test_cooccurrence_model(interactions_fixture, normalization):
+    user_idx, item_idx = np.nonzero(interactions_fixture)
+    model = CooccurrenceModel(normalization).fit(user_idx, item_idx, interactions_fixture.shape)
+    counts = interactions_fixture.T @ interactions_fixture
+    n = np.diag(counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = {
+            'count': counts,
+            'cosine': counts / np.sqrt(np.outer(n, n)),
+            'jaccard': counts / (n[:, np.newaxis] + n[np.newaxis, :] - counts),
+            'lift': counts * 30 / np.outer(n, n),
+        }[normalization]
+    expected = np.where(counts > 0, expected, 0)
+    np.fill_diagonal(expected, 0)
+    assert np.allclose(model.matrix.toarray(), expected)
+    # スコアは評価済みアイテムの行の和
+    rows, items = np.nonzero(interactions_fixture[:5])
+    scores = model.predict(rows, items, 5, 14)
+    assert scores.shape == (5, 14)
+    assert np.allclose(scores[:, :12], interactions_fixture[:5] @ expected, rtol=1e-5)
+    assert np.all(scores[:, 12:] == 0)
+    item_idx = np.array([3, 13, 0])
+    assert np.allclose(model.predict(rows, items, 5, 14, item_idx), scores[:, item_idx])
+
+
+def test_cooccurrence_model_unknown_normalization():
+    with pytest.raises(Exception):
+        CooccurrenceModel('pmi').fit(np.array([0]), np.array([0]), (1, 1))
@@ -0,0 +1,93 @@
+import numpy as np
+from evaluation import RatingLog, random_split, leave_k_out_split, temporal_split, split_log, \
+    rating_errors, ranking_metrics, evaluate, select_cheapest
+from benchmark import SyntheticRatings
+from recommendation import Recommendation
+import math
+import pytest
+
+
+@pytest.fixture
+def log_fixture():
+    user_idx, item_idx, ratings = SyntheticRatings(n_users=40, n_items=30, density=0.2).generate()
+    return RatingLog(['user{}'.format(u) for u in range(40)], ['item{}'.format(i) for i in range(30)],
+                     user_idx, item_idx, ratings, timestamps=np.arange(len(ratings), dtype=np.float64))
+
+
+def test_splits(log_fixture):
+    n_ratings = len(log_fixture.ratings)
+    test = random_split(n_ratings, test_ratio=0.25)
+    assert test.sum() == round(0.25 * n_ratings)
+    assert np.array_equal(test, random_split(n_ratings, test_ratio=0.25))
+
+    user_idx = np.array([0, 0, 0, 1, 1, 2, 0])
+    timestamps = np.array([5.0, 1.0, 7.0, 2.0, 3.0, 1.0, 6.0])
+    # ユーザごとに最新の2件。評価が2件以下のユーザは全て学習用
+    assert leave_k_out_split(user_idx, k=2, timestamps=timestamps).tolist() == \
+        [False, False, True, False, False, False, True]
+    test = leave_k_out_split(log_fixture.user_idx, k=1)
+    assert np.all(np.bincount(log_fixture.user_idx[test], minlength=40) == 1)
+
+    test = temporal_split(timestamps, test_ratio=0.3)
+    assert test.tolist() == [False, False, True, False, False, False, True]
+    with pytest.raises(Exception):
+        temporal_split(np.array([1.0, np.nan]))
+    assert np.array_equal(split_log(log_fixture, 'temporal', test_ratio=0.1),
+                          log_fixture.timestamps >= n_ratings - round(0.1 * n_ratings))
+    with pytest.raises(Exception):
+        split_log(log_fixture, 'unknown')
+
+
+def test_rating_errors():
+    errors = rating_errors(np.array([3.0, np.nan, 5.0]), np.array([4.0, 1.0, 5.0]))
+    assert errors == {'rmse': math.sqrt(0.5), 'mae': 0.5, 'n': 2}
+
+
+def test_ranking_metrics():
+    recommended = np.array([[0, 1, 2], [3, -1, -1], [1, 2, 3]])
+    # ユーザ0の適合アイテムは1, 4、ユーザ1は3、ユーザ2はなし
+    metrics = ranking_metrics(recommended, np.array([0, 0, 1]), np.array([1, 4, 3]), n_items=5)
+    discounts = 1 / np.log2(np.arange(3) + 2)
+    assert metrics['precision'] == pytest.approx((1 / 3 + 1 / 3) / 2)
+    assert metrics['recall'] == pytest.approx((1 / 2 + 1) / 2)
+    assert metrics['ndcg'] == pytest.approx((discounts[1] / discounts[:2].sum() + 1) / 2)
+    assert metrics['coverage'] == 0.8
+    assert metrics['n_users'] == 2
+
+
+@pytest.mark.parametrize('based', ['user', 'item', 'baseline'])
+def test_evaluate(log_fixture, tmp_path, based):
+    test = split_log(log_fixture, 'leave_k_out', k=2)
+    result = evaluate(log_fixture, test, based=based, k=5, relevance_threshold=4, storage='sparse')
+    assert result['n_test'] == test.sum()
+    assert set(result['seconds']) == {'fit', 'rating', 'ranking', 'total'}
+    # 推薦器を直接使って計算した値と一致する
+    file_name = str(tmp_path / 'train.csv')
+    log_fixture.write(file_name, ~test)
+    recommendation = Recommendation(file_name=file_name, file_format='csv', storage='sparse')
+    errors, relevant = [], {}
+    for u, i, r in zip(log_fixture.user_idx[test], log_fixture.item_idx[test], log_fixture.ratings[test]):
+        user_name, item_name = log_fixture.user_list[u], log_fixture.item_list[i]
+        # 学習用の評価にないアイテムは除く
+        if item_name not in recommendation._items:
+            continue
+        errors.append(recommendation._predict_ratings(user_name, based)[item_name] - r)
+        if r >= 4:
+            relevant.setdefault(user_name, set()).add(item_name)
+    assert result['n_evaluated'] == len(errors)
+    assert result['rating']['rmse'] == pytest.approx(np.sqrt(np.mean(np.square(errors))))
+    n_hits = [len(items & set(recommendation.get_recommendations(user_name, based=based, top_n=5)))
+              for user_name, items in relevant.items()]
+    n_relevant = [len(items) for items in relevant.values()]
+    assert result['ranking']['n_users'] == len(n_relevant)
+    assert result['ranking']['precision'] == pytest.approx(np.mean(np.array(n_hits) / 5))
+    assert result['ranking']['recall'] == pytest.approx(np.mean(np.array(n_hits) / np.array(n_relevant)))
+    assert 0 <= result['ranking']['ndcg'] <= 1
+
+
+def test_select_cheapest(log_fixture):
+    test = split_log(log_fixture, 'random')
+    results = [evaluate(log_fixture, test, based=based, k=5) for based in ['user', 'baseline']]
+    assert select_cheapest(results, 'coverage', 0.0) is min(results, key=lambda r: r['seconds']['total'])
+    assert select_cheapest(results, 'ndcg', 2.0) is None
+    assert select_cheapest(results, 'rmse', 100.0) is not None
@@ -0,0 +1,75 @@
+import numpy as np
+from factorization import BaselineEstimator, MatrixFactorization, _solve_regularized_least_squares
+
+
+def test__solve_regularized_least_squares():
+    rng = np.random.default_rng(0)
+    features = rng.standard_normal((6, 3))
+    indptr = np.array([0, 4, 4, 9])
+    indices = rng.integers(0, 6, 9)
+    targets = rng.standard_normal(9)
+    results = _solve_regularized_least_squares(
+        indptr, indices, targets, features, 0.5, block_size=2)
+    for row in range(3):
+        x = features[indices[indptr[row]:indptr[row + 1]]]
+        t = targets[indptr[row]:indptr[row + 1]]
+        expected = np.linalg.solve(x.T @ x + 0.5 * np.eye(3), x.T @ t)
+        assert np.allclose(results[row], expected)
+    # 要素のない行の解は0となる
+    assert np.all(results[1] == 0)
+    # 要素数で区切るブロックの大きさによらず同じ解となる。1要素ずつでも、全要素を一度でもよい
+    for block_size in [1, 3, 100, None]:
+        assert np.allclose(_solve_regularized_least_squares(
+            indptr, indices, targets, features, 0.5, block_size=block_size), results)
+
+
+def test_matrix_factorization():
+    rng = np.random.default_rng(0)
+    n_users, n_items = 60, 40
+    scores = rng.standard_normal((n_users, 2)) @ rng.standard_normal((2, n_items))
+    user_idx, item_idx = np.where(rng.random((n_users, n_items)) < 0.5)
+    ratings = 3 + scores[user_idx, item_idx]
+    model = MatrixFactorization(n_factors=4, n_epochs=10, regularization=0.1).fit(
+        user_idx, item_idx, ratings, (n_users, n_items))
+    assert model.user_factors.dtype == np.float32
+    assert model.item_factors.shape == (n_items, 4)
+    baseline = np.sqrt(np.mean(np.square(ratings - ratings.mean())))
+    assert model.rmse(user_idx, item_idx, ratings) < 0.2 * baseline
+    predictions = model.predict(np.array([0, n_users]), n_items + 1)
+    assert predictions.shape == (2, n_items + 1)
+    assert np.isclose(predictions[0, 0], model.global_mean + model.user_bias[0] + model.item_bias[0] +
+                      model.user_factors[0] @ model.item_factors[0], atol=1e-5)
+    # 学習後に追加されたユーザ・アイテムはバイアスと因子を0とみなす
+    assert np.allclose(predictions[1, :n_items], model.global_mean + model.item_bias)
+    assert np.isclose(predictions[0, n_items], model.global_mean + model.user_bias[0])
+
+
+def test_baseline_estimator():
+    rng = np.random.default_rng(0)
+    n_users, n_items = 30, 20
+    user_idx, item_idx = np.where(rng.random((n_users, n_items)) < 0.3)
+    ratings = rng.integers(1, 6, len(user_idx)).astype(float)
+    model = BaselineEstimator(n_epochs=2, user_regularization=5.0, item_regularization=10.0).fit(
+        user_idx, item_idx, ratings, (n_users, n_items))
+    # 閉じた式の交互の更新を素朴に計算した結果と一致する
+    mu = ratings.mean()
+    user_bias = np.zeros(n_users)
+    item_bias = np.zeros(n_items)
+    for _ in range(2):
+        for i in range(n_items):
+            rows = item_idx == i
+            item_bias[i] = np.sum(ratings[rows] - mu - user_bias[user_idx[rows]]) / (10.0 + rows.sum())
+        for u in range(n_users):
+            rows = user_idx == u
+            user_bias[u] = np.sum(ratings[rows] - mu - item_bias[item_idx[rows]]) / (5.0 + rows.sum())
+    assert np.isclose(model.global_mean, mu)
+    assert np.allclose(model.user_bias, user_bias)
+    assert np.allclose(model.item_bias, item_bias)
+    predictions = model.predict(np.array([0, n_users]), n_items + 1)
+    assert np.allclose(predictions[0, :n_items], mu + user_bias[0] + item_bias)
+    # 学習後に追加されたユーザ・アイテムはバイアスを0とみなす
+    assert np.allclose(predictions[1, :n_items], mu + item_bias)
+    assert np.isclose(predictions[0, n_items], mu + user_bias[0])
+    padded_user_bias, padded_item_bias = model.get_biases(n_users + 2, n_items - 1)
+    assert np.allclose(padded_user_bias, np.concatenate([user_bias, [0, 0]]))
+    assert np.allclose(padded_item_bias, item_bias[:-1])
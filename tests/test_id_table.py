@@ -0,0 +1,27 @@
+from id_table import IdTable
+import numpy as np
+import pytest
+
+
+def test_id_table():
+    table = IdTable(['b', 'a'])
+    assert len(table) == 2
+    assert table['b'] == 0
+    assert 'a' in table
+    assert table.get('c') is None
+    # 登録済みの名前は既存のコードを返す
+    assert table.add('a') == 1
+    for i in range(20):
+        assert table.add('x{}'.format(i)) == i + 2
+    assert len(table) == 22
+    assert table.names.dtype == object
+    assert table.names.tolist()[:3] == ['b', 'a', 'x0']
+    codes = table.encode(['x3', 'b'])
+    assert codes.dtype == np.int32
+    assert codes.tolist() == [5, 0]
+    assert table.decode(codes) == ['x3', 'b']
+    assert list(table)[:2] == ['b', 'a']
+    with pytest.raises(KeyError):
+        table.encode(['unknown'])
+    with pytest.raises(Exception):
+        IdTable(['a', 'a'])
@@ -0,0 +1,69 @@
+from instrumentation import Registry, profile, registry
+from recommendation import Recommendation
+import json
+import pytest
+
+
+@pytest.fixture
+def enabled_registry():
+    registry.reset()
+    registry.enable()
+    yield registry
+    registry.disable()
+    registry.reset()
+
+
+def test_registry():
+    local_registry = Registry()
+    with local_registry.timer('stage'):
+        pass
+    local_registry.increment('counter')
+    assert local_registry.snapshot() == {'stages': {}, 'counters': {}}
+    local_registry.enable()
+    for _ in range(3):
+        with local_registry.timer('stage'):
+            pass
+    local_registry.increment('counter', 2)
+
+    @local_registry.timed('function')
+    def function(x):
+        return x + 1
+
+    assert function(1) == 2
+    values = json.loads(local_registry.to_json())
+    assert values['stages']['stage']['count'] == 3
+    assert values['stages']['function']['count'] == 1
+    assert values['stages']['stage']['max_seconds'] <= values['stages']['stage']['total_seconds']
+    assert values['counters'] == {'counter': 2}
+    text = local_registry.to_prometheus()
+    assert 'recommendation_stage_calls_total{stage="stage"} 3' in text
+    assert 'recommendation_counter_total 2' in text
+    local_registry.reset()
+    assert local_registry.snapshot() == {'stages': {}, 'counters': {}}
+
+
+def test_recommendation_instrumentation(enabled_registry):
+    recommendation = Recommendation(cache_size=10)
+    user_name = recommendation._get_user_list()[0]
+    for based in ['user', 'item']:
+        recommendation.get_recommendations(user_name, based=based)
+    recommendation.get_recommendations(user_name, based='item')
+    values = enabled_registry.snapshot()
+    for stage in ['load', 'similarity', 'predict', 'offsets', 'neighbors', 'sort', 'get_recommendations']:
+        assert values['stages'][stage]['count'] > 0
+    counters = values['counters']
+    n_users = len(recommendation._get_user_list())
+    n_items = len(recommendation._get_item_list())
+    assert counters['similarity_evaluations'] == n_users * n_users + n_items * n_items
+    assert counters['similarity_cache_misses'] == 2
+    assert counters['neighbors_considered'] == n_users + n_items
+    assert counters['result_cache_hits'] == 1
+    assert counters['result_cache_misses'] == 2
+
+
+def test_profile():
+    recommendation = Recommendation()
+    with profile(limit=5) as result:
+        recommendation.get_recommendations(recommendation._get_user_list()[0])
+    assert 'get_recommendations' in result['report']
+    assert result['stats'].total_calls > 0
@@ -0,0 +1,132 @@
+import pytest
+import numpy as np
+import json
+from loader import load_triplets, load_triplets_with_timestamps
+
+
+@pytest.fixture
+def triplets_fixture():
+    return [('u1', 'i1', 3.0), ('u2', 'i1', 4.5), ('u1', 'i2', 1.0),
+            ('u3', 'i3', 5.0), ('u2', 'i1', 2.0)]
+
+
+def _write_csv(path, triplets, header):
+    with open(path, 'w') as f:
+        if header:
+            f.write('user,item,rating\n')
+        for user, item, rating in triplets:
+            f.write('{},{},{}\n'.format(user, item, rating))
+
+
+def _write_jsonl(path, triplets):
+    with open(path, 'w') as f:
+        for user, item, rating in triplets:
+            f.write(json.dumps(
+                {'user': user, 'item': item, 'rating': rating}) + '\n')
+
+
+@pytest.mark.parametrize('file_format,header', [
+    ('csv', True), ('csv', False), ('jsonl', False)
+], ids=['csv_with_header', 'csv_without_header', 'jsonl'])
+@pytest.mark.parametrize('chunk_size', [1, 2, 100])
+def test_load_triplets(tmp_path, triplets_fixture, file_format, header, chunk_size):
+    file_name = str(tmp_path / 'ratings')
+    if file_format == 'csv':
+        _write_csv(file_name, triplets_fixture, header)
+    else:
+        _write_jsonl(file_name, triplets_fixture)
+    user_list, item_list, user_idx, item_idx, ratings = load_triplets(
+        file_name, file_format, chunk_size)
+    assert user_list == ['u1', 'u2', 'u3']  # 最初に現れた順
+    assert item_list == ['i1', 'i2', 'i3']
+    results = [(user_list[u], item_list[i], r)
+               for u, i, r in zip(user_idx, item_idx, ratings)]
+    assert results == triplets_fixture
+    assert user_idx.dtype == np.int64
+    assert ratings.dtype == np.float64
+
+
+def test_load_triplets_empty(tmp_path):
+    file_name = str(tmp_path / 'ratings.csv')
+    _write_csv(file_name, [], header=True)
+    user_list, item_list, user_idx, item_idx, ratings = load_triplets(
+        file_name, 'csv')
+    assert user_list == [] and item_list == []
+    assert len(user_idx) == len(item_idx) == len(ratings) == 0
+
+
+def test_load_triplets_unknown_format(tmp_path):
+    file_name = str(tmp_path / 'ratings.csv')
+    _write_csv(file_name, [], header=True)
+    with pytest.raises(Exception):
+        load_triplets(file_name, 'xml')
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+def test_load_triplets_with_timestamps(tmp_path, file_format):
+    file_name = str(tmp_path / 'ratings')
+    with open(file_name, 'w') as f:
+        if file_format == 'csv':
+            f.write('user,item,rating,timestamp\nu1,i1,3,100\nu2,i1,4,\nu1,i2,1,50\n')
+        else:
+            f.write('{"user": "u1", "item": "i1", "rating": 3, "timestamp": 100}\n'
+                    '{"user": "u2", "item": "i1", "rating": 4}\n'
+                    '{"user": "u1", "item": "i2", "rating": 1, "timestamp": 50}\n')
+    user_list, item_list, user_idx, item_idx, ratings, timestamps = load_triplets_with_timestamps(
+        file_name, file_format, chunk_size=2)
+    assert user_list == ['u1', 'u2']
+    assert ratings.tolist() == [3.0, 4.0, 1.0]
+    assert timestamps[0] == 100 and np.isnan(timestamps[1]) and timestamps[2] == 50
+    # タイムスタンプの列は読み飛ばされる
+    assert load_triplets(file_name, file_format)[4].tolist() == [3.0, 4.0, 1.0]
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+def test_load_triplets_without_rating(tmp_path, file_format):
+    file_name = str(tmp_path / 'events')
+    with open(file_name, 'w') as f:
+        if file_format == 'csv':
+            f.write('user,item\nu1,i1\nu2,i1\n')
+        else:
+            f.write('{"user": "u1", "item": "i1"}\n{"user": "u2", "item": "i1"}\n')
+    user_list, item_list, user_idx, item_idx, ratings = load_triplets(file_name, file_format)
+    assert user_list == ['u1', 'u2'] and item_list == ['i1']
+    # 評価値がない場合は1とする
+    assert ratings.tolist() == [1.0, 1.0]
+
+
+@pytest.mark.parametrize('header', ['User,Item', ' user , item ', '\ufeffuser,item', 'USER,ITEM', '\nuser,item'])
+def test_load_triplets_without_rating_header_variants(tmp_path, header):
+    file_name = str(tmp_path / 'events')
+    with open(file_name, 'w', encoding='utf-8') as f:
+        f.write(header + '\nu1,i1\nu2,i1\n')
+    user_list, item_list, user_idx, item_idx, ratings = load_triplets(file_name)
+    # 表記の揺れたヘッダも読み飛ばす
+    assert user_list == ['u1', 'u2'] and item_list == ['i1']
+    assert ratings.tolist() == [1.0, 1.0]
+
+
+@pytest.mark.parametrize('content', [
+    '\ufeffu1,i1,3\nu2,i1,4\n', '\ufeffuser,item,rating\nu1,i1,3\nu2,i1,4\n',
+    '\n\nuser,item,rating\nu1,i1,3\nu2,i1,4\n', '\ufeffu1,i1\nu2,i1\n',
+], ids=['bom_without_header', 'bom_with_header', 'blank_lines_before_header', 'bom_without_rating'])
+def test_load_triplets_bom_and_blank_lines(tmp_path, content):
+    file_name = str(tmp_path / 'ratings.csv')
+    with open(file_name, 'w', encoding='utf-8') as f:
+        f.write(content)
+    user_list, item_list, user_idx, item_idx, ratings = load_triplets(file_name)
+    # BOMはユーザ名に含まれず、空行の後のヘッダも読み飛ばす
+    assert user_list == ['u1', 'u2'] and item_list == ['i1']
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+def test_load_triplets_invalid_timestamp(tmp_path, file_format):
+    file_name = str(tmp_path / 'ratings')
+    with open(file_name, 'w') as f:
+        if file_format == 'csv':
+            f.write('u1,i1,3,100\n\nu2,i1,4,yesterday\n')
+        else:
+            f.write('{"user": "u1", "item": "i1", "rating": 3, "timestamp": 100}\n\n'
+                    '{"user": "u2", "item": "i1", "rating": 4, "timestamp": "yesterday"}\n')
+    with pytest.raises(Exception, match='line 3'):
+        load_triplets_with_timestamps(file_name, file_format)
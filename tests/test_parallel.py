@@ -0,0 +1,22 @@
+import json
+from parallel import precompute_recommendations
+from recommendation import Recommendation
+import pytest
+
+
+@pytest.mark.parametrize('storage,based', [
+    ('dense', 'user'), ('dense', 'item'), ('sparse', 'user'), ('sparse', 'item')
+])
+def test_precompute_recommendations(tmp_path, storage, based):
+    recommendation = Recommendation(storage=storage)
+    output_file = str(tmp_path / 'recommendations.jsonl')
+    report = precompute_recommendations(
+        recommendation, output_file, based=based, top_n=2, n_workers=2, chunk_size=2)
+    expected = recommendation.get_recommendations_batch(
+        recommendation._get_user_list(), based=based, top_n=2)
+    with open(output_file) as f:
+        results = [json.loads(line) for line in f]
+    assert [r['user'] for r in results] == recommendation._get_user_list()
+    assert {r['user']: r['items'] for r in results} == expected
+    assert report['n_users'] == len(expected)
+    assert report['users_per_second'] > 0
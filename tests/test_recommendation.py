@@ -1,7 +1,12 @@
 import numpy as np
-from recommendation import Recommendation
+from recommendation import Recommendation, _select_top_n
+from benchmark import SyntheticRatings
 import pytest
+import copy
+import json
 import math
+import pickle
+import threading
 
 
 @pytest.fixture
@@ -187,3 +192,830 @@ def test__calculate_average_ratings(recommendation_fixture, recommendation_fixtu
     assert 1.0 <= mu <= 5.0
     with pytest.raises(Exception):
         recommendation_fixture_special_user._calculate_average_ratings()
+
+
+@pytest.mark.parametrize('object_type', ['user', 'item'])
+@pytest.mark.parametrize('metric', ['euclidean', 'pearson', 'cosine', 'adjusted_cosine', 'jaccard'])
+def test__get_similarity_matrix(recommendation_fixture, object_type, metric):
+    sim_matrix = recommendation_fixture._get_similarity_matrix(
+        object_type, metric)
+    if object_type == 'user':
+        object_list = recommendation_fixture._get_user_list()
+    else:
+        object_list = recommendation_fixture._get_item_list()
+    assert sim_matrix.shape == (len(object_list), len(object_list))
+    for i, name_1 in enumerate(object_list):
+        for j, name_2 in enumerate(object_list):
+            expected = recommendation_fixture._calc_similarity_with_missing_value_by_name(
+                object_type, name_1, name_2, metric)
+            assert np.isclose(sim_matrix[i, j], expected)
+    # 2回目以降はキャッシュが返る
+    assert recommendation_fixture._get_similarity_matrix(
+        object_type, metric) is sim_matrix
+
+
+@pytest.fixture
+def recommendation_fixture_sparse():
+    recommendation = Recommendation(storage='sparse')
+    return recommendation
+
+
+def test__load_ratings_sparse(recommendation_fixture, recommendation_fixture_sparse):
+    sparse_matrix = recommendation_fixture_sparse.matrix
+    assert sparse_matrix.shape == recommendation_fixture.matrix.shape
+    assert sparse_matrix.nnz == np.count_nonzero(recommendation_fixture.matrix)
+    assert (sparse_matrix.toarray() == recommendation_fixture.matrix).all()
+    with pytest.raises(Exception):
+        Recommendation(storage='unknown')
+
+
+def test_sparse_storage_accessors(recommendation_fixture, recommendation_fixture_sparse):
+    dense, sparse = recommendation_fixture, recommendation_fixture_sparse
+    for user_name in dense._get_user_list():
+        assert (dense._get_ratings_for_one_user(user_name) ==
+                sparse._get_ratings_for_one_user(user_name)).all()
+        assert dense._get_item_list_rated_by(
+            user_name) == sparse._get_item_list_rated_by(user_name)
+        assert dense._get_item_list_not_rated_by(
+            user_name) == sparse._get_item_list_not_rated_by(user_name)
+        assert np.isclose(dense._get_average_rating_for_one_user(user_name),
+                          sparse._get_average_rating_for_one_user(user_name))
+    for item_name in dense._get_item_list():
+        assert (dense._get_ratings_for_one_item(item_name) ==
+                sparse._get_ratings_for_one_item(item_name)).all()
+        assert dense._get_user_who_rated_item(
+            item_name) == sparse._get_user_who_rated_item(item_name)
+        assert np.isclose(dense._get_average_rating_for_one_item(item_name),
+                          sparse._get_average_rating_for_one_item(item_name))
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('shrinkage,min_overlap', [(10.0, 0), (0.0, 3), (5.0, 2)])
+def test_similarity_shrinkage(storage, shrinkage, min_overlap):
+    recommendation = Recommendation(
+        storage=storage, shrinkage=shrinkage, min_overlap=min_overlap)
+    raw = Recommendation(storage=storage)
+    user_list = recommendation._get_user_list()
+    for i, name_1 in enumerate(user_list):
+        row = recommendation._get_similarity_row('user', i)
+        for j, name_2 in enumerate(user_list):
+            expected = recommendation._calc_similarity_with_missing_value_by_name(
+                'user', name_1, name_2)
+            assert np.isclose(row[j], expected)
+            n = np.count_nonzero((recommendation._get_ratings_for_one_user(name_1) != 0) &
+                                 (recommendation._get_ratings_for_one_user(name_2) != 0))
+            if n < min_overlap:
+                assert row[j] == 0
+            else:
+                assert np.isclose(row[j], raw._get_similarity_row('user', i)[j] * n / (n + shrinkage))
+    # 近似最近傍探索でも同じ縮小を行う
+    recommendation.build_ann_index('user', n_tables=32, n_bits=1)
+    candidates, sim_list = recommendation._get_similar_objects_approximately('user', 0)
+    assert np.allclose(sim_list, recommendation._get_similarity_row('user', 0)[candidates])
+
+
+def test_save_snapshot_shrinkage(tmp_path):
+    recommendation = Recommendation(shrinkage=10.0)
+    recommendation._get_similarity_matrix('user')
+    recommendation.save_snapshot(str(tmp_path), include_similarity=True)
+    loaded = Recommendation(file_name=str(tmp_path), file_format='snapshot', shrinkage=10.0)
+    assert ('user', 'euclidean') in loaded._similarity_cache
+    # 縮小の設定が異なる場合は保存された類似度を使わない
+    loaded = Recommendation(file_name=str(tmp_path), file_format='snapshot')
+    assert ('user', 'euclidean') not in loaded._similarity_cache
+    assert np.allclose(loaded._get_similarity_matrix('user'),
+                       Recommendation()._get_similarity_matrix('user'))
+
+
+@pytest.mark.parametrize('metric', ['cosine', 'adjusted_cosine', 'jaccard'])
+def test_sparse_storage_similarity_metrics(recommendation_fixture, recommendation_fixture_sparse, metric):
+    for object_type in ['user', 'item']:
+        expected = recommendation_fixture._get_similarity_matrix(object_type, metric)
+        for idx in range(len(expected)):
+            assert np.allclose(recommendation_fixture_sparse._get_similarity_row(object_type, idx, metric),
+                               expected[idx])
+
+
+@pytest.mark.parametrize('based', ['user', 'item'])
+def test_sparse_storage_predictions(recommendation_fixture, recommendation_fixture_sparse, based):
+    for object_type in ['user', 'item']:
+        assert np.allclose(recommendation_fixture._get_similarity_matrix(object_type),
+                           recommendation_fixture_sparse._get_similarity_matrix(object_type))
+    for user_name in recommendation_fixture._get_user_list():
+        expected = recommendation_fixture._predict_ratings(user_name, based)
+        results = recommendation_fixture_sparse._predict_ratings(
+            user_name, based)
+        assert expected.keys() == results.keys()
+        for k in expected:
+            assert np.isclose(expected[k], results[k])
+
+
+@pytest.mark.parametrize('based', ['user', 'item'])
+@pytest.mark.parametrize('debiasing', [True, False])
+def test_get_recommendations_batch(recommendation_fixture, recommendation_fixture_sparse, based, debiasing):
+    user_list = recommendation_fixture._get_user_list()
+    for fixture in [recommendation_fixture, recommendation_fixture_sparse]:
+        results = fixture.get_recommendations_batch(
+            user_list, based=based, debiasing=debiasing, block_size=3)
+        assert list(results.keys()) == user_list
+        for user_name in user_list:
+            predictions = recommendation_fixture._predict_ratings(
+                user_name, based, debiasing)
+            assert sorted(results[user_name]) == sorted(predictions)
+            ratings = [predictions[k] for k in results[user_name]]
+            assert ratings == sorted(ratings, reverse=True)
+        results = fixture.get_recommendations_batch(
+            user_list, based=based, top_n=1, debiasing=debiasing)
+        for user_name in user_list:
+            assert len(results[user_name]) <= 1
+
+
+def test_get_recommendations_batch_special_user(recommendation_fixture_special_user):
+    user_list = recommendation_fixture_special_user._get_user_list()
+    results = recommendation_fixture_special_user.get_recommendations_batch(
+        user_list)
+    assert results == {user_list[0]: []}
+
+
+def test__calc_rating_statistics(recommendation_fixture, recommendation_fixture_sparse):
+    for fixture in [recommendation_fixture, recommendation_fixture_sparse]:
+        for user_name in fixture._get_user_list():
+            ratings = list(fixture.ratings_dict[user_name].values())
+            user_idx = fixture._user_dic[user_name]
+            assert fixture._user_rating_count[user_idx] == len(ratings)
+            assert np.isclose(fixture._get_average_ratings(
+                'user')[user_idx], np.mean(ratings))
+        for item_name in fixture._get_item_list():
+            ratings = [v[item_name]
+                       for v in fixture.ratings_dict.values() if item_name in v]
+            item_idx = fixture._item_dic[item_name]
+            assert fixture._item_rating_count[item_idx] == len(ratings)
+            assert np.isclose(fixture._get_average_ratings(
+                'item')[item_idx], np.mean(ratings))
+        all_ratings = [r for v in fixture.ratings_dict.values()
+                       for r in v.values()]
+        assert np.isclose(fixture._calculate_average_ratings(),
+                          np.mean(all_ratings))
+    # 評価値を変更した後に再計算すると平均評価値も追従する
+    user_name = recommendation_fixture._get_user_list()[0]
+    recommendation_fixture.matrix[recommendation_fixture._user_dic[user_name]] = 0
+    recommendation_fixture._calc_rating_statistics()
+    with pytest.raises(Exception):
+        recommendation_fixture._get_average_rating_for_one_user(user_name)
+
+
+@pytest.mark.parametrize('values,top_n,expected', [
+    (np.array([1.0, 3.0, 2.0]), 0, [1, 2, 0]),
+    (np.array([1.0, 3.0, 2.0]), 2, [1, 2]),
+    (np.array([2.0, 1.0, 2.0, 2.0]), 2, [0, 2]),
+    (np.array([1.0, 3.0]), 5, [1, 0]),
+    (np.array([]), 1, []),
+], ids=['all', 'top_n', 'ties', 'top_n_larger_than_size', 'empty'])
+def test__select_top_n(values, top_n, expected):
+    assert _select_top_n(values, top_n).tolist() == expected
+
+
+def test__get_similar_objects_top_n(recommendation_fixture):
+    user_name = recommendation_fixture._get_user_list()[0]
+    user_sim = recommendation_fixture._get_similar_objects('user', user_name)
+    assert recommendation_fixture._get_similar_objects(
+        'user', user_name, top_n=3) == user_sim[:3]
+
+
+def _predict_ratings_knn_naive(recommendation, user_name, based, n_neighbors):
+    # 上位n_neighbors件の近傍のみを使う予測のループによる実装
+    predictions = {}
+    for item_name in recommendation._get_item_list_not_rated_by(user_name):
+        if based == 'user':
+            bias = recommendation._get_average_rating_for_one_user(user_name)
+            neighbors = [(recommendation._calc_similarity_with_missing_value_by_name(
+                'user', user_name, other),
+                recommendation._get_rating(other, item_name) -
+                recommendation._get_average_rating_for_one_user(other))
+                for other in recommendation._get_user_who_rated_item(item_name)]
+        else:
+            bias = recommendation._get_average_rating_for_one_item(item_name)
+            neighbors = [(recommendation._calc_similarity_with_missing_value_by_name(
+                'item', item_name, other),
+                recommendation._get_rating(user_name, other) -
+                recommendation._get_average_rating_for_one_item(other))
+                for other in recommendation._get_item_list_rated_by(user_name)]
+        neighbors = sorted(neighbors, key=lambda x: x[0], reverse=True)[
+            :n_neighbors]
+        sum_similarity = sum(abs(sim) for sim, _ in neighbors)
+        weighted_sum = sum(sim * rating for sim, rating in neighbors)
+        predictions[item_name] = bias + \
+            (weighted_sum / sum_similarity if sum_similarity != 0 else 0)
+    return predictions
+
+
+@pytest.mark.parametrize('based', ['user', 'item'])
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('n_neighbors', [1, 2, 100])
+def test__predict_ratings_n_neighbors(based, storage, n_neighbors):
+    recommendation = Recommendation(
+        storage=storage, n_neighbors=n_neighbors)
+    for user_name in recommendation._get_user_list():
+        expected = _predict_ratings_knn_naive(
+            recommendation, user_name, based, n_neighbors)
+        results = recommendation._predict_ratings(user_name, based)
+        assert expected.keys() == results.keys()
+        for k in expected:
+            assert np.isclose(expected[k], results[k])
+
+
+def _assert_same_state(results, expected):
+    # 差分更新した結果と、同じデータを読み込み直した結果が一致することを確認する
+    assert sorted(results._get_user_list()) == sorted(
+        expected._get_user_list())
+    assert sorted(results._get_item_list()) == sorted(
+        expected._get_item_list())
+    assert results.ratings_dict == expected.ratings_dict
+    for user_name in expected._get_user_list():
+        for item_name in expected._get_item_list():
+            assert results._get_ratings_for_one_user(user_name)[results._item_dic[item_name]] == \
+                expected._get_ratings_for_one_user(
+                    user_name)[expected._item_dic[item_name]]
+        if expected._user_rating_count[expected._user_dic[user_name]] > 0:
+            assert np.isclose(results._get_average_rating_for_one_user(user_name),
+                              expected._get_average_rating_for_one_user(user_name))
+    for item_name in expected._get_item_list():
+        assert np.isclose(results._get_average_rating_for_one_item(item_name),
+                          expected._get_average_rating_for_one_item(item_name), equal_nan=True)
+    assert np.isclose(results._calculate_average_ratings(),
+                      expected._calculate_average_ratings())
+    for object_type in ['user', 'item']:
+        if object_type == 'user':
+            object_list = expected._get_user_list()
+        else:
+            object_list = expected._get_item_list()
+        for name in object_list:
+            results_sim = dict(
+                (k, v) for k, v in results._get_similar_objects(object_type, name))
+            expected_sim = dict(
+                (k, v) for k, v in expected._get_similar_objects(object_type, name))
+            assert results_sim.keys() == expected_sim.keys()
+            for k in expected_sim:
+                assert np.isclose(results_sim[k], expected_sim[k])
+    for user_name in expected._get_user_list():
+        if expected._user_rating_count[expected._user_dic[user_name]] == 0:
+            continue
+        for based in ['user', 'item']:
+            results_ratings = results._predict_ratings(user_name, based)
+            expected_ratings = expected._predict_ratings(user_name, based)
+            assert results_ratings.keys() == expected_ratings.keys()
+            for k in expected_ratings:
+                assert np.isclose(
+                    results_ratings[k], expected_ratings[k], equal_nan=True)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_add_and_remove_rating(tmp_path, storage):
+    recommendation = Recommendation(storage=storage)
+    # 類似度のキャッシュを作っておき、更新で正しく無効化されることを確認する
+    recommendation._get_similarity_matrix('user')
+    recommendation._get_similarity_matrix('item', 'pearson')
+    recommendation._get_similar_objects('user', 'Toby')
+    for metric in ['adjusted_cosine', 'jaccard']:
+        recommendation._get_similarity_rows('user', np.arange(3), metric)
+    user_list = recommendation._get_user_list()
+    ratings = recommendation.ratings_dict
+    expected_ratings = copy.deepcopy(ratings)
+
+    recommendation.add_rating('Toby', 'Lady in the Water', 4.5)  # 新規
+    expected_ratings['Toby']['Lady in the Water'] = 4.5
+    recommendation.add_rating('Lisa Rose', 'Just My Luck', 1.0)  # 更新
+    expected_ratings['Lisa Rose']['Just My Luck'] = 1.0
+    recommendation.remove_rating(user_list[1], 'Superman Returns')  # 削除
+    del expected_ratings[user_list[1]]['Superman Returns']
+    # 新しいユーザとアイテム
+    recommendation.add_ratings(['New User', 'New User', 'Toby', 'New User'],
+                               ['New Movie', 'Just My Luck',
+                                'New Movie', 'New Movie'],
+                               [2.0, 3.0, 5.0, 4.0])
+    expected_ratings['New User'] = {'New Movie': 4.0, 'Just My Luck': 3.0}
+    expected_ratings['Toby']['New Movie'] = 5.0
+    recommendation.add_user('Cold User')
+    recommendation.add_item('Cold Movie')
+    expected_ratings['Cold User'] = {}
+    with pytest.raises(Exception):
+        recommendation.remove_rating('Cold User', 'Cold Movie')
+
+    file_name = tmp_path / 'ratings.json'
+    with open(file_name, 'w') as f:
+        json.dump(expected_ratings, f)
+    expected = Recommendation(file_name=str(file_name), storage=storage)
+    expected.add_item('Cold Movie')
+    _assert_same_state(recommendation, expected)
+    for metric in ['adjusted_cosine', 'jaccard']:
+        # 名前の並びが異なるため、名前で対応づけて比較する
+        order = [recommendation._user_dic[name] for name in expected._get_user_list()]
+        results = recommendation._get_similarity_rows('user', np.array(order), metric)[:, order]
+        assert np.allclose(results, expected._get_similarity_rows(
+            'user', np.arange(len(order)), metric))
+
+
+def test_add_user_amortized_growth():
+    recommendation = Recommendation()
+    for i in range(100):
+        recommendation.add_rating(
+            'user{}'.format(i), 'item{}'.format(i), 3.0)
+    n_users = len(recommendation._get_user_list())
+    n_items = len(recommendation._get_item_list())
+    assert recommendation.matrix.shape == (n_users, n_items)
+    assert recommendation.matrix.base.shape[0] >= n_users
+    assert recommendation._user_mean.shape == (n_users,)
+    assert recommendation._get_average_rating_for_one_user('user99') == 3.0
+    with pytest.raises(Exception):
+        recommendation.add_rating('user0', 'item1', 0.0)  # 欠損値と同じ値
+
+
+@pytest.mark.parametrize('metric', ['euclidean', 'pearson', 'cosine', 'jaccard'])
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_similarity_matrix_incremental_update(storage, metric):
+    recommendation = Recommendation(storage=storage, metric=metric, shrinkage=2.0)
+    for object_type in ['user', 'item']:
+        recommendation._get_similarity_matrix(object_type)
+    items = recommendation._get_item_list()
+    rng = np.random.default_rng(0)
+    for i in range(12):
+        # 新しいユーザとアイテム、既存のユーザの評価を混ぜて追加する
+        recommendation.add_rating('user{}'.format(i % 5), 'item{}'.format(i % 3), float(rng.integers(1, 6)))
+        recommendation.add_rating('Toby', items[rng.integers(len(items))], float(rng.integers(1, 6)))
+        for object_type in ['user', 'item']:
+            n_objects = recommendation._get_n_objects(object_type)
+            expected = recommendation._calc_similarity_rows(object_type, np.arange(n_objects), metric)
+            assert np.allclose(recommendation._get_similarity_matrix(object_type), expected, atol=1e-6)
+    # 追加のたびに類似度行列をコピーせず、容量を倍々に確保したバッファのビューを広げる
+    sim_matrix = recommendation._get_similarity_matrix('user')
+    assert sim_matrix.base is recommendation._buffers[('_similarity_cache', 'user', metric)]
+    if storage == 'dense':
+        # 比較対象側の前処理済みの行列をキャッシュし、評価値が変わった行だけを前処理し直す
+        assert len(recommendation._similarity_operands[('user', metric)][0]) == len(sim_matrix)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_save_snapshot(tmp_path, storage):
+    recommendation = Recommendation(storage=storage)
+    recommendation._get_similarity_matrix('user')
+    recommendation._get_similarity_matrix('item', 'pearson')
+    path = str(tmp_path / 'snapshot')
+    recommendation.save_snapshot(path, include_similarity=True)
+    loaded = Recommendation(
+        file_name=path, file_format='snapshot', storage=storage)
+    assert loaded._get_user_list() == recommendation._get_user_list()
+    assert loaded._get_item_list() == recommendation._get_item_list()
+    assert (loaded._similarity_cache.keys() ==
+            recommendation._similarity_cache.keys())
+    _assert_same_state(loaded, recommendation)
+    # 読み込んだ後も差分更新できる
+    loaded.add_rating('Toby', 'Lady in the Water', 4.5)
+    recommendation.add_rating('Toby', 'Lady in the Water', 4.5)
+    _assert_same_state(loaded, recommendation)
+    # 類似度を保存しない場合は、キャッシュは空となる
+    recommendation.save_snapshot(path)
+    loaded = Recommendation(
+        file_name=path, file_format='snapshot', storage=storage)
+    assert loaded._similarity_cache == {}
+
+
+def test_load_snapshot_mismatch(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    Recommendation().save_snapshot(path)
+    with pytest.raises(Exception):
+        Recommendation(file_name=path, file_format='snapshot',
+                       storage='sparse')
+    with pytest.raises(Exception):
+        Recommendation(file_name=path, file_format='snapshot',
+                       missing_value=-1)
+    with pytest.raises(Exception):
+        Recommendation(file_name=path, file_format='unknown')
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'jsonl'])
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test__load_ratings_log(tmp_path, recommendation_fixture, file_format, storage):
+    file_name = str(tmp_path / 'ratings.{}'.format(file_format))
+    with open(file_name, 'w') as f:
+        if file_format == 'csv':
+            f.write('user,item,rating\n')
+        for user_name, user_ratings in recommendation_fixture.ratings_dict.items():
+            for item_name, rating in user_ratings.items():
+                if file_format == 'csv':
+                    f.write('"{}","{}",{}\n'.format(
+                        user_name, item_name, rating))
+                else:
+                    f.write(json.dumps(
+                        {'user': user_name, 'item': item_name, 'rating': rating}) + '\n')
+    recommendation = Recommendation(
+        file_name=file_name, file_format=file_format, storage=storage, chunk_size=7)
+    assert recommendation._get_user_list() == recommendation_fixture._get_user_list()
+    assert recommendation._get_item_list() == recommendation_fixture._get_item_list()
+    _assert_same_state(recommendation, recommendation_fixture)
+
+
+def test__get_rating_not_rated(recommendation_fixture):
+    user_name = 'Toby'
+    item_name = recommendation_fixture._get_item_list_not_rated_by(user_name)[
+        0]
+    with pytest.raises(Exception):
+        recommendation_fixture._get_rating(user_name, item_name)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('based', ['user', 'item'])
+def test_fit_neighbors(storage, based):
+    recommendation = Recommendation(storage=storage)
+    user_list = recommendation._get_user_list()
+    expected = {user_name: recommendation._predict_ratings(user_name, based)
+                for user_name in user_list}
+    n_objects = recommendation._get_n_objects(based)
+    # 自身以外の全てを近傍とすると、近傍リストを使わない予測と一致する
+    indices, scores = recommendation.fit_neighbors(based, k=n_objects + 10)
+    assert indices.dtype == np.int32 and scores.dtype == np.float32
+    assert indices.shape == (n_objects, n_objects - 1)
+    assert not np.any(indices == np.arange(n_objects)[:, np.newaxis])
+    for user_name in user_list:
+        results = recommendation._predict_ratings(user_name, based)
+        assert expected[user_name].keys() == results.keys()
+        for k in results:
+            assert np.isclose(results[k], expected[user_name][k], atol=1e-6)
+
+
+def _predict_ratings_fitted_naive(recommendation, user_name, based, k):
+    # 近傍リストの定義どおりに1件ずつ予測する
+    user_idx = recommendation._user_dic[user_name]
+    ratings = recommendation._get_ratings_for_one_user(user_name)
+    predictions = {}
+    for item_idx in np.where(ratings == 0)[0]:
+        numerator, denominator = 0.0, 0.0
+        if based == 'item':
+            sim = recommendation._get_similarity_matrix('item')[item_idx].copy()
+            sim[item_idx] = -np.inf
+            for j in np.argsort(-sim, kind='stable')[:k]:
+                if ratings[j] != 0:
+                    numerator += sim[j] * (ratings[j] - recommendation._item_mean[j])
+                    denominator += abs(sim[j])
+            bias = recommendation._item_mean[item_idx]
+        else:
+            sim = recommendation._get_similarity_matrix('user')[user_idx].copy()
+            sim[user_idx] = -np.inf
+            for v in np.argsort(-sim, kind='stable')[:k]:
+                rating = recommendation.matrix[v, item_idx]
+                if rating != 0:
+                    numerator += sim[v] * (rating - recommendation._user_mean[v])
+                    denominator += abs(sim[v])
+            bias = recommendation._user_mean[user_idx]
+        predictions[recommendation._items.names[item_idx]] = bias + \
+            (numerator / denominator if denominator != 0 else 0.0)
+    return predictions
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('based', ['user', 'item'])
+def test_fit_neighbors_top_k(recommendation_fixture, storage, based, tmp_path):
+    recommendation = Recommendation(storage=storage)
+    recommendation.fit_neighbors(based, k=2)
+    for user_name in recommendation._get_user_list():
+        expected = _predict_ratings_fitted_naive(
+            recommendation_fixture, user_name, based, 2)
+        results = recommendation._predict_ratings(user_name, based)
+        assert expected.keys() == results.keys()
+        for k in results:
+            assert np.isclose(results[k], expected[k], atol=1e-6)
+    # 近傍リストはスナップショットに含まれる
+    recommendation.save_snapshot(str(tmp_path))
+    loaded = Recommendation(file_name=str(tmp_path), file_format='snapshot', storage=storage)
+    assert based in loaded._neighbors
+    assert loaded._similarity_cache == {}
+    user_list = recommendation._get_user_list()
+    assert loaded.get_recommendations_batch(user_list, based=based) == \
+        recommendation.get_recommendations_batch(user_list, based=based)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('based', ['user', 'item'])
+def test_similarity_blocks(storage, based):
+    expected = Recommendation(storage=storage, similarity_dtype='float64', shrinkage=1.0)
+    # 1行ずつ計算しても、float32で保持しても結果は変わらない
+    recommendation = Recommendation(storage=storage, memory_budget=1, shrinkage=1.0)
+    sim_matrix = recommendation._get_similarity_matrix(based)
+    assert sim_matrix.dtype == np.float32
+    assert expected._get_similarity_matrix(based).dtype == np.float64
+    assert np.allclose(sim_matrix, expected._get_similarity_matrix(based), atol=1e-6)
+    indices, scores = recommendation.fit_neighbors(based, k=3)
+    expected_indices, expected_scores = expected.fit_neighbors(based, k=3, block_size=1000)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(scores, expected_scores)
+    with pytest.raises(Exception):
+        Recommendation(similarity_dtype='float16')._get_similarity_matrix(based)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_lazy(storage, tmp_path):
+    expected = Recommendation(storage=storage)
+    user_list = expected._get_user_list()
+    recommendation = Recommendation(storage=storage, lazy=True)
+    # 初めてアクセスするまで読み込まない
+    assert 'matrix' not in recommendation.__dict__
+    assert recommendation.get_recommendations_batch(user_list, based='item') == \
+        expected.get_recommendations_batch(user_list, based='item')
+    # 平均評価値は初めて使う時点で計算する
+    recommendation = Recommendation(storage=storage)
+    assert '_user_mean' not in recommendation.__dict__
+    assert np.allclose(recommendation._get_average_ratings('user'),
+                       recommendation._user_rating_sum / recommendation._user_rating_count)
+    # スナップショットの近傍リストも、初めてアクセスした時点で読み込む
+    expected.fit_neighbors('item', k=2)
+    expected.save_snapshot(str(tmp_path))
+    loaded = Recommendation(file_name=str(tmp_path), file_format='snapshot', storage=storage, lazy=True)
+    assert 'item' in loaded._neighbors
+    assert loaded.get_recommendations_batch(user_list, based='item') == \
+        expected.get_recommendations_batch(user_list, based='item')
+    missing = Recommendation(file_name=str(tmp_path / 'missing.json'), lazy=True)
+    with pytest.raises(FileNotFoundError):
+        missing.matrix
+
+
+def test_lazy_threads():
+    expected = Recommendation()
+    user_list = expected._get_user_list()
+    for _ in range(10):
+        recommendation = Recommendation(lazy=True)
+        barrier = threading.Barrier(4)
+        results = [None] * 4
+
+        def recommend(i):
+            barrier.wait()
+            results[i] = recommendation.get_recommendations(user_list[i])
+
+        threads = [threading.Thread(target=recommend, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 読み込み中の属性にアクセスしたスレッドも、読み込みの完了を待って同じ結果を得る
+        assert results == [expected.get_recommendations(user_name) for user_name in user_list[:4]]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_pickle(lazy):
+    expected = Recommendation()
+    user_list = expected._get_user_list()
+    recommendation = Recommendation(lazy=lazy)
+    for restored in (pickle.loads(pickle.dumps(recommendation)), copy.deepcopy(recommendation)):
+        assert restored.get_recommendations_batch(user_list) == expected.get_recommendations_batch(user_list)
+        assert restored._load_lock is not recommendation._load_lock
+
+
+def test_view():
+    recommendation = Recommendation(storage='sparse')
+    user_list = recommendation._get_user_list()
+    recommendation._get_similarity_matrix('item')
+    view = recommendation.view(metric='pearson', missing_value=-1.0, n_neighbors=2)
+    assert view.matrix is recommendation.matrix and view._users is recommendation._users
+    expected = Recommendation(storage='sparse', metric='pearson', missing_value=-1.0, n_neighbors=2)
+    for based in ('user', 'item'):
+        assert view.get_recommendations_batch(user_list, based=based) == \
+            expected.get_recommendations_batch(user_list, based=based)
+    # 類似度の設定が同じ場合は類似度行列を共有する
+    view = recommendation.view(n_neighbors=2)
+    assert view._similarity_cache[('item', 'euclidean')] is \
+        recommendation._similarity_cache[('item', 'euclidean')]
+    assert recommendation.view(shrinkage=1.0)._similarity_cache == {}
+    # 評価値行列を共有した後は、いずれも評価値を更新できない
+    for target in (recommendation, view):
+        with pytest.raises(Exception):
+            target.add_rating('new user', 'Superman Returns', 3.0)
+        with pytest.raises(Exception):
+            target.remove_rating('Lisa Rose', 'Superman Returns')
+    dense = Recommendation()
+    with pytest.raises(Exception):
+        dense.view(missing_value=-1.0)
+    with pytest.raises(Exception):
+        dense.view(storage='sparse')
+    # 元の推薦器は、ビューを作成できなかった場合は更新できる
+    dense.add_rating('new user', 'Superman Returns', 3.0)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_get_recommendations_mf(storage, tmp_path):
+    recommendation = Recommendation(storage=storage)
+    user_list = recommendation._get_user_list()
+    # 未学習の場合は既定の設定で学習する
+    recommendations = recommendation.get_recommendations(user_list[0], based='mf')
+    assert sorted(recommendations) == sorted(
+        recommendation._get_item_list_not_rated_by(user_list[0]))
+    assert recommendation._factor_model is not None
+    model = recommendation.fit_factors(n_factors=2, n_epochs=20, regularization=0.01)
+    user_idx, item_idx, ratings = recommendation._get_rating_triplets()
+    assert model.rmse(user_idx, item_idx, ratings) < 0.5
+    for user_name in user_list:
+        predictions = recommendation._predict_ratings(user_name, based='mf')
+        assert sorted(predictions) == sorted(
+            recommendation._get_item_list_not_rated_by(user_name))
+    batch = recommendation.get_recommendations_batch(user_list, based='mf', top_n=2)
+    recommendation.save_snapshot(str(tmp_path))
+    loaded = Recommendation(file_name=str(tmp_path), file_format='snapshot', storage=storage)
+    assert loaded._factor_model.n_factors == 2
+    assert loaded.get_recommendations_batch(user_list, based='mf', top_n=2) == batch
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_get_recommendations_baseline(storage, tmp_path):
+    recommendation = Recommendation(storage=storage)
+    user_list = recommendation._get_user_list()
+    model = recommendation.fit_baseline(n_epochs=2)
+    for user_name in user_list:
+        predictions = recommendation._predict_ratings(user_name, based='baseline')
+        assert sorted(predictions) == sorted(
+            recommendation._get_item_list_not_rated_by(user_name))
+        user_idx = recommendation._user_dic[user_name]
+        for item_name, rating in predictions.items():
+            item_idx = recommendation._item_dic[item_name]
+            assert np.isclose(
+                rating, model.global_mean + model.user_bias[user_idx] + model.item_bias[item_idx])
+    batch = recommendation.get_recommendations_batch(user_list, based='baseline', top_n=2)
+    recommendation.save_snapshot(str(tmp_path))
+    loaded = Recommendation(file_name=str(tmp_path), file_format='snapshot', storage=storage)
+    assert loaded._baseline_model.n_epochs == 2
+    assert loaded.get_recommendations_batch(user_list, based='baseline', top_n=2) == batch
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_cold_start(storage, tmp_path):
+    with open('data/ratings.json') as f:
+        ratings = json.load(f)
+    ratings['New User'] = {}
+    file_name = str(tmp_path / 'ratings.json')
+    with open(file_name, 'w') as f:
+        json.dump(ratings, f)
+    with pytest.raises(Exception):
+        Recommendation(file_name=file_name, storage=storage).get_recommendations('New User')
+    recommendation = Recommendation(file_name=file_name, storage=storage, cold_start='baseline')
+    expected = recommendation.get_recommendations('New User', based='baseline')
+    assert len(expected) == len(recommendation._get_item_list())
+    for based in ['user', 'item']:
+        assert recommendation.get_recommendations('New User', based=based) == expected
+        batch = recommendation.get_recommendations_batch(['New User', 'Toby'], based=based)
+        assert batch['New User'] == expected
+        assert batch['Toby'] == recommendation.get_recommendations('Toby', based=based)
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_result_cache(storage):
+    recommendation = Recommendation(storage=storage, cache_size=100)
+    reference = Recommendation(storage=storage)
+    user_list = recommendation._get_user_list()
+    for based in ['user', 'item', 'mf']:
+        for user_name in user_list:
+            expected = reference.get_recommendations(user_name, based=based, top_n=3)
+            assert recommendation.get_recommendations(user_name, based=based, top_n=3) == expected
+            # 2回目はキャッシュから返し、返却したリストの変更はキャッシュに影響しない
+            cached = recommendation.get_recommendations(user_name, based=based, top_n=3)
+            assert cached == expected
+            cached.append('dummy')
+    info = recommendation.cache_info()
+    assert info['hits'] == 3 * len(user_list)
+    assert info['misses'] == 3 * len(user_list)
+    assert recommendation.get_recommendations_batch(user_list, based='item', top_n=3) == \
+        reference.get_recommendations_batch(user_list, based='item', top_n=3)
+    assert recommendation.cache_info()['hits'] == 4 * len(user_list)
+    # 評価値の更新で、近傍による推薦は全て、行列分解による推薦は更新したユーザの分だけ無効化する
+    user_name = user_list[0]
+    item_name = recommendation._get_item_list_not_rated_by(user_name)[0]
+    for r in [recommendation, reference]:
+        r.add_rating(user_name, item_name, 1.0)
+    info = recommendation.cache_info()
+    assert info['entries'] == len(user_list) - 1
+    for based in ['user', 'item', 'mf']:
+        assert recommendation.get_recommendations_batch(user_list, based=based, top_n=3) == \
+            reference.get_recommendations_batch(user_list, based=based, top_n=3)
+    recommendation.fit_factors(n_factors=2)
+    assert recommendation.cache_info()['entries'] == 0
+    assert Recommendation(storage=storage).cache_info() == {}
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('metric', ['euclidean', 'pearson', 'adjusted_cosine'])
+def test_rating_dtype(storage, metric, tmp_path):
+    file_name = str(tmp_path / 'ratings.csv')
+    SyntheticRatings(n_users=40, n_items=30, density=0.2).write(file_name)
+    expected = Recommendation(file_name=file_name, file_format='csv', storage=storage, metric=metric)
+    user_list = expected._get_user_list()
+    for rating_dtype, dtype in [('float32', np.float32), ('uint8', np.uint8)]:
+        recommendation = Recommendation(file_name=file_name, file_format='csv', storage=storage,
+                                        metric=metric, rating_dtype=rating_dtype)
+        data = recommendation.matrix if storage == 'dense' else recommendation.matrix.data
+        assert data.dtype == dtype
+        for based in ['user', 'item']:
+            assert recommendation.get_recommendations_batch(user_list, based=based, top_n=5) == \
+                expected.get_recommendations_batch(user_list, based=based, top_n=5)
+        similar = recommendation._get_similar_objects('user', user_list[0], top_n=3)
+        expected_similar = expected._get_similar_objects('user', user_list[0], top_n=3)
+        assert [s[0] for s in similar] == [s[0] for s in expected_similar]
+        recommendation.add_rating(user_list[0], 'new item', 3)
+        assert recommendation._get_rating(user_list[0], 'new item') == 3.0
+        path = str(tmp_path / rating_dtype)
+        recommendation.save_snapshot(path)
+        loaded = Recommendation(file_name=path, file_format='snapshot', storage=storage,
+                                metric=metric, rating_dtype=rating_dtype)
+        assert loaded.get_recommendations_batch(user_list, top_n=5) == \
+            recommendation.get_recommendations_batch(user_list, top_n=5)
+        with pytest.raises(Exception):
+            Recommendation(file_name=path, file_format='snapshot', storage=storage, metric=metric)
+    # uint8は0〜255の整数の評価値しか保持できない
+    with pytest.raises(Exception):
+        Recommendation(storage=storage, rating_dtype='uint8')
+    with pytest.raises(Exception):
+        Recommendation(storage=storage, rating_dtype='int64')
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+@pytest.mark.parametrize('based,n_neighbors,fitted', [
+    ('user', 0, False), ('user', 3, False), ('user', 0, True),
+    ('item', 0, False), ('item', 3, False), ('item', 0, True),
+    ('mf', 0, False), ('baseline', 0, False)])
+def test_candidate_filters(storage, based, n_neighbors, fitted, tmp_path):
+    file_name = str(tmp_path / 'ratings.csv')
+    SyntheticRatings(n_users=30, n_items=40, density=0.2).write(file_name)
+    recommendation = Recommendation(file_name=file_name, file_format='csv', storage=storage,
+                                    n_neighbors=n_neighbors, cold_start='baseline')
+    if fitted:
+        recommendation.fit_neighbors(based, k=5)
+    recommendation.add_user('New User')
+    user_list = recommendation._get_user_list()
+    item_list = recommendation._get_item_list()
+    allow = item_list[::3] + ['unknown item']
+    deny = item_list[:6]
+    for user_name in user_list[:5] + ['New User']:
+        user_idx = recommendation._users[user_name]
+        expected = recommendation._predict_ratings_vector(user_idx, based)
+        mask = recommendation._get_candidate_mask(np.array([user_idx]), allow=allow, deny=deny)[0]
+        predictions = recommendation._predict_ratings_vector(user_idx, based, candidate_mask=mask)
+        assert np.all(np.isnan(predictions[~mask]))
+        assert np.allclose(predictions[mask], expected[mask], equal_nan=True)
+    # 候補だけを予測した結果は、全アイテムの推薦リストから候補外を除いたものと一致する
+    results = recommendation.get_recommendations_batch(
+        user_list, based=based, block_size=7, allow=allow, deny=deny)
+    for user_name in user_list[:5]:
+        full = recommendation.get_recommendations(user_name, based=based)
+        filtered = [item for item in full if item in set(allow) - set(deny)]
+        assert recommendation.get_recommendations(user_name, based=based, allow=allow, deny=deny) == filtered
+        assert results[user_name] == filtered
+
+
+def test_candidate_filters_similarity_rows():
+    recommendation = Recommendation(storage='sparse')
+    user_name = recommendation._get_user_list()[0]
+    allow = recommendation._get_item_list_not_rated_by(user_name)[:2]
+    results = recommendation.get_recommendations(user_name, based='item', allow=allow)
+    assert sorted(results) == sorted(allow)
+    # 類似度は候補のアイテムの行だけを計算する
+    assert sorted(key[2] for key in recommendation._similarity_row_cache) == \
+        sorted(recommendation._items[item_name] for item_name in allow)
+    assert recommendation._similarity_cache == {}
+    assert recommendation.get_recommendations(user_name, based='item', allow=[]) == []
+    # 密行列でも類似度行列全体は計算しない
+    recommendation = Recommendation()
+    expected = Recommendation()
+    for based in ['user', 'item']:
+        results = recommendation.get_recommendations(user_name, based=based, allow=allow)
+        assert recommendation._similarity_cache == {}
+        predictions = expected._predict_ratings(user_name, based)
+        assert results == sorted(allow, key=lambda item_name: -predictions[item_name])
+    # 候補を指定した結果はキャッシュしない
+    recommendation = Recommendation(cache_size=8)
+    recommendation.get_recommendations(user_name, deny=allow)
+    assert recommendation.cache_info()['entries'] == 0
+
+
+@pytest.mark.parametrize('storage', ['dense', 'sparse'])
+def test_get_recommendations_cooccurrence(storage, tmp_path):
+    file_name = str(tmp_path / 'events.csv')
+    events = [('u1', 'a'), ('u1', 'b'), ('u2', 'a'), ('u2', 'b'), ('u2', 'c'),
+              ('u3', 'b'), ('u3', 'c'), ('u3', 'c'), ('u4', 'd')]
+    with open(file_name, 'w') as f:
+        f.write('user,item\n')
+        for user_name, item_name in events:
+            f.write('{},{}\n'.format(user_name, item_name))
+    recommendation = Recommendation(file_name=file_name, file_format='csv', storage=storage, implicit=True)
+    # 同じ組が複数あっても1回の接触とみなす
+    assert recommendation._get_rating('u3', 'c') == 1.0
+    recommendation.fit_cooccurrence('count')
+    # u1のa, bとの共起回数: cはbと2回、aと1回、dは0回
+    assert recommendation.get_recommendations('u1', based='cooccurrence') == ['c', 'd']
+    recommendation.fit_cooccurrence('cosine')
+    predictions = recommendation._predict_ratings('u1', 'cooccurrence')
+    assert np.isclose(predictions['c'], 1 / np.sqrt(2 * 2) + 2 / np.sqrt(3 * 2))
+    # 評価値の追加では共起行列は変わらず、ユーザの評価済みアイテムだけが変わる
+    recommendation.add_rating('u4', 'a', 5)
+    assert recommendation._get_rating('u4', 'a') == 1.0
+    assert recommendation.get_recommendations('u4', based='cooccurrence', top_n=1) == ['b']
+    path = str(tmp_path / 'snapshot')
+    recommendation.save_snapshot(path)
+    loaded = Recommendation(file_name=path, file_format='snapshot', storage=storage, implicit=True)
+    assert loaded._cooccurrence_model.normalization == 'cosine'
+    assert loaded.get_recommendations_batch(['u1', 'u2', 'u4'], based='cooccurrence') == \
+        recommendation.get_recommendations_batch(['u1', 'u2', 'u4'], based='cooccurrence')
+    assert loaded.get_recommendations('u1', based='cooccurrence', allow=['d']) == ['d']
@@ -0,0 +1,67 @@
+from recommendation import Recommendation
+from server import RecommendationService, serve
+import asyncio
+import json
+import pytest
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_recommendation_service(executor):
+    recommendation = Recommendation()
+    user_list = recommendation._get_user_list()
+    expected = recommendation.get_recommendations_batch(user_list, based='item', top_n=2)
+
+    async def run():
+        async with RecommendationService(recommendation, executor=executor, n_workers=2,
+                                         max_batch_size=4, batch_wait=0.01) as service:
+            requests = [service.recommend(user_name, based='item', top_n=2)
+                        for user_name in user_list * 3]
+            results = await asyncio.gather(*requests)
+            with pytest.raises(Exception):
+                await service.recommend('Unknown User')
+            # 別のユーザと同じバッチに入っても、未知のユーザ以外は結果を返す
+            results_with_unknown = await asyncio.gather(
+                service.recommend(user_list[0], based='item', top_n=2),
+                service.recommend('Unknown User', based='item', top_n=2), return_exceptions=True)
+            return results, results_with_unknown, service.stats
+
+    results, results_with_unknown, stats = asyncio.run(run())
+    assert results == [expected[user_name] for user_name in user_list * 3]
+    assert results_with_unknown[0] == expected[user_list[0]]
+    assert isinstance(results_with_unknown[1], Exception)
+    # 計算中の同じリクエストはまとめ、異なるユーザはバッチにまとめる
+    assert stats['coalesced'] == 2 * len(user_list)
+    assert stats['batched_users'] == len(user_list) + 3
+    assert stats['batches'] < stats['batched_users']
+
+
+def test_recommendation_service_not_started():
+    service = RecommendationService(Recommendation())
+    with pytest.raises(Exception):
+        asyncio.run(service.recommend('Toby'))
+
+
+def test_serve():
+    recommendation = Recommendation()
+    user_list = recommendation._get_user_list()
+    expected = recommendation.get_recommendations_batch(user_list, top_n=3)
+
+    async def run():
+        async with RecommendationService(recommendation) as service:
+            server = await serve(service, port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for user_name in user_list + ['Unknown User']:
+                writer.write((json.dumps({'user': user_name, 'top_n': 3}) + '\n').encode())
+                await writer.drain()
+                responses.append(json.loads(await reader.readline()))
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return responses
+
+    responses = asyncio.run(run())
+    assert [r['items'] for r in responses[:-1]] == [expected[user_name] for user_name in user_list]
+    assert responses[-1]['user'] == 'Unknown User'
+    assert 'error' in responses[-1]
@@ -54,3 +54,196 @@ def test_calc_similarity(v1, v2):
         v1, v2, metric='euclidean') == similarity.calc_euclidean_similarity(v1, v2)
     assert similarity.calc_similarity(
         v1, v2, metric='pearson') == similarity.calc_pearson_correlation_coefficient(v1, v2)
+
+
+@pytest.mark.parametrize('v1,v2,expected', [
+    (np.array([1, 2]), np.array([2, 4]), 1),
+    (np.array([1, 0]), np.array([0, 1]), 0),
+    (np.array([1, 1]), np.array([-1, -1]), -1),
+    (np.array([0, 0]), np.array([3, 4]), 0),
+], ids=['parallel', 'orthogonal', 'opposite', 'zero_vector'])
+def test_calc_cosine_similarity(v1, v2, expected):
+    assert np.isclose(similarity.calc_cosine_similarity(v1, v2), expected)
+
+
+@pytest.mark.parametrize('v1,v2,expected', [
+    (np.array([1, 2, 0]), np.array([3, 0, 0]), 1/2),
+    (np.array([1, 2, 0]), np.array([0, 0, 4]), 0),
+    (np.array([0, 0, 0]), np.array([0, 0, 0]), 0),
+], ids=['half', 'disjoint', 'empty'])
+def test_calc_similarity_with_missing_value_jaccard(v1, v2, expected):
+    assert similarity.calc_similarity_with_missing_value(
+        v1, v2, 'jaccard') == expected
+
+
+def test_calc_similarity_with_missing_value_adjusted_cosine():
+    v1 = np.array([1, 3, 0])
+    v2 = np.array([3, 1, 2])
+    means = np.array([2, 2, 2])
+    assert np.isclose(similarity.calc_similarity_with_missing_value(
+        v1, v2, 'adjusted_cosine', dimension_means=means), -1)
+    with pytest.raises(Exception):
+        similarity.calc_similarity_with_missing_value(v1, v2, 'adjusted_cosine')
+
+
+_METRICS = ['euclidean', 'pearson', 'cosine', 'adjusted_cosine', 'jaccard']
+
+
+def _calc_dimension_means(m, missing_value=0):
+    observed = m != missing_value
+    return np.where(observed, m, 0).sum(axis=0) / np.maximum(observed.sum(axis=0), 1)
+
+
+@pytest.mark.parametrize('metric', _METRICS)
+@pytest.mark.parametrize('missing_value', [0, -1])
+def test_calc_similarity_matrix_with_missing_value(metric, missing_value):
+    rng = np.random.default_rng(0)
+    m = rng.integers(1, 6, size=(8, 12)).astype(float)
+    m[rng.random(m.shape) < 0.4] = missing_value
+    m[0] = missing_value  # 評価が1つもない行
+    means = _calc_dimension_means(m, missing_value)
+    results = similarity.calc_similarity_matrix_with_missing_value(
+        m, m[:5], metric, missing_value, dimension_means=means)
+    assert results.shape == (8, 5)
+    for i in range(m.shape[0]):
+        for j in range(5):
+            expected = similarity.calc_similarity_with_missing_value(
+                m[i], m[j], metric, missing_value, dimension_means=means)
+            assert np.isclose(results[i, j], expected)
+        vector = similarity.calc_similarity_vector_with_missing_value(
+            m[i], m[:5], metric, missing_value, dimension_means=means)
+        assert np.allclose(vector, results[i])
+
+
+@pytest.mark.parametrize('metric', _METRICS)
+@pytest.mark.parametrize('memory_budget', [1, 2 ** 12, 2 ** 28])
+def test_calc_similarity_matrix_in_blocks(metric, memory_budget):
+    rng = np.random.default_rng(3)
+    m = rng.integers(1, 6, size=(20, 12)).astype(float)
+    m[rng.random(m.shape) < 0.4] = -1
+    expected = similarity.shrink_similarity(
+        similarity.calc_similarity_matrix_with_missing_value(m, m, metric, -1),
+        similarity.calc_co_rating_count_matrix(m, m, -1), shrinkage=2, min_overlap=3)
+    results = similarity.calc_similarity_matrix_in_blocks(
+        m, m, metric, -1, memory_budget=memory_budget, shrinkage=2, min_overlap=3)
+    assert results.dtype == np.float32
+    assert np.allclose(results, expected, atol=1e-6)
+    results = similarity.calc_similarity_matrix_in_blocks(
+        m, m, metric, -1, dtype=np.float64, memory_budget=memory_budget, shrinkage=2, min_overlap=3)
+    assert results.dtype == np.float64
+    assert np.allclose(results, expected)
+
+
+def test_get_block_shape():
+    # 比較対象側の前処理済みの行列が予算の半分に収まる場合は、列を分けない
+    n_rows, n_columns = similarity.get_block_shape(1000, 10, 2 ** 22)
+    assert n_columns == 1000
+    assert n_rows == (2 ** 22 - 1000 * 5 * 10 * 8) // (8 * (5 * 10 + 8 * 1000 + 1000))
+    # 収まらない場合は列も分け、作業領域全体を予算に収める
+    n_rows, n_columns = similarity.get_block_shape(10000, 1000, 2 ** 24)
+    assert n_columns < 10000
+    assert 8 * (5 * 1000 * (n_rows + n_columns) + 8 * n_rows * n_columns + n_rows * 10000) <= 2 ** 24
+    # 1行も収まらない場合も1行ずつ計算する
+    assert similarity.get_block_shape(1000, 10, 1) == (1, 1)
+
+
+@pytest.mark.parametrize('metric', _METRICS)
+def test_iter_similarity_blocks_columns(metric):
+    rng = np.random.default_rng(6)
+    m = rng.integers(1, 6, size=(13, 9)).astype(float)
+    m[rng.random(m.shape) < 0.4] = 0
+    expected = similarity.calc_similarity_matrix_with_missing_value(m, m[:11], metric)
+    # 比較対象側も分けて前処理しても、結果は変わらない
+    blocks = list(similarity.iter_similarity_blocks(m, m[:11], metric, block_size=4, column_block_size=3))
+    assert [start for start, _ in blocks] == [0, 4, 8, 12]
+    assert np.allclose(np.concatenate([block for _, block in blocks]), expected)
+
+
+@pytest.mark.parametrize('k', [0, 1, 3, 6, 8])
+def test_select_top_k_rows(k):
+    rng = np.random.default_rng(4)
+    # 同じ値を多く含む
+    sim = rng.integers(0, 3, size=(10, 6)).astype(float)
+    sim[0] = -np.inf
+    results = similarity.select_top_k_rows(sim, k)
+    expected = np.argsort(-sim, axis=1, kind='stable')[:, :k]
+    assert np.array_equal(results, expected)
+
+
+@pytest.mark.parametrize('metric', _METRICS)
+def test_calc_top_k_similarity(metric):
+    rng = np.random.default_rng(5)
+    m = rng.integers(1, 6, size=(15, 10)).astype(float)
+    m[rng.random(m.shape) < 0.5] = 0
+    sim = similarity.calc_similarity_matrix_with_missing_value(m, m, metric)
+    np.fill_diagonal(sim, -np.inf)
+    indices, scores = similarity.calc_top_k_similarity(m, 4, metric, memory_budget=1)
+    assert indices.dtype == np.int32 and scores.dtype == np.float32
+    assert indices.shape == scores.shape == (15, 4)
+    assert not np.any(indices == np.arange(15)[:, np.newaxis])
+    assert np.allclose(scores, -np.sort(-sim, axis=1)[:, :4])
+    assert np.allclose(np.take_along_axis(sim, indices.astype(np.int64), axis=1), scores)
+
+
+@pytest.mark.parametrize('metric', _METRICS)
+def test_calc_similarity_vector_with_sparse_matrix(metric):
+    rng = np.random.default_rng(1)
+    m = rng.integers(1, 6, size=(7, 10)).astype(float)
+    m[rng.random(m.shape) < 0.5] = 0
+    m[3] = 0  # 評価が1つもない行
+    # 次元(列)方向に圧縮した形式
+    col_order = np.lexsort(np.nonzero(m))
+    row, col = np.nonzero(m)
+    row, col = row[col_order], col[col_order]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(col, minlength=10))])
+    for i in range(m.shape[0]):
+        indices = np.nonzero(m[i])[0]
+        results = similarity.calc_similarity_vector_with_sparse_matrix(
+            indices, m[i, indices], indptr, row, m[row, col], 7, metric)
+        expected = similarity.calc_similarity_matrix_with_missing_value(
+            m[i:i + 1], m, metric)[0]
+        assert np.allclose(results, expected)
+
+
+@pytest.mark.parametrize('metric', _METRICS)
+def test_calc_similarity_vector_with_sparse_rows(metric):
+    rng = np.random.default_rng(2)
+    m = rng.integers(1, 6, size=(7, 10)).astype(float)
+    m[rng.random(m.shape) < 0.5] = 0
+    row, col = np.nonzero(m)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(row, minlength=7))])
+    rows = np.array([5, 0, 3])
+    results = similarity.calc_similarity_vector_with_sparse_rows(
+        m[1], m[1] != 0, indptr, col, m[row, col], rows, metric)
+    # 次元ごとの平均は行列全体から計算される
+    expected = similarity.calc_similarity_matrix_with_missing_value(
+        m[1:2], m[rows], metric, dimension_means=_calc_dimension_means(m))[0]
+    assert np.allclose(results, expected)
+
+
+def test_shrink_similarity():
+    sim = np.array([1.0, 0.5, -0.5, 0.8])
+    n = np.array([1, 4, 4, 0])
+    assert np.allclose(similarity.shrink_similarity(sim, n, shrinkage=4),
+                       [0.2, 0.25, -0.25, 0])
+    assert np.allclose(similarity.shrink_similarity(sim, n, min_overlap=2),
+                       [0, 0.5, -0.5, 0])
+    assert np.allclose(similarity.shrink_similarity(sim, n), sim)
+
+
+def test_calc_co_rating_counts():
+    rng = np.random.default_rng(3)
+    m = rng.integers(1, 6, size=(7, 10)).astype(float)
+    m[rng.random(m.shape) < 0.5] = 0
+    expected = similarity.calc_co_rating_count_matrix(m, m)
+    assert np.array_equal(expected, (m != 0).astype(int) @ (m != 0).T)
+    row, col = np.nonzero(m)
+    col_order = np.argsort(col, kind='stable')
+    col_indptr = np.concatenate([[0], np.cumsum(np.bincount(col, minlength=10))])
+    row_indptr = np.concatenate([[0], np.cumsum(np.bincount(row, minlength=7))])
+    rows = np.array([5, 0, 3])
+    for i in range(m.shape[0]):
+        assert np.array_equal(similarity.calc_co_rating_count_vector_with_sparse_matrix(
+            np.nonzero(m[i])[0], col_indptr, row[col_order], 7), expected[i])
+        assert np.array_equal(similarity.calc_co_rating_count_vector_with_sparse_rows(
+            m[i] != 0, row_indptr, col, rows), expected[i, rows])
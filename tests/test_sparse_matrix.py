@@ -0,0 +1,157 @@
+import pytest
+import numpy as np
+from sparse_matrix import SparseRatingMatrix, expand_ranges
+import sparse_matrix
+
+
+@pytest.fixture
+def dense_fixture():
+    rng = np.random.default_rng(0)
+    m = rng.integers(1, 6, size=(6, 9)).astype(float)
+    m[rng.random(m.shape) < 0.5] = 0
+    m[2] = 0  # 評価が1つもない行
+    m[:, 4] = 0  # 評価が1つもない列
+    return m
+
+
+@pytest.fixture
+def sparse_fixture(dense_fixture):
+    row, col = np.nonzero(dense_fixture)
+    return SparseRatingMatrix.from_triplets(
+        row, col, dense_fixture[row, col], dense_fixture.shape)
+
+
+@pytest.mark.parametrize('starts,lengths,expected', [
+    (np.array([3, 0]), np.array([2, 1]), [3, 4, 0]),
+    (np.array([5, 1]), np.array([0, 2]), [1, 2]),
+    (np.array([], dtype=int), np.array([], dtype=int), []),
+], ids=['basic', 'empty_range', 'empty'])
+def test_expand_ranges(starts, lengths, expected):
+    assert expand_ranges(starts, lengths).tolist() == expected
+
+
+def test_from_triplets_duplicates():
+    m = SparseRatingMatrix.from_triplets(
+        np.array([0, 1, 0]), np.array([1, 0, 1]), np.array([1.0, 2.0, 3.0]), (2, 2))
+    assert m.nnz == 2
+    assert m.get(0, 1) == 3.0  # 後の値を採用する
+    assert m.get(1, 0) == 2.0
+    assert m.get(0, 0) is None
+
+
+def test_toarray(dense_fixture, sparse_fixture):
+    assert sparse_fixture.nnz == np.count_nonzero(dense_fixture)
+    assert (sparse_fixture.toarray() == dense_fixture).all()
+    expected = np.where(dense_fixture != 0, dense_fixture, -1)
+    assert (sparse_fixture.toarray(-1) == expected).all()
+
+
+def test_get_row_and_col(dense_fixture, sparse_fixture):
+    for i in range(dense_fixture.shape[0]):
+        indices, data = sparse_fixture.get_row(i)
+        assert indices.tolist() == np.nonzero(dense_fixture[i])[0].tolist()
+        assert (data == dense_fixture[i, indices]).all()
+        assert (sparse_fixture.row_to_dense(i) == dense_fixture[i]).all()
+    for j in range(dense_fixture.shape[1]):
+        indices, data = sparse_fixture.get_col(j)
+        assert indices.tolist() == np.nonzero(dense_fixture[:, j])[0].tolist()
+        assert (data == dense_fixture[indices, j]).all()
+        assert (sparse_fixture.col_to_dense(j) == dense_fixture[:, j]).all()
+
+
+def test_counts_and_sums(dense_fixture, sparse_fixture):
+    assert (sparse_fixture.row_counts() ==
+            np.count_nonzero(dense_fixture, axis=1)).all()
+    assert (sparse_fixture.col_counts() ==
+            np.count_nonzero(dense_fixture, axis=0)).all()
+    assert np.allclose(sparse_fixture.row_sums(), dense_fixture.sum(axis=1))
+    assert np.allclose(sparse_fixture.col_sums(), dense_fixture.sum(axis=0))
+
+
+def test_rows_to_dense(dense_fixture, sparse_fixture):
+    row_idx = np.array([4, 2, 0])
+    m, mask = sparse_fixture.rows_to_dense(row_idx, -1)
+    assert (mask == (dense_fixture[row_idx] != 0)).all()
+    assert (m == np.where(mask, dense_fixture[row_idx], -1)).all()
+
+
+def test_left_matmul(dense_fixture, sparse_fixture):
+    a = np.random.default_rng(2).normal(size=(3, dense_fixture.shape[0]))
+    assert np.allclose(sparse_fixture.left_matmul(a), a @ dense_fixture)
+    ones = np.ones(sparse_fixture.nnz)
+    assert np.allclose(sparse_fixture.left_matmul(a, ones),
+                       a @ (dense_fixture != 0))
+    # 一部の列だけを計算する
+    col_idx = np.array([3, 0, 3])
+    assert np.allclose(sparse_fixture.left_matmul(a, ones, col_idx),
+                       (a @ (dense_fixture != 0))[:, col_idx])
+    assert sparse_fixture.left_matmul(a, col_idx=np.zeros(0, dtype=np.int64)).shape == (3, 0)
+
+
+def test_dtype(dense_fixture):
+    row, col = np.nonzero(dense_fixture)
+    m = SparseRatingMatrix.from_triplets(
+        row, col, dense_fixture[row, col], dense_fixture.shape, np.uint8)
+    assert m.data.dtype == np.uint8
+    assert m.col_data.dtype == np.uint8
+    assert np.allclose(m.row_sums(), dense_fixture.sum(axis=1))
+    # 新しい要素を追加しても型を保つ
+    m.set_values(np.array([2]), np.array([4]), np.array([5.0]))
+    assert m.data.dtype == np.uint8
+    assert m.get(2, 4) == 5.0
+
+
+def _assert_matches(m, expected):
+    observed = ~np.isnan(expected)
+    assert m.nnz == observed.sum()
+    for i in range(expected.shape[0]):
+        indices, data = m.get_row(i)
+        assert indices.tolist() == np.flatnonzero(observed[i]).tolist()
+        assert (data == expected[i, indices]).all()
+    for j in range(expected.shape[1]):
+        indices, data = m.get_col(j)
+        assert indices.tolist() == np.flatnonzero(observed[:, j]).tolist()
+        assert (data == expected[indices, j]).all()
+    dense, mask = m.rows_to_dense(np.arange(expected.shape[0]), np.nan)
+    assert (mask == observed).all()
+    assert np.array_equal(dense, expected, equal_nan=True)
+    assert m.get(0, 0) == (None if np.isnan(expected[0, 0]) else expected[0, 0])
+
+
+def test_set_and_remove_values(dense_fixture, sparse_fixture):
+    rng = np.random.default_rng(3)
+    m = sparse_fixture
+    expected = np.where(dense_fixture != 0, dense_fixture, np.nan)
+    for _ in range(40):
+        row = rng.integers(0, expected.shape[0], size=2)
+        col = rng.integers(0, expected.shape[1], size=2)
+        if rng.random() < 0.6:
+            data = rng.integers(1, 6, size=2).astype(float)
+            m.set_values(row, col, data)
+            expected[row, col] = data
+        else:
+            m.remove_values(row, col)
+            expected[row, col] = np.nan
+    # 差分と削除済みの印は統合されずに残っており、1行・1列・1要素の参照はそれも読む
+    assert m._n_pending > 0 and m._n_removed > 0
+    _assert_matches(m, expected)
+    # 行列全体を読むと統合される
+    assert np.array_equal(m.toarray(np.nan), expected, equal_nan=True)
+    assert m._n_pending == 0 and m._alive is None
+    assert (m.row_counts() == (~np.isnan(expected)).sum(axis=1)).all()
+    _assert_matches(m, expected)
+    # 統合後のCSRとCSCは並び順を保つ
+    rebuilt = SparseRatingMatrix.from_triplets(*m.to_triplets(), m.shape)
+    for name in ['indptr', 'indices', 'data', 'col_indptr', 'col_indices', 'col_data']:
+        assert (getattr(m, name) == getattr(rebuilt, name)).all()
+
+
+def test_set_values_compacts_large_delta(sparse_fixture, monkeypatch):
+    monkeypatch.setattr(sparse_matrix, '_MIN_DELTA', 2)
+    m = sparse_fixture
+    m.set_values(np.array([2, 2]), np.array([4, 5]), np.array([1.0, 2.0]))
+    assert m._n_pending == 2
+    m.set_values(np.array([2]), np.array([6]), np.array([3.0]))
+    # 差分が閾値を超えたので統合された
+    assert m._n_pending == 0
+    assert m.get_row(2)[0].tolist() == [4, 5, 6]